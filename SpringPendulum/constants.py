@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class Constants:
+    real_dt: float = 0.03
+    DT: float = 1E-2 * real_dt
+    g: float = 9.79234  # magnitude, pointing along -y
+    end_time: float = 1000 * real_dt
+    button_from_hook_length: float = 0.17
+    rod_length: float = 0.14
+    rod_mass: float = 0.1135
+    weight_mass: float = 0.2622 - rod_mass
+    spring_mass: float = 0.0414
+
+    k: float = 29.0237
+    rod_center_of_mass_from_hook: float = 0.125
+    big_weight_height: float = 0.0115
+    small_weight_height: float = 0.0085
+    spring_weightless_length: float = 0.18
+
+    @property
+    def effective_mass(self) -> float:
+        return self.weight_mass + self.rod_mass + self.spring_mass / 3
+
+    @property
+    def spring_equilibrium_length(self) -> float:
+        return self.spring_weightless_length + (self.effective_mass + self.spring_mass / 6) * self.g / self.k
+
+    def spring_length(self, total_length):
+        return total_length - self.rod_length
+
+    def center_of_mass(self, spring_length: float):
+        return ((self.weight_mass + self.rod_mass) * (self.rod_weights_center_of_mass + spring_length) +
+                self.spring_mass * spring_length / 2) / (self.rod_mass + self.weight_mass + self.spring_mass)
+
+    @property
+    def center_of_mass_at_equilibrium(self):
+        return ((self.weight_mass + self.rod_mass) * (self.rod_weights_center_of_mass + self.spring_equilibrium_length)
+                + self.spring_mass * self.spring_equilibrium_length / 2) / \
+               (self.rod_mass + self.weight_mass + self.spring_mass)
+
+    @property
+    def rod_weights_center_of_mass(self):
+        return (self.rod_mass * self.rod_center_of_mass_from_hook +
+                self.weight_mass * self.weight_center_of_mass_from_hook) / (self.weight_mass + self.rod_mass)
+
+    @property
+    def weight_center_of_mass_from_hook(self):
+        return self.rod_length - (2. / 3 * self.weight_mass * self.big_weight_height / 2 +
+                                  1. / 3 * self.weight_mass * (self.big_weight_height + self.small_weight_height / 2)) \
+               / self.weight_mass
+
+
+Constants = Constants()
@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class SpringPendulumEnergy:
+    spring: float = 0
+    gravity: float = 0
+    kinetic: float = 0
+
+    @property
+    def total(self):
+        return self.potential + self.kinetic
+
+    @property
+    def potential(self):
+        return self.spring + self.gravity
+
+
+@dataclass
+class SpringPendulumPower:
+    spring: float = 0
+    gravity: float = 0
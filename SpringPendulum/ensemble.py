@@ -0,0 +1,258 @@
+from dataclasses import dataclass
+from itertools import product
+
+import numpy as np
+
+from constants import Constants
+from energy import SpringPendulumEnergy
+from integrators import INTEGRATORS, rk45
+from noise import LangevinThermostat, NoiseGenerator
+
+
+# FUNCTIONS #
+def change_vector_length(old_vectors, new_lengths):
+    old_vectors = np.asarray(old_vectors, dtype=float)
+    return np.asarray(new_lengths, dtype=float)[..., None] * old_vectors / vector_mag(old_vectors)[..., None]
+
+
+def vector_mag(vectors):
+    # same summation order as vpython's mag so the ensemble follows the single pendulum as closely as possible
+    return np.sqrt(vectors[..., 0] ** 2 + vectors[..., 1] ** 2 + vectors[..., 2] ** 2)
+
+
+def row_dot(a, b):
+    return a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + a[..., 2] * b[..., 2]
+
+
+# CLASSES #
+@dataclass
+class EnsembleTrajectory:
+    t: np.ndarray  # (samples,)
+    pos: np.ndarray  # (samples, N, 3)
+    velocity: np.ndarray  # (samples, N, 3)
+    energy: np.ndarray  # (samples, N), total energy
+    integrator: str = 'euler'
+    dt: float = Constants.DT  # None for adaptive integrators
+    evaluations: int = 0  # acceleration evaluations, the cost of the run
+
+    @property
+    def size(self) -> int:
+        return self.pos.shape[1]
+
+    @property
+    def energy_error(self) -> np.ndarray:  # (N,), max relative deviation of the total energy from its start value
+        return np.max(np.abs(self.energy - self.energy[0]), axis=0) / np.abs(self.energy[0])
+
+    def pendulum(self, i):
+        return EnsembleTrajectory(self.t, self.pos[:, i:i + 1], self.velocity[:, i:i + 1], self.energy[:, i:i + 1],
+                                  self.integrator, self.dt, self.evaluations)
+
+
+@dataclass
+class IntegratorRun:
+    integrator: str
+    dt: float  # None for rk45
+    evaluations: int
+    energy_error: float
+    rtol: float = None  # rk45 only
+
+
+class PendulumEnsemble:
+    """
+    N independent spring pendulums hanging from the origin, stepped together with one of the integrators in
+    integrators.INTEGRATORS (or 'rk45', adaptive, through run).
+
+    Every state and parameter is a NumPy array (positions and velocities of shape (N, 3), parameters of shape (N,)),
+    so a whole parameter sweep advances in one batched step without any vpython objects. The equations and the order
+    of the floating point operations follow SpringPendulum.kinematics, so a one element ensemble tracks the live
+    simulation (random forces included when both use the same seed) to the last bit for thousands of steps. vpython's
+    vector arithmetic still rounds differently now and then, so over long runs the two drift apart by a few ulp.
+
+    The random force (random_force=True) and the Langevin heat bath (langevin_damping > 0, see noise.py) are drawn
+    for the whole ensemble at once, in blocks of many steps; langevin_damping and temperature can be swept like the
+    other parameters.
+    """
+
+    def __init__(self, weight_pos, starting_velocity=(0, 0, 0), effective_mass=0.25, spring_mass=0.05,
+                 spring_constant=30., equilibrium_length=0.2, g=Constants.g, random_force=False, seed=None,
+                 integrator='euler', noise_amplitude=1E-3, noise_spectrum=None, langevin_damping=0., temperature=0.):
+        self.pos = np.array(weight_pos, dtype=float).reshape(-1, 3)
+        size = len(self.pos)
+        self.velocity = np.broadcast_to(np.asarray(starting_velocity, dtype=float), (size, 3)).copy()
+        self.effective_mass = self.__per_pendulum(effective_mass)
+        self.spring_mass = self.__per_pendulum(spring_mass)
+        self.spring_constant = self.__per_pendulum(spring_constant)
+        self.equilibrium_length = self.__per_pendulum(equilibrium_length)
+        self.g = self.__per_pendulum(g)
+
+        self.gravity_enabled = True
+        self.random_action = random_force
+        noise_seed, thermostat_seed = np.random.SeedSequence(seed).spawn(2)
+        self.noise = NoiseGenerator(self.pos.shape, noise_amplitude, noise_spectrum, seed=noise_seed)
+        self.thermostat = LangevinThermostat(self.pos.shape, self.__per_pendulum(langevin_damping),
+                                             self.__per_pendulum(temperature), thermostat_seed) \
+            if np.any(langevin_damping) else None
+        self.integrator = integrator
+        self.evaluations = 0
+
+        self.acceleration = np.zeros_like(self.pos)
+        self.force = np.zeros_like(self.pos)
+        self.spring_power = np.zeros(size)
+        self.gravitational_power = np.zeros(size)
+
+    @classmethod
+    def sweep(cls, weight_pos, starting_velocity=(0, 0, 0), **parameters):
+        """
+        Builds an ensemble over the cartesian product of the given parameter lists, e.g.
+        PendulumEnsemble.sweep(start_pos, spring_constant=[28, 29, 30], effective_mass=[0.25, 0.26]).
+        Returns the ensemble and the (N, len(parameters)) grid of parameter values, one row per pendulum.
+        """
+        names = list(parameters)
+        grid = np.array(list(product(*(np.atleast_1d(parameters[name]) for name in names))), dtype=float)
+        weight_pos = np.broadcast_to(np.asarray(weight_pos, dtype=float), (len(grid), 3))
+        starting_velocity = np.broadcast_to(np.asarray(starting_velocity, dtype=float), (len(grid), 3))
+        return cls(weight_pos, starting_velocity, **{name: grid[:, i] for i, name in enumerate(names)}), grid
+
+    @property
+    def size(self) -> int:
+        return len(self.pos)
+
+    def __per_pendulum(self, value):
+        return np.broadcast_to(np.asarray(value, dtype=float), (len(self.pos),)).copy()
+
+    def random_force(self, dt=Constants.DT):
+        force = self.noise.next() if self.random_action else np.zeros_like(self.pos)
+        if self.thermostat is not None:
+            force = force + self.thermostat.kick(self.effective_mass, dt)
+        return force
+
+    def friction(self):  # (N, 1) rates, the Langevin friction force is minus this times the velocity
+        return self.thermostat.friction_rate(self.effective_mass)[:, None] if self.thermostat is not None else None
+
+    def gravity(self):
+        if not self.gravity_enabled:
+            return np.zeros_like(self.pos)
+        gravity = np.zeros_like(self.pos)
+        gravity[:, 1] = (self.effective_mass + self.spring_mass / 6) * -self.g
+        return gravity
+
+    def spring_force(self, pos=None):
+        pos = self.pos if pos is None else pos
+        length = vector_mag(pos)
+        return (-self.spring_constant * (length - self.equilibrium_length))[:, None] * pos / length[:, None]
+
+    def acceleration_function(self, random_force, gravity, friction=None):
+        def acceleration(pos, velocity):
+            self.evaluations += 1
+            force = random_force + gravity + self.spring_force(pos)
+            if friction is not None:
+                force = force - friction * velocity
+            return force / self.effective_mass[:, None]
+
+        return acceleration
+
+    def kinematics(self, dt=Constants.DT):
+        gravity = self.gravity()
+        random_force = self.random_force(dt)
+        friction = self.friction()
+        spring_force = self.spring_force()
+        self.force = random_force + gravity + spring_force
+        if friction is not None:
+            self.force -= friction * self.velocity
+        self.acceleration = self.force / self.effective_mass[:, None]
+        self.pos, self.velocity = INTEGRATORS[self.integrator](
+            self.pos, self.velocity, self.acceleration_function(random_force, gravity, friction), dt)
+
+        # update power
+        self.spring_power = row_dot(spring_force, self.velocity)
+        self.gravitational_power = row_dot(gravity, self.velocity)
+
+    def energy(self, pos=None, velocity=None) -> SpringPendulumEnergy:
+        """
+        Energies of every pendulum as (N,) arrays. Unlike the plotted energies of SpringPendulum, the gravitational and
+        kinetic terms use the masses of the equations of motion, so without noise the total is conserved up to the
+        integrator's error.
+        """
+        pos = self.pos if pos is None else pos
+        velocity = self.velocity if velocity is None else velocity
+        gravitational_mass = self.effective_mass + self.spring_mass / 6 if self.gravity_enabled else 0
+        spring = 0.5 * self.spring_constant * (vector_mag(pos) - self.equilibrium_length) ** 2
+        return SpringPendulumEnergy(spring=spring, gravity=gravitational_mass * self.g * pos[..., 1],
+                                    kinetic=0.5 * self.effective_mass * row_dot(velocity, velocity))
+
+    def run(self, end_time=Constants.end_time, dt=Constants.DT, sample_dt=Constants.real_dt, integrator=None,
+            **rk45_options) -> EnsembleTrajectory:
+        """
+        Steps the ensemble until end_time and returns the states sampled every sample_dt.
+
+        Fixed step integrators use the same time loop (and the same float time bookkeeping) as the live simulation.
+        With integrator='rk45' dt is only the first step size, the step adapts to rk45_options (rtol, atol,
+        max_step) and the samples come from dense output at the sample times.
+        """
+        if integrator is not None:
+            self.integrator = integrator
+        start_evaluations = self.evaluations
+        if self.integrator == 'rk45':
+            times, positions, velocities = self.__run_adaptive(end_time, dt, sample_dt, **rk45_options)
+        else:
+            times, positions, velocities = self.__run_fixed_step(end_time, dt, sample_dt)
+
+        positions, velocities = np.stack(positions), np.stack(velocities)
+        return EnsembleTrajectory(np.array(times), positions, velocities,
+                                  self.energy(positions, velocities).total, self.integrator,
+                                  None if self.integrator == 'rk45' else dt, self.evaluations - start_evaluations)
+
+    def __run_fixed_step(self, end_time, dt, sample_dt):
+        times, positions, velocities = [], [], []
+        t = 0
+        while t <= end_time + dt:
+            if t + dt / 2 >= len(times) * sample_dt:  # the step nearest to each sample time
+                times.append(t)
+                positions.append(self.pos.copy())
+                velocities.append(self.velocity.copy())
+
+            t += dt
+            self.kinematics(dt)
+        return times, positions, velocities
+
+    def __run_adaptive(self, end_time, first_step, sample_dt, **rk45_options):
+        if self.random_action or self.thermostat is not None and np.any(self.thermostat.temperature):
+            raise ValueError('rk45 cannot integrate random forces, use a fixed step integrator')
+
+        acceleration = self.acceleration_function(random_force=0, gravity=self.gravity(), friction=self.friction())
+        sample_times = sample_dt * np.arange(int(round(end_time / sample_dt)) + 1)
+        times, positions, velocities = [], [], []
+        for t, pos, velocity in rk45(self.pos, self.velocity, acceleration, sample_times, first_step,
+                                     **rk45_options):
+            times.append(t)
+            positions.append(pos)
+            velocities.append(velocity)
+        self.pos, self.velocity = positions[-1].copy(), velocities[-1].copy()
+        return times, positions, velocities
+
+
+def cheapest_integrator(make_ensemble, tolerance, end_time=Constants.end_time, sample_dt=Constants.real_dt,
+                        candidates=None):
+    """
+    Runs every (integrator, dt) candidate on a fresh ensemble from make_ensemble() and returns the one with the fewest
+    acceleration evaluations whose worst energy error is within tolerance (or None), together with the full report.
+    The default candidates are each fixed step integrator at sample_dt / 100 ... sample_dt and rk45 at a few
+    tolerances; the second value of an rk45 candidate is its rtol.
+    """
+    if candidates is None:
+        candidates = [(integrator, sample_dt / substeps) for integrator in ('euler', 'verlet', 'rk4')
+                      for substeps in (1, 2, 5, 10, 20, 50, 100)]
+        candidates += [('rk45', rtol) for rtol in (1E-4, 1E-6, 1E-8)]
+
+    report = []
+    for integrator, dt in candidates:
+        rtol = dt if integrator == 'rk45' else None
+        if integrator == 'rk45':
+            trajectory = make_ensemble().run(end_time, sample_dt / 10, sample_dt, integrator, rtol=rtol)
+        else:
+            trajectory = make_ensemble().run(end_time, dt, sample_dt, integrator)
+        report.append(IntegratorRun(integrator, trajectory.dt, trajectory.evaluations,
+                                    float(np.max(trajectory.energy_error)), rtol))
+
+    passing = [run for run in report if run.energy_error <= tolerance]
+    return min(passing, key=lambda run: run.evaluations, default=None), report
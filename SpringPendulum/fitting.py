@@ -0,0 +1,194 @@
+"""
+Least squares fitting of Constants and start conditions to a measured pendulum track.
+
+The track is an x/y/z/t table of the button's position, as main.py exports it (CSV, raw trajectory or the old xlwt
+.xls sheets). Every residual or Jacobian evaluation simulates the candidates as one PendulumEnsemble with adaptive
+RK45 sampled exactly at the track's times, and the Jacobian's finite difference candidates are split between the
+workers of a process pool.
+
+    python fitting.py "Data sheet.csv" --parameters k spring_weightless_length --workers 8
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace, fields
+
+import numpy as np
+from scipy.optimize import least_squares
+
+from constants import Constants
+from ensemble import PendulumEnsemble, change_vector_length, vector_mag
+from integrators import rk45
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the shared simtools package
+from simtools.trajectory import load_trajectory
+
+# the starting velocity hand-tuned in main.py, in the button's frame
+STARTING_VELOCITY = (-0.02333, 0.33167, -0.105)
+INITIAL_CONDITIONS = ('start x', 'start y', 'start z', 'start vx', 'start vy', 'start vz')
+XLS_MAGIC = b'\xd0\xcf\x11\xe0'
+# time stepping, not physics: a batch of candidates is simulated with one set of these
+TIME_CONSTANTS = ('DT', 'real_dt', 'end_time')
+
+
+# FUNCTIONS #
+def load_track(path):
+    """Returns the measured (t, positions) of a track, positions of shape (samples, 3)."""
+    with open(path, 'rb') as track_file:
+        is_xls = track_file.read(4) == XLS_MAGIC  # ExcelSheet saved .xls workbooks under a .csv name
+    if is_xls:
+        try:
+            import xlrd
+        except ImportError:
+            raise ImportError(f'{path} is an old xlwt sheet, reading it needs xlrd (pip install xlrd)')
+        sheet = xlrd.open_workbook(path).sheet_by_index(0)
+        columns = [cell.value for cell in sheet.row(0)[:4]]
+        rows = np.array([[cell.value for cell in sheet.row(i)[:4]] for i in range(1, sheet.nrows)
+                         if sheet.cell_type(i, 0) == xlrd.XL_CELL_NUMBER])
+    else:
+        rows, columns, _ = load_trajectory(path)
+    rows = np.asarray(rows, dtype=float)
+    return rows[:, columns.index('t')], rows[:, [columns.index(axis) for axis in 'xyz']]
+
+
+def button_offset(constants):
+    return constants.rod_weights_center_of_mass - constants.button_from_hook_length
+
+
+def initial_state(constants, start_pos, starting_velocity):
+    """Converts the button's start position and velocity to the simulated weight's, as main.py does."""
+    start_pos = np.asarray(start_pos, dtype=float)
+    starting_velocity = np.asarray(starting_velocity, dtype=float)
+    start_length = vector_mag(start_pos)
+    starting_velocity = change_vector_length(starting_velocity, vector_mag(starting_velocity) *
+                                             constants.center_of_mass(constants.spring_length(start_length))
+                                             / start_length)
+    return change_vector_length(start_pos, start_length + button_offset(constants)), starting_velocity
+
+
+def button_positions(constants, weight_positions):
+    return change_vector_length(weight_positions, vector_mag(weight_positions) - button_offset(constants))
+
+
+def simulate_tracks(candidates, times, rtol=1E-8):
+    """
+    Simulates (constants overrides, start_pos, starting_velocity) candidates together and returns the button
+    positions at the given times, of shape (len(candidates), len(times), 3). The overrides are plain dicts so
+    candidates pickle cheaply to pool workers.
+    """
+    constants = [replace(Constants, **overrides) for overrides, _, _ in candidates]
+    states = [initial_state(c, start_pos, velocity) for c, (_, start_pos, velocity) in zip(constants, candidates)]
+    ensemble = PendulumEnsemble([state[0] for state in states], [state[1] for state in states],
+                                effective_mass=[c.effective_mass for c in constants],
+                                spring_mass=[c.spring_mass for c in constants],
+                                spring_constant=[c.k for c in constants],
+                                equilibrium_length=[c.spring_equilibrium_length for c in constants],
+                                g=[c.g for c in constants])
+    acceleration = ensemble.acceleration_function(random_force=0, gravity=ensemble.gravity())
+    tracks = np.stack([pos for _, pos, _ in rk45(ensemble.pos, ensemble.velocity, acceleration, times,
+                                                 first_step=constants[0].DT, rtol=rtol, atol=rtol * 1E-2)], axis=1)
+    return np.stack([button_positions(c, track) for c, track in zip(constants, tracks)])
+
+
+# CLASSES #
+@dataclass
+class FitResult:
+    constants: object  # Constants with the fitted values
+    start_pos: np.ndarray
+    starting_velocity: np.ndarray
+    rms_error: float  # [m]
+    solution: object  # scipy's OptimizeResult
+
+
+class TrackFitter:
+    """
+    Fits the named Constants fields (and, with fit_initial_conditions, the start position and velocity) so the
+    simulated button follows the measured track. Candidate simulations run on a pool of workers processes; with
+    workers=1 everything runs in this process.
+    """
+
+    def __init__(self, times, positions, parameters=('k', 'spring_weightless_length'), start_pos=None,
+                 starting_velocity=STARTING_VELOCITY, fit_initial_conditions=True, workers=None, rtol=1E-8):
+        known = {field.name for field in fields(Constants)} - set(TIME_CONSTANTS)
+        unknown = set(parameters) - known
+        if unknown:
+            raise ValueError(f'Unknown or unfittable constants {sorted(unknown)}, choose from {sorted(known)}')
+
+        self.times = np.asarray(times, dtype=float) - times[0]
+        self.positions = np.asarray(positions, dtype=float)
+        self.parameters = list(parameters)
+        self.start_pos = self.positions[0] if start_pos is None else np.asarray(start_pos, dtype=float)
+        self.starting_velocity = np.asarray(starting_velocity, dtype=float)
+        self.fit_initial_conditions = fit_initial_conditions
+        self.workers = workers or os.cpu_count()
+        self.rtol = rtol
+
+    @property
+    def names(self):
+        return self.parameters + (list(INITIAL_CONDITIONS) if self.fit_initial_conditions else [])
+
+    def initial_guess(self):
+        guess = [getattr(Constants, name) for name in self.parameters]
+        if self.fit_initial_conditions:
+            guess += list(self.start_pos) + list(self.starting_velocity)
+        return np.array(guess, dtype=float)
+
+    def candidate(self, x):
+        overrides = dict(zip(self.parameters, map(float, x)))
+        if self.fit_initial_conditions:
+            return overrides, x[len(self.parameters):][:3], x[len(self.parameters):][3:]
+        return overrides, self.start_pos, self.starting_velocity
+
+    def residuals(self, tracks):
+        return (tracks - self.positions).reshape(len(tracks), -1)
+
+    def evaluate(self, points, pool=None):
+        """Residual vectors for every row of points, split into one ensemble per worker."""
+        candidates = [self.candidate(x) for x in points]
+        if pool is None or len(candidates) == 1:
+            return self.residuals(simulate_tracks(candidates, self.times, self.rtol))
+        chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(candidates)), self.workers) if len(chunk)]
+        tracks = pool.map(simulate_tracks, [[candidates[i] for i in chunk] for chunk in chunks],
+                          [self.times] * len(chunks), [self.rtol] * len(chunks))
+        return self.residuals(np.concatenate(list(tracks)))
+
+    def fit(self, **least_squares_options) -> FitResult:
+        x0 = self.initial_guess()
+        steps = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(x0), 1E-3)
+
+        def fit_with(pool):
+            def jacobian(x):
+                points = np.vstack([x, x + np.diag(steps)])
+                residuals = self.evaluate(points, pool)
+                return ((residuals[1:] - residuals[0]) / steps[:, None]).T
+
+            return least_squares(lambda x: self.evaluate(x[None], pool)[0], x0, jac=jacobian, x_scale='jac',
+                                 **least_squares_options)
+
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                solution = fit_with(pool)
+        else:
+            solution = fit_with(None)
+
+        overrides, start_pos, starting_velocity = self.candidate(solution.x)
+        return FitResult(replace(Constants, **overrides), np.asarray(start_pos), np.asarray(starting_velocity),
+                         float(np.sqrt(np.mean(solution.fun ** 2))), solution)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit Constants and start conditions to a measured x/y/z/t track.')
+    parser.add_argument('track', help='a .csv, raw trajectory or old .xls data sheet')
+    parser.add_argument('--parameters', nargs='+', default=['k', 'spring_weightless_length'])
+    parser.add_argument('--no-initial-conditions', action='store_true', help='keep the start conditions fixed')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    track_times, track_positions = load_track(args.track)
+    fitter = TrackFitter(track_times, track_positions, args.parameters,
+                         fit_initial_conditions=not args.no_initial_conditions, workers=args.workers)
+    result = fitter.fit(verbose=1)
+    for name, value in zip(fitter.names, result.solution.x):
+        print(f'{name}: {value:.6g}')
+    print(f'RMS error: {result.rms_error * 1E3:.3f}[mm]')
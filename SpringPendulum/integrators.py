@@ -0,0 +1,96 @@
+"""
+Integrators for second order systems x'' = a(x, v).
+
+The fixed step integrators only use +, - and scalar * on the state, so they work both on vpython vectors (the live
+SpringPendulum) and on NumPy arrays (PendulumEnsemble). Each takes (pos, velocity, acceleration, dt), where
+acceleration(pos, velocity) returns the acceleration, and returns the new (pos, velocity).
+"""
+import numpy as np
+
+
+# FIXED STEP #
+def euler(pos, velocity, acceleration, dt):  # semi-implicit Euler, the original SpringPendulum.kinematics scheme
+    velocity = velocity + acceleration(pos, velocity) * dt
+    return pos + velocity * dt, velocity
+
+
+def velocity_verlet(pos, velocity, acceleration, dt):  # kick-drift-kick leapfrog, symplectic and second order
+    half_velocity = velocity + acceleration(pos, velocity) * (dt / 2)
+    pos = pos + half_velocity * dt
+    return pos, half_velocity + acceleration(pos, half_velocity) * (dt / 2)
+
+
+def rk4(pos, velocity, acceleration, dt):
+    k1_x, k1_v = velocity, acceleration(pos, velocity)
+    k2_x, k2_v = velocity + k1_v * (dt / 2), acceleration(pos + k1_x * (dt / 2), velocity + k1_v * (dt / 2))
+    k3_x, k3_v = velocity + k2_v * (dt / 2), acceleration(pos + k2_x * (dt / 2), velocity + k2_v * (dt / 2))
+    k4_x, k4_v = velocity + k3_v * dt, acceleration(pos + k3_x * dt, velocity + k3_v * dt)
+    return pos + (k1_x + 2 * k2_x + 2 * k3_x + k4_x) * (dt / 6), \
+        velocity + (k1_v + 2 * k2_v + 2 * k3_v + k4_v) * (dt / 6)
+
+
+INTEGRATORS = {'euler': euler, 'verlet': velocity_verlet, 'leapfrog': velocity_verlet, 'rk4': rk4}
+
+
+# ADAPTIVE #
+# Dormand-Prince 5(4) tableau
+DP_A = ((),
+        (1 / 5,),
+        (3 / 40, 9 / 40),
+        (44 / 45, -56 / 15, 32 / 9),
+        (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+        (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+        (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+DP_ERROR = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)
+
+
+def hermite(y0, dy0, y1, dy1, h, theta):  # cubic Hermite interpolation at y(t0 + theta * h)
+    return ((2 * theta ** 3 - 3 * theta ** 2 + 1) * y0 + (theta ** 3 - 2 * theta ** 2 + theta) * h * dy0
+            + (3 * theta ** 2 - 2 * theta ** 3) * y1 + (theta ** 3 - theta ** 2) * h * dy1)
+
+
+def rk45(pos, velocity, acceleration, sample_times, first_step=1E-3, rtol=1E-8, atol=1E-10, max_step=np.inf):
+    """
+    Adaptive Dormand-Prince integration of NumPy states with dense output.
+
+    One step size is shared by the whole state (so an ensemble steps together) and is chosen from the RMS of the
+    scaled local error. Samples are interpolated with cubic Hermite polynomials built from the positions, velocities
+    and accelerations at both ends of each accepted step (the last stage is the next step's first, so this is free).
+    Yields (t, pos, velocity) for every t in sample_times, which must be increasing.
+    """
+    sample_times = np.asarray(sample_times, dtype=float)
+    t = sample_times[0]
+    y = (np.array(pos, dtype=float), np.array(velocity, dtype=float))
+    dy = (y[1], acceleration(*y))
+    h = first_step
+    sample = 0
+
+    while sample < len(sample_times) and sample_times[sample] <= t:
+        yield sample_times[sample], y[0].copy(), y[1].copy()
+        sample += 1
+
+    while sample < len(sample_times):
+        h = min(h, max_step)
+        stages = [dy]
+        for row in DP_A[1:]:
+            stage_x = y[0] + h * sum(a * k[0] for a, k in zip(row, stages))
+            stage_v = y[1] + h * sum(a * k[1] for a, k in zip(row, stages))
+            stages.append((stage_v, acceleration(stage_x, stage_v)))
+        y_new = (stage_x, stage_v)  # the last stage is evaluated at the 5th order solution
+
+        error = [h * sum(e * k[i] for e, k in zip(DP_ERROR, stages)) for i in range(2)]
+        scale = [atol + rtol * np.maximum(np.abs(y[i]), np.abs(y_new[i])) for i in range(2)]
+        error_norm = np.sqrt(np.mean(np.concatenate([(error[i] / scale[i]).ravel() for i in range(2)]) ** 2))
+
+        if error_norm <= 1:
+            dy_new = stages[-1]
+            while sample < len(sample_times) and sample_times[sample] <= t + h:
+                theta = (sample_times[sample] - t) / h
+                yield (sample_times[sample],
+                       hermite(y[0], dy[0], y_new[0], dy_new[0], h, theta),
+                       hermite(y[1], dy[1], y_new[1], dy_new[1], h, theta))
+                sample += 1
+            t += h
+            y, dy = y_new, dy_new
+
+        h *= min(5., max(0.2, 0.9 * error_norm ** -0.2)) if error_norm > 0 else 5.
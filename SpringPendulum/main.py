@@ -1,7 +1,35 @@
-from dataclasses import dataclass
-from random import uniform
-from vpython import *
-import xlwt
+import argparse
+import os
+import sys
+from dataclasses import asdict
+
+import numpy as np
+
+from constants import Constants
+from energy import SpringPendulumEnergy, SpringPendulumPower
+from ensemble import PendulumEnsemble
+from integrators import INTEGRATORS, rk45
+from noise import SPECTRA, LangevinThermostat, NoiseGenerator
+from plotting import GraphPlotter
+from spectral import SIGNALS, PendulumSpectra, format_result
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the shared simtools package
+from simtools.cache import RunCache, code_version, imported_sources
+from simtools.checkpoint import Checkpointer, load_checkpoint
+from simtools.profiling import Profiler
+from simtools.render import BACKENDS, load_backend, selected_backend
+from simtools.replay import TrajectoryPlayer
+from simtools.trajectory import load_trajectory, open_trajectory_writer
+
+render = load_backend(selected_backend('vpython'))  # picked before anything is drawn, see simtools.render
+vector, mag, color, rate = render.vector, render.mag, render.color, render.rate
+helix, cylinder, graph, gcurve = render.helix, render.cylinder, render.graph, render.gcurve
+
+GRAVITY = vector(0, -Constants.g, 0)
+RECORD_COLUMNS = ['t', 'x', 'y', 'z', 'vx', 'vy', 'vz', 'spring power', 'gravitational power']
+ADAPTIVE_CHUNK = 4096  # dense output samples per rk45 call, the last state starts the next call
+# the code a cached run's results depend on: every module imported from the repository, see simtools.cache
+SOURCES = imported_sources(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
 # FUNCTIONS #
@@ -10,116 +38,16 @@ def change_vector_length(old_vector, new_length):
 
 
 # CLASSES #
-@dataclass
-class Constants:
-    real_dt = 0.03
-    DT = 1E-2 * real_dt
-    g = vector(0, -9.79234, 0)
-    end_time = 1000 * real_dt
-    button_from_hook_length = 0.17
-    rod_length = 0.14
-    rod_mass = 0.1135
-    weight_mass = 0.2622 - rod_mass
-    spring_mass = 0.0414
-
-    k = 29.0237
-    rod_center_of_mass_from_hook = 0.125
-    big_weight_height = 0.0115
-    small_weight_height = 0.0085
-    spring_weightless_length = 0.18
-
-    @property
-    def effective_mass(self) -> float:
-        return self.weight_mass + self.rod_mass + self.spring_mass / 3
-
-    @property
-    def spring_equilibrium_length(self) -> float:
-        return self.spring_weightless_length + (self.effective_mass + self.spring_mass / 6) * self.g.mag / self.k
-
-    @classmethod
-    def spring_length(cls, total_length):
-        return total_length - cls.rod_length
-
-    def center_of_mass(self, spring_length: float):
-        return ((self.weight_mass + self.rod_mass) * (self.rod_weights_center_of_mass + spring_length) +
-                self.spring_mass * spring_length / 2) / (self.rod_mass + self.weight_mass + self.spring_mass)
-
-    @property
-    def center_of_mass_at_equilibrium(self):
-        return ((self.weight_mass + self.rod_mass) * (self.rod_weights_center_of_mass + self.spring_equilibrium_length)
-                + self.spring_mass * self.spring_equilibrium_length / 2) / \
-               (self.rod_mass + self.weight_mass + self.spring_mass)
-
-    @property
-    def rod_weights_center_of_mass(self):
-        return (self.rod_mass * self.rod_center_of_mass_from_hook +
-                self.weight_mass * self.weight_center_of_mass_from_hook) / (self.weight_mass + self.rod_mass)
-
-    @property
-    def weight_center_of_mass_from_hook(self):
-        return self.rod_length - (2. / 3 * self.weight_mass * self.big_weight_height / 2 +
-                                  1. / 3 * self.weight_mass * (self.big_weight_height + self.small_weight_height / 2)) \
-               / self.weight_mass
-
-
-Constants = Constants()
-
-
-class ExcelSheet:
-    class DataObject:
-        def __init__(self, x, y, data):
-            self.x = x
-            self.y = y
-            self.data = data
-
-    def __init__(self, sheet_name='Data'):
-        self.book = xlwt.Workbook(encoding="utf-8")
-        self.sheets = []
-        self.sheets.append(self.book.add_sheet(sheet_name))
-
-    def write_to_sheet(self, data, sheet=0):
-        for data_obj in data:
-            self.sheets[sheet].write(data_obj.y, data_obj.x, data_obj.data)
-
-    @staticmethod
-    def create_data_objects(lists):
-        _ret_list = []
-        for _list in lists:
-            _ret_list.append(ExcelSheet.DataObject(_list[0], _list[1], _list[2]))
-        return _ret_list
-
-    def save_file(self, file_name='Data sheet'):
-        file_name += '.csv'
-        self.book.save(file_name)
-        print(f'Saved file to {file_name}')
-
-
-@dataclass
-class SpringPendulumEnergy:
-    spring: float = 0
-    gravity: float = 0
-    kinetic: float = 0
-
-    @property
-    def total(self):
-        return self.potential + self.kinetic
-
-    @property
-    def potential(self):
-        return self.spring + self.gravity
-
-
-@dataclass
-class SpringPendulumPower:
-    spring: float = 0
-    gravity: float = 0
-
-
 class SpringPendulum:
     def __init__(self, equilibrium_length=0.2, start_pos=vector(0, 0, 0), end_pos=vector(0, -0.3, 0),
                  effective_mass=0.25, spring_mass=0.05,
                  spring_constant=30., trail_retain=10000, radius=0.1, starting_velocity=vector(0, 0, 0),
-                 random_force=True):
+                 random_force=True, integrator='euler', seed=None, noise_amplitude=1E-3, noise_spectrum=None,
+                 langevin_damping=0., temperature=0., dt=Constants.DT, rtol=1E-8):
+        if integrator not in INTEGRATORS and integrator != 'rk45':
+            raise ValueError(f'Unknown integrator {integrator!r}, use rk45 or one of {", ".join(INTEGRATORS)}')
+        if integrator == 'rk45' and (random_force or langevin_damping and temperature):
+            raise ValueError('rk45 cannot integrate random forces, use a fixed step integrator')
         self.spring = helix(pos=start_pos, axis=end_pos - start_pos, radius=radius, color=color.green)
         self.spring_constant = spring_constant
         self.effective_mass = effective_mass
@@ -132,6 +60,14 @@ class SpringPendulum:
 
         self.gravity_enabled = True
         self.random_action = random_force
+        noise_seed, thermostat_seed = np.random.SeedSequence(seed).spawn(2)  # as in PendulumEnsemble
+        self.noise = NoiseGenerator((3,), noise_amplitude, noise_spectrum, dt, seed=noise_seed)
+        self.thermostat = LangevinThermostat((3,), langevin_damping, temperature, thermostat_seed) \
+            if langevin_damping else None
+        self.integrator = INTEGRATORS.get(integrator)  # None for rk45, see adaptive_kinematics
+        self.dt = dt
+        self.rtol = rtol
+        self.adaptive_samples = None
 
         self.acceleration = vector(0, 0, 0)
         self.velocity = starting_velocity
@@ -145,35 +81,109 @@ class SpringPendulum:
         self.spring_energy_offset = None
         self.gravitational_energy_offset = None
 
-    def random_force(self):
-        if self.random_action:
-            return vector(uniform(-1, 1), uniform(-1, 1), uniform(-1, 1)) * 1E-3
-        return vector(0, 0, 0)
-
-    def kinematics(self, dt=Constants.DT):  # Euler integration
-        gravity = (self.effective_mass + self.spring_mass / 6) * Constants.g if self.gravity_enabled else vector(0, 0,
-                                                                                                                 0)
-
-        spring_force = -self.spring_constant * \
-                       (mag(self.weight_pos) - self.equilibrium_length) * self.weight_pos / mag(self.weight_pos)
-        self.force = self.random_force() + gravity + spring_force
+    def random_force(self, dt):
+        force = vector(*self.noise.next().tolist()) if self.random_action else vector(0, 0, 0)
+        if self.thermostat is not None:
+            force = force + vector(*self.thermostat.kick(self.effective_mass, dt).tolist())
+        return force
+
+    def acceleration_function(self, random_force, gravity):
+        if self.thermostat is None:
+            return lambda pos, velocity: (random_force + gravity + self.spring_force(pos)) / self.effective_mass
+        friction = float(self.thermostat.friction_rate(self.effective_mass))
+        return lambda pos, velocity: (random_force + gravity + self.spring_force(pos) - friction * velocity) \
+            / self.effective_mass
+
+    def spring_force(self, pos):
+        return -self.spring_constant * (mag(pos) - self.equilibrium_length) * pos / mag(pos)
+
+    def kinematics(self, dt=None):
+        dt = self.dt if dt is None else dt
+        if self.integrator is None:
+            self.adaptive_kinematics(dt)
+            return
+        gravity = (self.effective_mass + self.spring_mass / 6) * GRAVITY if self.gravity_enabled else vector(0, 0, 0)
+        random_force = self.random_force(dt)  # held fixed over the step's sub-stages
+
+        spring_force = self.spring_force(self.weight_pos)
+        self.force = random_force + gravity + spring_force
+        if self.thermostat is not None:
+            self.force = self.force - float(self.thermostat.friction_rate(self.effective_mass)) * self.velocity
         self.acceleration = self.force / self.effective_mass
-        self.velocity += self.acceleration * dt
-        self.pos += self.velocity * dt
+        self.pos, self.velocity = self.integrator(self.weight_pos, self.velocity,
+                                                  self.acceleration_function(random_force, gravity), dt)
 
         # update power
         self.power.spring = spring_force.dot(self.velocity)
         self.power.gravity = gravity.dot(self.velocity)
 
+    def adaptive_kinematics(self, dt):
+        """
+        Moves on to the next of rk45's dense output samples, dt apart. The step size adapts to rtol underneath, the
+        equations are PendulumEnsemble's (a one element ensemble with this pendulum's parameters and state).
+        """
+        if self.adaptive_samples is None:
+            ensemble = PendulumEnsemble((self.pos.x, self.pos.y, self.pos.z),
+                                        (self.velocity.x, self.velocity.y, self.velocity.z), self.effective_mass,
+                                        self.spring_mass, self.spring_constant, self.equilibrium_length,
+                                        langevin_damping=self.thermostat.damping if self.thermostat is not None else 0.)
+            ensemble.gravity_enabled = self.gravity_enabled
+            acceleration = ensemble.acceleration_function(0, ensemble.gravity(), ensemble.friction())
+            self.adaptive_samples = rk45(ensemble.pos, ensemble.velocity, acceleration,
+                                         dt * np.arange(ADAPTIVE_CHUNK + 1), dt, self.rtol)
+            next(self.adaptive_samples)  # the starting state itself
+        try:
+            _, pos, velocity = next(self.adaptive_samples)
+        except StopIteration:  # the chunk is used up, carry on from its last sample
+            self.adaptive_samples = None
+            self.adaptive_kinematics(dt)
+            return
+        self.pos, self.velocity = vector(*pos[0].tolist()), vector(*velocity[0].tolist())
+        gravity = (self.effective_mass + self.spring_mass / 6) * GRAVITY if self.gravity_enabled else vector(0, 0, 0)
+        spring_force = self.spring_force(self.pos)
+        self.force = gravity + spring_force
+        self.acceleration = self.force / self.effective_mass
+        self.power.spring = spring_force.dot(self.velocity)
+        self.power.gravity = gravity.dot(self.velocity)
+
+    def get_state(self):
+        return {'pos': (self.pos.x, self.pos.y, self.pos.z),
+                'velocity': (self.velocity.x, self.velocity.y, self.velocity.z),
+                'spring_energy_offset': self.spring_energy_offset,
+                'gravitational_energy_offset': self.gravitational_energy_offset,
+                'noise': self.noise.get_state(),
+                'thermostat': self.thermostat.get_state() if self.thermostat is not None else None}
+
+    def set_state(self, state):
+        self.pos = vector(*state['pos'])
+        self.velocity = vector(*state['velocity'])
+        self.adaptive_samples = None  # rk45 starts over from the restored state
+        self.spring_energy_offset = state['spring_energy_offset']
+        self.gravitational_energy_offset = state['gravitational_energy_offset']
+        if state.get('noise') is not None:  # checkpoints from before the seeded noise have none
+            self.noise.set_state(state['noise'])
+        if self.thermostat is not None and state.get('thermostat') is not None:
+            self.thermostat.set_state(state['thermostat'])
+        self.update_pos()
+
+    def record_row(self, t):
+        return [t, self.pos.x, self.pos.y, self.pos.z, self.velocity.x, self.velocity.y, self.velocity.z,
+                self.power.spring, self.power.gravity]
+
+    def record(self, writer, t):
+        writer.write(*self.record_row(t))
+
+    def show_recorded(self, row):
+        _, x, y, z, vx, vy, vz, self.power.spring, self.power.gravity = row.tolist()
+        self.pos = vector(x, y, z)
+        self.velocity = vector(vx, vy, vz)
+        self.update_pos()
+
     def update_pos(self):
         self.weight_pos = self.pos
         self.spring.axis = self.weight_pos - self.spring.pos
         self.weight.pos = self.weight_pos
 
-    def update_all_graphs(self, t):
-        for graph_name in self.graphs:
-            self.update_graph(t, graph_name)
-
     def add_energy_graphs(self, total=False, potential=False, kinetic=False):
         if total:
             graph(title='Total Energy Over Time', xtitle='Time[s]', ytitle='Energy[J]')
@@ -210,8 +220,17 @@ class SpringPendulum:
             graph(title='Angular Momentum Over Time', xtitle='Time[s]', ytitle='Angular Momentum[kg∙m^2/s]')
             self.graphs['angular momentum'] = gcurve(color=color.purple)
 
-    def __calculate_energy(self):
-        self.energy.gravity = self.effective_mass * Constants.g.mag * self.pos.y
+    def angular_momentum(self):
+        return self.effective_mass * self.pos.cross(self.velocity)
+
+    def conserved_energy(self):
+        """The total energy with the masses of the equations of motion, as PendulumEnsemble.energy computes it."""
+        gravitational_mass = self.effective_mass + self.spring_mass / 6 if self.gravity_enabled else 0
+        return (0.5 * self.spring_constant * (self.weight_pos.mag - self.equilibrium_length) ** 2
+                + gravitational_mass * Constants.g * self.pos.y + 0.5 * self.effective_mass * self.velocity.mag2)
+
+    def calculate_energy(self):
+        self.energy.gravity = self.effective_mass * Constants.g * self.pos.y
         self.energy.spring = 0.5 * self.spring_constant * (self.weight_pos.mag - self.equilibrium_length) ** 2
         self.energy.kinetic = 0.5 * (self.effective_mass + self.spring_mass / 6) * self.velocity.mag2
 
@@ -220,33 +239,55 @@ class SpringPendulum:
         if self.gravitational_energy_offset is None:
             self.gravitational_energy_offset = self.energy.gravity
 
-    def update_graph(self, t, graph_name='total energy'):
-        if 'energy' in graph_name:
-            self.__calculate_energy()
-            self.graphs[graph_name] \
-                .plot(pos=(t,
-                           {'total energy': self.energy.total,
-                            'potential energy': self.energy.potential,
-                            'kinetic energy': self.energy.kinetic,
-                            'potential spring energy': self.energy.spring - self.spring_energy_offset,
-                            'potential gravitational energy': self.energy.gravity - self.gravitational_energy_offset}[
-                               graph_name]))
-        elif 'power' in graph_name:
-            self.graphs[graph_name] \
-                .plot(pos=(t,
-                           {'spring power': self.power.spring,
-                            'gravitational power': self.power.gravity}[graph_name]))
-        elif graph_name == 'xy':
-            self.graphs['xy'].plot(pos=(self.pos.x, self.pos.y))
-        elif graph_name == 'xz':
-            self.graphs['xz'].plot(pos=(self.pos.x, self.pos.z))
-        elif graph_name == 'angular momentum':
-            self.graphs['angular momentum'].plot(pos=(t, mag(self.effective_mass * self.pos.cross(self.velocity))))
 
+# RUN OPTIONS #
+parser = argparse.ArgumentParser(description='Spring pendulum simulation.')
+parser.add_argument('--export', nargs='*', default=['Data sheet.csv', 'Data sheet.f64'],
+                    help='trajectory files to write, .csv or raw')
+parser.add_argument('--checkpoint', help='periodically save the full state to this file')
+parser.add_argument('--checkpoint-every', type=int, default=10000, help='physics steps between checkpoints')
+parser.add_argument('--resume', help='continue from a checkpoint file')
+parser.add_argument('--profile', action='store_true', help='time each phase of the main loop, report at exit')
+parser.add_argument('--profile-timeline', help='also dump every timed phase to this JSON trace file')
+parser.add_argument('--render', default='vpython', help=f'render backend, one of {", ".join(BACKENDS)} '
+                                                        f'(recorder:path sets the recording file)')
+parser.add_argument('--record', help='record the state after every physics step to this raw trajectory file')
+parser.add_argument('--replay', help='play a --record file back instead of simulating')
+parser.add_argument('--replay-speed', type=float, default=1.,
+                    help='simulation seconds per wall second, 0 shows every step')
+parser.add_argument('--replay-decimate', type=int, default=1, help='show only every n-th recorded step')
+parser.add_argument('--replay-start', type=float, help='simulation time to start playing from')
+parser.add_argument('--integrator', choices=list(INTEGRATORS) + ['rk45'], default='euler',
+                    help='the physics step\'s scheme; rk45 adapts its step and samples the run every --dt by dense '
+                         'output, without random forces')
+parser.add_argument('--dt', type=float,
+                    help=f'physics step in s (default {Constants.DT:g}, real_dt for rk45), at most real_dt; verlet and '
+                         f'rk4 keep the energy with 10-100 times larger steps than euler')
+parser.add_argument('--rtol', type=float, default=1E-8, help='rk45\'s relative error tolerance per step')
+parser.add_argument('--seed', type=int, help='seeds the random force and the heat bath, for reproducible runs')
+parser.add_argument('--noise', type=float, default=0., help='random force amplitude in N, 0 turns it off')
+parser.add_argument('--noise-spectrum', choices=list(SPECTRA), default='white',
+                    help='shape of the random force\'s amplitude spectrum')
+parser.add_argument('--langevin-damping', type=float, default=0.,
+                    help='couples the pendulum to a heat bath with this friction rate in 1/s, 0 turns it off')
+parser.add_argument('--temperature', type=float, default=0., help='the heat bath\'s k_B T in J')
+parser.add_argument('--spectra', action='store_true',
+                    help='analyse the run\'s spectra and mode energy exchange on the fly, report them at exit')
+parser.add_argument('--spectra-output', help='also save the spectra to this .npz file')
+parser.add_argument('--spectra-segment', type=int, default=256, help='samples per Welch segment, one every real_dt')
+parser.add_argument('--cache', help='directory of cached runs: an unchanged run is loaded from it instead of simulated')
+parser.add_argument('--cache-size', type=float, default=1024, help='MB the cache may take before old runs are evicted')
+args = parser.parse_args()
+if args.dt is None:
+    args.dt = Constants.real_dt if args.integrator == 'rk45' else Constants.DT
+if not 0 < args.dt <= Constants.real_dt:
+    parser.error(f'--dt must be positive and at most real_dt ({Constants.real_dt:g} s), the export interval')
+if args.integrator == 'rk45' and (args.noise > 0 or args.langevin_damping > 0 and args.temperature > 0):
+    parser.error('rk45 cannot integrate random forces, use a fixed step integrator with --noise and --temperature')
+profiler = Profiler(enabled=args.profile or args.profile_timeline is not None, timeline_path=args.profile_timeline)
 
 # STARTING TERMS #
 t = 0
-col_y = 0
 start_pos = vector(0, -0.425, -0.003)
 starting_velocity = vector(-0.02333, 0.33167, -0.105)
 starting_velocity = change_vector_length(starting_velocity,
@@ -266,40 +307,202 @@ spring_pendulum = SpringPendulum(radius=0.05,
                                  trail_retain=600,
                                  equilibrium_length=Constants.spring_equilibrium_length,
                                  starting_velocity=starting_velocity,
-                                 random_force=False)
+                                 random_force=args.noise > 0,
+                                 integrator=args.integrator,
+                                 dt=args.dt,
+                                 rtol=args.rtol,
+                                 seed=args.seed,
+                                 noise_amplitude=args.noise,
+                                 noise_spectrum=None if args.noise_spectrum == 'white' else args.noise_spectrum,
+                                 langevin_damping=args.langevin_damping,
+                                 temperature=args.temperature)
 spring_pendulum.add_power_graph()
 spring_pendulum.add_energy_graphs(total=True, potential=True, kinetic=True)
 spring_pendulum.add_xyz_graphs(xz=True, xy=False)
 spring_pendulum.add_momentum_graphs(angular=True)
-
-# Defining the Excel data file.
-data_sheet = ExcelSheet('Data')
-headers = ExcelSheet.create_data_objects(
-    [[0, 0, 'x'], [1, 0, 'y'], [2, 0, 'z'], [3, 0, 't']])
-experiment_constants = ExcelSheet.create_data_objects([[5, 0, 'effective mass'], [5, 1, spring_pendulum.effective_mass],
-                                                       [6, 0, 'spring constant'],
-                                                       [6, 1, spring_pendulum.spring_constant],
-                                                       [7, 0, 'equilibrium length'],
-                                                       [7, 1, spring_pendulum.equilibrium_length]])
-data_sheet.write_to_sheet(headers)
-data_sheet.write_to_sheet(experiment_constants)
-
-while t <= Constants.end_time + Constants.DT:
-    if t % Constants.real_dt < Constants.DT:  # so it works with the slight floating point precision errors
-        col_y += 1
-        print_vector = change_vector_length(spring_pendulum.pos, spring_pendulum.pos.mag -
-                                            (Constants.rod_weights_center_of_mass - Constants.button_from_hook_length))
-        data_list = ExcelSheet.create_data_objects(
-            [[0, col_y, print_vector.x], [1, col_y, print_vector.y], [2, col_y, print_vector.z],
-             [3, col_y, round(t, 2)]])
-        data_sheet.write_to_sheet(data_list)
-    rate(1000)
-
-    t += Constants.DT
+graph_plotter = GraphPlotter(spring_pendulum, plot_dt=Constants.real_dt, batch_size=100,
+                             keep_history=args.cache is not None)
+spectra = PendulumSpectra(spring_pendulum.effective_mass,
+                          spring_pendulum.effective_mass + spring_pendulum.spring_mass / 6,
+                          spring_pendulum.spring_constant, spring_pendulum.equilibrium_length,
+                          sample_dt=Constants.real_dt,
+                          segment_length=args.spectra_segment) if args.spectra or args.spectra_output else None
+
+
+def replay(player, fps=60):
+    """Drives the pendulum, its trail and graphs from a recording; a slider scrubs where the backend has one."""
+    metadata = player.metadata
+    spring_pendulum.effective_mass = metadata['effective mass']
+    spring_pendulum.spring_constant = metadata['spring constant']
+    spring_pendulum.equilibrium_length = metadata['equilibrium length']
+
+    def scrub(slider):
+        player.progress = slider.value
+
+    slider = render.slider(bind=scrub, min=0, max=1, value=0, length=600) if render.slider is not None else None
+    for _, row, jumped in player.frames():
+        rate(fps)
+        if jumped:  # the trail and graphs would otherwise connect across the jump
+            graph_plotter.clear(row[0])
+            if hasattr(spring_pendulum.weight, 'clear_trail'):
+                spring_pendulum.weight.clear_trail()
+        spring_pendulum.show_recorded(row)
+        graph_plotter.update(row[0])
+        if slider is not None:
+            slider.value = player.progress
+    graph_plotter.flush()
+
+
+if args.replay:
+    replay(TrajectoryPlayer(args.replay, speed=args.replay_speed or None, decimate=args.replay_decimate,
+                            start=args.replay_start))
+    sys.exit()
+
+# Defining the data files, one writer per format. The experiment constants go in the files' metadata.
+experiment_constants = {**asdict(Constants),
+                        'effective mass': spring_pendulum.effective_mass,
+                        'spring constant': spring_pendulum.spring_constant,
+                        'equilibrium length': spring_pendulum.equilibrium_length}
+export_cursors = {}
+
+# Everything the run's results depend on. Runs resumed from a checkpoint or with unseeded noise are not cached.
+run_cache = RunCache(args.cache, int(args.cache_size * 2 ** 20), code_version(*SOURCES)) if args.cache else None
+random_run = args.noise > 0 or args.langevin_damping > 0 and args.temperature > 0
+cacheable = run_cache is not None and not args.resume and (args.seed is not None or not random_run)
+run_parameters = {'constants': experiment_constants, 'start pos': [start_pos.x, start_pos.y, start_pos.z],
+                  'starting velocity': [starting_velocity.x, starting_velocity.y, starting_velocity.z],
+                  'integrator': args.integrator, 'dt': args.dt,
+                  'rtol': args.rtol if args.integrator == 'rk45' else None, 'seed': args.seed, 'noise': args.noise,
+                  'noise spectrum': args.noise_spectrum, 'langevin damping': args.langevin_damping,
+                  'temperature': args.temperature,
+                  'observables': graph_plotter.observables,
+                  'spectra segment': args.spectra_segment if spectra is not None else None}
+
+
+def report_energy_drift(drift):
+    step = f'rtol={args.rtol:g}' if args.integrator == 'rk45' else f'dt={args.dt:g}[s]'
+    print(f'Energy drift with {args.integrator} at {step}: {drift:.3g} of the starting energy'
+          + (' (the random forces do work too)' if random_run else ''))
+
+
+def report_spectra(result):
+    print(format_result(result))
+    if args.spectra_output:
+        np.savez(args.spectra_output, signals=SIGNALS, **result)
+        print(f'Saved the spectra to {args.spectra_output}')
+
+
+def show_cached(cached_run):
+    """Writes the exports and draws the graphs and the final state of a cached run instead of simulating it."""
+    for file_name in args.export:
+        with open_trajectory_writer(file_name, ['x', 'y', 'z', 't'], experiment_constants) as writer:
+            writer.write_rows(cached_run['exports'])
+    if args.record:
+        with open_trajectory_writer(args.record, RECORD_COLUMNS, experiment_constants) as writer:
+            writer.write_rows(cached_run['record'])
+    if len(cached_run['graph_samples']):
+        graph_plotter.plot(cached_run['graph_samples'])
+    spring_pendulum.show_recorded(cached_run['final_state'])
+    report_energy_drift(cached_run['energy drift'])
+    if spectra is not None:
+        report_spectra({name[len('spectra '):]: value for name, value in cached_run.items()
+                        if name.startswith('spectra ')})
+
+
+if cacheable:
+    cached_run = run_cache.load(run_parameters, required=['energy drift'] + (['record'] if args.record else []) +
+                                                         (['spectra segments'] if spectra is not None else []))
+    if cached_run is not None:
+        print(f'Loaded the run from {run_cache.path(run_parameters)}')
+        with profiler.phase('cache'):
+            show_cached(cached_run)
+        sys.exit()
+export_rows = []
+start_energy = spring_pendulum.conserved_energy()
+energy_drift = 0.  # the largest relative deviation from start_energy, checked at every export
+next_export = 0  # the index of the next multiple of real_dt to export
+
+if args.resume:
+    checkpoint = load_checkpoint(args.resume, 'spring pendulum')
+    t = checkpoint['t']
+    spring_pendulum.set_state(checkpoint['pendulum'])
+    graph_plotter.next_sample_time = checkpoint['next_plot_time']
+    export_cursors = checkpoint['export_cursors']
+    if 'start_energy' in checkpoint:  # checkpoints from before the drift report measure from the resumed state
+        start_energy, energy_drift = checkpoint['start_energy'], checkpoint['energy_drift']
+    next_export = checkpoint.get('next_export', round(t / Constants.real_dt))
+    if spectra is not None and checkpoint.get('spectra') is not None:
+        spectra.set_state(checkpoint['spectra'])
+
+data_writers = [open_trajectory_writer(file_name, ['x', 'y', 'z', 't'], experiment_constants,
+                                       resume=export_cursors.get(file_name))
+                for file_name in args.export]
+record_writers = [open_trajectory_writer(args.record, RECORD_COLUMNS, experiment_constants,
+                                         resume=export_cursors.get(args.record))] if args.record else []
+if record_writers and not args.resume:
+    spring_pendulum.record(record_writers[0], t)
+checkpointer = Checkpointer(args.checkpoint, 'spring pendulum', args.checkpoint_every)
+
+
+def simulation_state():
+    return {'t': t, 'pendulum': spring_pendulum.get_state(), 'next_plot_time': graph_plotter.next_sample_time,
+            'start_energy': start_energy, 'energy_drift': energy_drift, 'next_export': next_export,
+            'spectra': spectra.get_state() if spectra is not None else None,
+            'export_cursors': {writer.path: writer.cursor() for writer in data_writers + record_writers}}
+
+
+while t <= Constants.end_time + args.dt:
+    with profiler.phase('checkpoint'):
+        checkpointer.step(simulation_state)
+    # the step nearest to each multiple of real_dt, t % real_dt would miss some when dt is not much smaller
+    if t + args.dt / 2 >= next_export * Constants.real_dt:
+        next_export = round(t / Constants.real_dt) + 1
+        energy_drift = max(energy_drift, abs(spring_pendulum.conserved_energy() - start_energy) / abs(start_energy))
+        with profiler.phase('data export'):
+            print_vector = change_vector_length(spring_pendulum.pos, spring_pendulum.pos.mag -
+                                                (Constants.rod_weights_center_of_mass -
+                                                 Constants.button_from_hook_length))
+            for data_writer in data_writers:
+                data_writer.write(print_vector.x, print_vector.y, print_vector.z, round(t, 2))
+            if cacheable:
+                export_rows.append([print_vector.x, print_vector.y, print_vector.z, round(t, 2)])
+    with profiler.phase('rate'):
+        rate(1000)
+
+    t += args.dt
 
     # update
-    spring_pendulum.update_all_graphs(t)
-    spring_pendulum.kinematics()
-    spring_pendulum.update_pos()
-
-data_sheet.save_file()
+    with profiler.phase('graphs'):
+        graph_plotter.update(t)
+    with profiler.phase('physics'):
+        spring_pendulum.kinematics(args.dt)
+    if spectra is not None and spectra.due(t):
+        with profiler.phase('spectra'):
+            pos, velocity = spring_pendulum.pos, spring_pendulum.velocity
+            spectra.update(t, (pos.x, pos.y, pos.z), (velocity.x, velocity.y, velocity.z),
+                           spring_pendulum.power.spring, spring_pendulum.power.gravity)
+    with profiler.phase('vpython objects'):
+        spring_pendulum.update_pos()
+    if record_writers:
+        with profiler.phase('data export'):
+            spring_pendulum.record(record_writers[0], t)
+
+with profiler.phase('graphs'):
+    graph_plotter.flush()
+checkpointer.save(simulation_state())
+with profiler.phase('data export'):
+    for data_writer in data_writers + record_writers:
+        data_writer.close()
+energy_drift = max(energy_drift, abs(spring_pendulum.conserved_energy() - start_energy) / abs(start_energy))
+report_energy_drift(energy_drift)
+spectra_result = spectra.result() if spectra is not None else {}
+if spectra is not None:
+    report_spectra(spectra_result)
+if cacheable:
+    with profiler.phase('cache'):
+        finished_run = {'exports': np.array(export_rows).reshape(-1, 4), 'graph_samples': graph_plotter.history(),
+                        'final_state': np.array(spring_pendulum.record_row(t)), 'energy drift': energy_drift}
+        finished_run.update({f'spectra {name}': value for name, value in spectra_result.items()})
+        if args.record:
+            finished_run['record'] = np.asarray(load_trajectory(args.record)[0])
+        run_cache.store(run_parameters, finished_run)
@@ -0,0 +1,219 @@
+"""
+Networks of point masses joined by springs, stepped with the integrators of integrators.INTEGRATORS.
+
+The network is stored as arrays: node positions and velocities (n, 3), inertial and gravitational masses (n,), a fixed
+mask for anchors, and per edge the two node indices, the spring constant and the rest length. Every step the spring
+forces of all edges are computed at once and summed onto the nodes with a single bincount, so the cost is linear in
+the number of edges and a chain of thousands of segments steps as one batch.
+
+SpringNetwork.chain discretizes the pendulum's spring into M segments and SpringNetwork.coupled_pendulums hangs
+several such pendulums side by side with springs between their weights. A chain of one segment is the SpringPendulum
+model itself (spring_mass / 3 moving with the weight and spring_mass / 6 more of its weight hanging on it) and
+reproduces a one element PendulumEnsemble bit for bit; with more segments the spring's mass moves with its nodes.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from constants import Constants
+from energy import SpringPendulumEnergy
+from ensemble import row_dot, vector_mag
+from integrators import INTEGRATORS
+
+
+# CLASSES #
+@dataclass
+class NetworkTrajectory:
+    t: np.ndarray  # (samples,)
+    pos: np.ndarray  # (samples, n, 3)
+    velocity: np.ndarray  # (samples, n, 3)
+    energy: np.ndarray  # (samples,), total energy of the network
+    integrator: str = 'euler'
+    dt: float = Constants.DT
+    evaluations: int = 0
+
+    @property
+    def energy_error(self) -> float:  # max relative deviation of the total energy from its start value
+        return float(np.max(np.abs(self.energy - self.energy[0])) / np.abs(self.energy[0]))
+
+
+class SpringNetwork:
+    """
+    Nodes at pos (n, 3) with inertial mass (n,), joined by springs from first[i] to second[i] (edge arrays of shape
+    (E,)) with spring_constant and rest_length (scalars or (E,)). Fixed nodes never move; gravity pulls each node with
+    gravity_mass (the inertial mass by default) along -y.
+    """
+
+    def __init__(self, pos, mass, first, second, spring_constant, rest_length, velocity=None, fixed=None,
+                 gravity_mass=None, g=Constants.g, integrator='euler'):
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Unknown integrator {integrator!r}, use one of {", ".join(INTEGRATORS)}')
+        self.pos = np.array(pos, dtype=float).reshape(-1, 3)
+        size = len(self.pos)
+        self.velocity = np.zeros_like(self.pos) if velocity is None else np.array(velocity, dtype=float)
+        self.mass = np.broadcast_to(np.asarray(mass, dtype=float), (size,)).copy()
+        self.gravity_mass = self.mass.copy() if gravity_mass is None else \
+            np.broadcast_to(np.asarray(gravity_mass, dtype=float), (size,)).copy()
+        self.fixed = np.zeros(size, dtype=bool) if fixed is None else np.array(fixed, dtype=bool)
+        self.velocity[self.fixed] = 0
+
+        self.first = np.array(first, dtype=np.int64)
+        self.second = np.array(second, dtype=np.int64)
+        self.spring_constant = np.broadcast_to(np.asarray(spring_constant, dtype=float), self.first.shape).copy()
+        self.rest_length = np.broadcast_to(np.asarray(rest_length, dtype=float), self.first.shape).copy()
+        # flat (node, axis) bins of every edge's force on its second node, then on its first
+        axes = np.arange(3)
+        self.__force_bins = np.concatenate([(3 * self.second[:, None] + axes).ravel(),
+                                            (3 * self.first[:, None] + axes).ravel()])
+
+        self.g = g
+        self.gravity_enabled = True
+        self.integrator = integrator
+        self.evaluations = 0
+        self.force = np.zeros_like(self.pos)
+        self.acceleration = np.zeros_like(self.pos)
+
+    @classmethod
+    def chain(cls, segments, end_pos, starting_velocity=(0, 0, 0), anchor=(0, 0, 0), effective_mass=0.25,
+              spring_mass=0.05, spring_constant=30., equilibrium_length=0.2, **options):
+        """
+        A pendulum whose spring is split into segments equal springs (segments times stiffer, a segments-th of the
+        length) between a fixed anchor and the weight at end_pos; the parameters are SpringPendulum's. The nodes start
+        evenly spaced on the straight line and with velocities growing linearly to starting_velocity at the weight.
+        """
+        return cls(**cls.__chain_layout(segments, anchor, end_pos, starting_velocity, effective_mass, spring_mass,
+                                        spring_constant, equilibrium_length), **options)
+
+    @classmethod
+    def coupled_pendulums(cls, anchors, end_positions, coupling_constant, coupling_length=None, segments=1,
+                          starting_velocities=None, effective_mass=0.25, spring_mass=0.05, spring_constant=30.,
+                          equilibrium_length=0.2, **options):
+        """
+        One chain per anchor, the weights of neighbouring pendulums joined by springs of coupling_constant, relaxed
+        at their starting distance unless coupling_length is given. The pendulum parameters may be scalars or one
+        value per pendulum.
+        """
+        anchors = np.asarray(anchors, dtype=float).reshape(-1, 3)
+        count = len(anchors)
+        end_positions = np.broadcast_to(np.asarray(end_positions, dtype=float), (count, 3))
+        starting_velocities = np.zeros((count, 3)) if starting_velocities is None else \
+            np.broadcast_to(np.asarray(starting_velocities, dtype=float), (count, 3))
+        parameters = [np.broadcast_to(np.asarray(value, dtype=float), (count,))
+                      for value in (effective_mass, spring_mass, spring_constant, equilibrium_length)]
+
+        layouts = [cls.__chain_layout(segments, anchor, end_pos, velocity, *values)
+                   for anchor, end_pos, velocity, *values in zip(anchors, end_positions, starting_velocities,
+                                                                 *parameters)]
+        network = {name: np.concatenate([layout[name] for layout in layouts]) for name in layouts[0]}
+        offsets = (segments + 1) * np.arange(count)
+        for name in ('first', 'second'):
+            network[name] = np.concatenate([layout[name] + offset for layout, offset in zip(layouts, offsets)])
+
+        weights = offsets + segments
+        if coupling_length is None:
+            coupling_length = vector_mag(network['pos'][weights[1:]] - network['pos'][weights[:-1]])
+        network['first'] = np.concatenate([network['first'], weights[:-1]])
+        network['second'] = np.concatenate([network['second'], weights[1:]])
+        for name, value in (('spring_constant', coupling_constant), ('rest_length', coupling_length)):
+            network[name] = np.concatenate([network[name], np.broadcast_to(value, (count - 1,))])
+        return cls(**network, **options)
+
+    @staticmethod
+    def __chain_layout(segments, anchor, end_pos, starting_velocity, effective_mass, spring_mass, spring_constant,
+                       equilibrium_length):
+        anchor, end_pos = np.asarray(anchor, dtype=float), np.asarray(end_pos, dtype=float)
+        fraction = np.arange(segments + 1)[:, None] / segments
+        pos = anchor + fraction * (end_pos - anchor)
+        pos[-1] = end_pos
+        velocity = fraction * np.asarray(starting_velocity, dtype=float)
+        velocity[-1] = starting_velocity
+
+        # a segments-th of the spring's mass on every inner node; the weight keeps the single spring's corrections
+        # for its last segment, which vanish when there is only one
+        segment_mass = spring_mass / segments
+        mass = np.full(segments + 1, segment_mass)
+        gravity_mass = mass.copy()
+        mass[-1] = effective_mass + (segment_mass / 3 - spring_mass / 3)
+        gravity_mass[-1] = effective_mass + spring_mass / 6 + (segment_mass / 2 - spring_mass / 2)
+        fixed = np.zeros(segments + 1, dtype=bool)
+        fixed[0] = True
+        return {'pos': pos, 'velocity': velocity, 'mass': mass, 'gravity_mass': gravity_mass, 'fixed': fixed,
+                'first': np.arange(segments), 'second': np.arange(1, segments + 1),
+                'spring_constant': np.full(segments, segments * spring_constant),
+                'rest_length': np.full(segments, equilibrium_length / segments)}
+
+    @property
+    def size(self) -> int:
+        return len(self.pos)
+
+    def edge_vectors(self, pos=None):
+        pos = self.pos if pos is None else pos
+        return pos[..., self.second, :] - pos[..., self.first, :]
+
+    def tensions(self, pos=None):  # (E,), positive when stretched
+        return self.spring_constant * (vector_mag(self.edge_vectors(pos)) - self.rest_length)
+
+    def spring_forces(self, pos=None):
+        """The summed spring force on every node, (n, 3)."""
+        edges = self.edge_vectors(pos)
+        length = vector_mag(edges)
+        # the force on each edge's second node, in PendulumEnsemble.spring_force's order of operations
+        force = (-self.spring_constant * (length - self.rest_length))[:, None] * edges / length[:, None]
+        return np.bincount(self.__force_bins, np.concatenate([force.ravel(), -force.ravel()]),
+                           minlength=3 * self.size).reshape(-1, 3)
+
+    def gravity(self):
+        gravity = np.zeros_like(self.pos)
+        if self.gravity_enabled:
+            gravity[:, 1] = self.gravity_mass * -self.g
+        return gravity
+
+    def inertia(self):  # (n, 1), infinite for the fixed nodes so they never accelerate
+        return np.where(self.fixed, np.inf, self.mass)[:, None]
+
+    def acceleration_function(self, gravity):
+        inertia = self.inertia()
+
+        def acceleration(pos, velocity):
+            self.evaluations += 1
+            return (gravity + self.spring_forces(pos)) / inertia
+
+        return acceleration
+
+    def kinematics(self, dt=Constants.DT):
+        gravity = self.gravity()
+        self.force = gravity + self.spring_forces()
+        acceleration = self.acceleration_function(gravity)
+        self.acceleration = self.force / self.inertia()
+        self.pos, self.velocity = INTEGRATORS[self.integrator](self.pos, self.velocity, acceleration, dt)
+
+    def energy(self, pos=None, velocity=None) -> SpringPendulumEnergy:
+        """The network's energies, summed over the edges and nodes (arrays over any leading sample axes)."""
+        pos = self.pos if pos is None else pos
+        velocity = self.velocity if velocity is None else velocity
+        gravitational_mass = self.gravity_mass if self.gravity_enabled else 0
+        spring = 0.5 * self.spring_constant * (vector_mag(self.edge_vectors(pos)) - self.rest_length) ** 2
+        return SpringPendulumEnergy(spring=spring.sum(axis=-1),
+                                    gravity=(gravitational_mass * self.g * pos[..., 1]).sum(axis=-1),
+                                    kinetic=(0.5 * self.mass * row_dot(velocity, velocity)).sum(axis=-1))
+
+    def run(self, end_time=Constants.end_time, dt=Constants.DT, sample_dt=Constants.real_dt,
+            integrator=None) -> NetworkTrajectory:
+        """Steps the network until end_time with the live simulation's time loop, sampling every sample_dt."""
+        if integrator is not None:
+            self.integrator = integrator
+        start_evaluations = self.evaluations
+        times, positions, velocities = [], [], []
+        t = 0
+        while t <= end_time + dt:
+            if t + dt / 2 >= len(times) * sample_dt:  # the step nearest to each sample time
+                times.append(t)
+                positions.append(self.pos.copy())
+                velocities.append(self.velocity.copy())
+
+            t += dt
+            self.kinematics(dt)
+
+        positions, velocities = np.stack(positions), np.stack(velocities)
+        return NetworkTrajectory(np.array(times), positions, velocities, self.energy(positions, velocities).total,
+                                 self.integrator, dt, self.evaluations - start_evaluations)
@@ -0,0 +1,121 @@
+"""
+Reproducible random forcing for the pendulums.
+
+NoiseGenerator hands out one random force per physics step for any number of pendulums, drawn from a seeded NumPy
+generator many steps at a time instead of three random.uniform calls per step. The default is the original forcing,
+independent uniform(-amplitude, amplitude) components every step (white noise). With a spectrum the noise of each block
+is shaped in the frequency domain, keeping its variance, so it can be pink, brown or any amplitude(frequency) profile.
+
+LangevinThermostat couples the pendulums to a heat bath instead: a friction force -damping * mass * velocity plus
+Gaussian kicks of standard deviation sqrt(2 * damping * mass * temperature / dt) per component and step, which by the
+fluctuation-dissipation theorem settles every degree of freedom at the temperature (given as k_B T, in joules).
+"""
+import numpy as np
+
+from constants import Constants
+
+MAX_BLOCK_VALUES = 1 << 20  # random numbers per block, 8 MB
+
+
+# FUNCTIONS #
+def white(frequency):
+    return np.ones_like(frequency)
+
+
+def pink(frequency):  # power falls as 1/f
+    return np.divide(1, np.sqrt(frequency), out=np.zeros_like(frequency), where=frequency > 0)
+
+
+def brown(frequency):  # power falls as 1/f^2
+    return np.divide(1, frequency, out=np.zeros_like(frequency), where=frequency > 0)
+
+
+SPECTRA = {'white': white, 'pink': pink, 'brown': brown}
+
+
+# CLASSES #
+class NoiseGenerator:
+    """
+    next() returns the noise of one step, an array of the given shape ((3,) for one pendulum, (N, 3) for an
+    ensemble). Blocks of block_size steps (fewer for large shapes, see MAX_BLOCK_VALUES) are generated at once.
+    distribution is 'uniform' (in [-amplitude, amplitude]) or 'normal' (standard deviation amplitude); spectrum is
+    None, a name from SPECTRA or a function of the frequency in Hz returning the relative amplitude.
+    """
+
+    def __init__(self, shape, amplitude=1E-3, spectrum=None, dt=Constants.DT, block_size=4096, seed=None,
+                 distribution='uniform'):
+        if distribution not in ('uniform', 'normal'):
+            raise ValueError(f'Unknown noise distribution {distribution!r}, use uniform or normal')
+        self.shape = tuple(np.atleast_1d(shape))
+        self.amplitude = amplitude
+        self.spectrum = SPECTRA[spectrum] if isinstance(spectrum, str) else spectrum
+        self.dt = dt
+        self.block_size = max(16, min(block_size, MAX_BLOCK_VALUES // max(int(np.prod(self.shape)), 1)))
+        self.distribution = distribution
+        self.rng = np.random.default_rng(seed)
+        self.block = None
+        self.block_state = None  # the generator's state the current block was drawn from
+        self.index = 0
+
+    def __draw_block(self):
+        self.block_state = self.rng.bit_generator.state
+        size = (self.block_size,) + self.shape
+        if self.distribution == 'uniform':
+            block = self.rng.uniform(-1, 1, size)
+        else:
+            block = self.rng.standard_normal(size)
+        if self.spectrum is not None:
+            amplitudes = self.spectrum(np.fft.rfftfreq(self.block_size, self.dt))
+            # every frequency but 0 (and the Nyquist one of an even block) appears twice in the full spectrum
+            weights = np.full(len(amplitudes), 2.)
+            weights[0] = 1
+            if self.block_size % 2 == 0:
+                weights[-1] = 1
+            gain = np.sqrt(self.block_size / max(float(weights @ amplitudes ** 2), 1E-300))  # keeps the variance
+            shaped = np.fft.rfft(block, axis=0) * (gain * amplitudes).reshape((-1,) + (1,) * len(self.shape))
+            block = np.fft.irfft(shaped, self.block_size, axis=0)
+        self.block = self.amplitude * block
+        self.index = 0
+
+    def next(self):
+        if self.block is None or self.index == self.block_size:
+            self.__draw_block()
+        self.index += 1
+        return self.block[self.index - 1]
+
+    def get_state(self):
+        return {'block_state': self.block_state, 'index': self.index}
+
+    def set_state(self, state):
+        if state['block_state'] is None:
+            return
+        self.rng.bit_generator.state = state['block_state']
+        self.__draw_block()
+        self.index = state['index']
+
+
+class LangevinThermostat:
+    """
+    The heat bath of one pendulum (shape (3,)) or of an ensemble ((N, 3), damping and temperature may then be (N,)
+    arrays). damping is the friction rate in 1/s, temperature k_B T in joules.
+    """
+
+    def __init__(self, shape, damping, temperature, seed=None):
+        self.damping = np.asarray(damping, dtype=float)
+        self.temperature = np.asarray(temperature, dtype=float)
+        self.noise = NoiseGenerator(shape, 1., seed=seed, distribution='normal')
+
+    def kick(self, mass, dt=Constants.DT):
+        """The random force of one step of length dt on pendulums of the given (effective) mass."""
+        deviation = np.sqrt(2 * self.damping * np.asarray(mass) * self.temperature / dt)
+        return deviation[..., None] * self.noise.next()
+
+    def friction_rate(self, mass):
+        """damping * mass, the friction force is minus this times the velocity."""
+        return self.damping * np.asarray(mass)
+
+    def get_state(self):
+        return self.noise.get_state()
+
+    def set_state(self, state):
+        self.noise.set_state(state)
@@ -0,0 +1,107 @@
+from time import perf_counter
+
+import numpy as np
+
+from constants import Constants
+
+# observable name -> value, read off a SpringPendulum whose energies were just recalculated
+OBSERVABLES = {
+    't': lambda pendulum, t: t,
+    'x': lambda pendulum, t: pendulum.pos.x,
+    'y': lambda pendulum, t: pendulum.pos.y,
+    'z': lambda pendulum, t: pendulum.pos.z,
+    'total energy': lambda pendulum, t: pendulum.energy.total,
+    'potential energy': lambda pendulum, t: pendulum.energy.potential,
+    'kinetic energy': lambda pendulum, t: pendulum.energy.kinetic,
+    'potential spring energy': lambda pendulum, t: pendulum.energy.spring - pendulum.spring_energy_offset,
+    'potential gravitational energy':
+        lambda pendulum, t: pendulum.energy.gravity - pendulum.gravitational_energy_offset,
+    'spring power': lambda pendulum, t: pendulum.power.spring,
+    'gravitational power': lambda pendulum, t: pendulum.power.gravity,
+    'angular momentum': lambda pendulum, t: pendulum.angular_momentum().mag,
+}
+ENERGY_OBSERVABLES = {name for name in OBSERVABLES if 'energy' in name}
+
+# graph name -> (x observable, y observable)
+GRAPH_AXES = {
+    'total energy': ('t', 'total energy'),
+    'potential energy': ('t', 'potential energy'),
+    'kinetic energy': ('t', 'kinetic energy'),
+    'potential spring energy': ('t', 'potential spring energy'),
+    'potential gravitational energy': ('t', 'potential gravitational energy'),
+    'spring power': ('t', 'spring power'),
+    'gravitational power': ('t', 'gravitational power'),
+    'xy': ('x', 'y'),
+    'xz': ('x', 'z'),
+    'angular momentum': ('t', 'angular momentum'),
+}
+
+
+class GraphPlotter:
+    """
+    Samples a SpringPendulum's observables every plot_dt of simulation time into a preallocated buffer and pushes
+    them to its gcurves in batches, one plot call per curve per batch, instead of one websocket message per curve per
+    physics step. Each observable is computed once per sample no matter how many graphs show it.
+
+    A batch is pushed when batch_size samples are buffered, when flush_interval seconds of wall time passed since the
+    last push (so the graphs keep up with the animation frames) and on flush(). With keep_history every pushed sample
+    is also kept, see history(), so the graphs of a run can be drawn again with plot() without simulating it.
+    """
+
+    def __init__(self, pendulum, plot_dt=Constants.real_dt, batch_size=100, flush_interval=1 / 30,
+                 keep_history=False):
+        self.pendulum = pendulum
+        self.plot_dt = plot_dt
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.curves = list(pendulum.graphs.items())
+        self.observables = sorted({name for graph_name, _ in self.curves for name in GRAPH_AXES[graph_name]})
+        columns = {name: i for i, name in enumerate(self.observables)}
+        self.columns = [list(map(columns.get, GRAPH_AXES[graph_name])) for graph_name, _ in self.curves]
+        self.needs_energy = not ENERGY_OBSERVABLES.isdisjoint(self.observables)
+
+        self.buffer = np.empty((batch_size, len(self.observables)))
+        self.buffered = 0
+        self.next_sample_time = 0
+        self.last_flush = perf_counter()
+        self.pushed = [] if keep_history else None
+
+    def update(self, t):
+        if t + 1E-12 < self.next_sample_time:
+            return
+        self.next_sample_time += self.plot_dt * max(1, int((t - self.next_sample_time) // self.plot_dt) + 1)
+
+        if self.needs_energy:
+            self.pendulum.calculate_energy()
+        row = self.buffer[self.buffered]
+        for i, name in enumerate(self.observables):
+            row[i] = OBSERVABLES[name](self.pendulum, t)
+        self.buffered += 1
+
+        if self.buffered == self.batch_size or perf_counter() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            self.plot(self.buffer[:self.buffered])
+            self.buffered = 0
+        self.last_flush = perf_counter()
+
+    def plot(self, samples):
+        """Pushes sample rows (one column per observable, in self.observables order) to the curves."""
+        for (_, curve), columns in zip(self.curves, self.columns):
+            curve.plot(samples[:, columns].tolist())
+        if self.pushed is not None:
+            self.pushed.append(samples.copy())
+
+    def history(self):
+        return np.concatenate(self.pushed) if self.pushed else np.empty((0, len(self.observables)))
+
+    def clear(self, t=0):
+        """Drops the buffered samples and the curves' points (where the backend can), then samples again from t."""
+        self.buffered = 0
+        for _, curve in self.curves:
+            if hasattr(curve, 'delete'):
+                curve.delete()
+        self.next_sample_time = t
@@ -0,0 +1,237 @@
+"""
+Online spectral analysis of pendulum runs, in memory that does not grow with the run's length.
+
+WelchSpectrum averages the periodograms of overlapping Hann windowed segments (Welch's method) as the samples come in,
+keeping only the last segment's samples and the running sum of their power, so its result is the one scipy.signal.welch
+gives for the whole signal (one-sided power spectral density, mean detrended segments).
+
+The spring pendulum's energy splits into a stretching mode (radial motion in the spring) and a swinging mode
+(mode_energies); their sum is the total energy up to a constant. ExchangeTracker follows the stretching mode's share
+of it and times the exchanges between the modes from its maxima, counting a maximum once the share has fallen
+hysteresis below it (and a minimum likewise), so the fast ripple within each swing is not mistaken for one.
+
+PendulumSpectra feeds both from a pendulum's (or an ensemble's) state every sample_dt and reports the stretching and
+swinging mode frequencies from the spectra and the exchange period (and its inverse, the exchange frequency) from the
+tracker.
+"""
+import numpy as np
+
+from constants import Constants
+
+# the signals PendulumSpectra takes the spectra of
+SIGNALS = ('x', 'y', 'z', 'stretch', 'stretch energy', 'swing energy', 'spring power', 'gravitational power')
+
+
+# FUNCTIONS #
+def mode_energies(pos, velocity, mass, gravity_mass, spring_constant, equilibrium_length, g=Constants.g):
+    """
+    (stretching, swinging) energies of pendulums at pos with velocity (arrays of shape (..., 3)). Stretching is the
+    radial kinetic energy plus the spring's energy around its stretch at rest under gravity, swinging the tangential
+    kinetic energy plus the weight's rise above the lowest point on the current radius.
+    """
+    pos, velocity = np.asarray(pos, dtype=float), np.asarray(velocity, dtype=float)
+    radius = np.sqrt(pos[..., 0] ** 2 + pos[..., 1] ** 2 + pos[..., 2] ** 2)
+    radial_velocity = (pos * velocity).sum(axis=-1) / radius
+    speed2 = (velocity * velocity).sum(axis=-1)
+    rest_radius = equilibrium_length + gravity_mass * g / spring_constant
+    stretching = 0.5 * mass * radial_velocity ** 2 + 0.5 * spring_constant * (radius - rest_radius) ** 2
+    swinging = 0.5 * mass * (speed2 - radial_velocity ** 2) + gravity_mass * g * (radius + pos[..., 1])
+    return stretching, swinging
+
+
+def peak_frequency(frequencies, power):
+    """The frequency of the highest peak above 0 along the last axis, refined by a parabola through its bins."""
+    power = np.asarray(power, dtype=float)
+    index = np.argmax(power[..., 1:], axis=-1) + 1
+    left = np.take_along_axis(power, np.maximum(index - 1, 0)[..., None], -1)[..., 0]
+    center = np.take_along_axis(power, index[..., None], -1)[..., 0]
+    right = np.take_along_axis(power, np.minimum(index + 1, power.shape[-1] - 1)[..., None], -1)[..., 0]
+    curvature = left - 2 * center + right
+    shift = np.divide(0.5 * (left - right), curvature, out=np.zeros_like(center), where=curvature != 0)
+    return frequencies[index] + np.clip(shift, -0.5, 0.5) * (frequencies[1] - frequencies[0])
+
+
+# CLASSES #
+class WelchSpectrum:
+    """
+    Samples (arrays of any fixed shape, one spectrum per element) are added with update(). A segment of
+    segment_length samples is transformed every hop = segment_length * (1 - overlap) samples.
+    """
+
+    def __init__(self, sample_dt, segment_length=256, overlap=0.5):
+        self.sample_dt = sample_dt
+        self.segment_length = segment_length
+        self.hop = max(1, int(round(segment_length * (1 - overlap))))
+        self.window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(segment_length) / segment_length)  # periodic Hann
+        # one-sided density: the energy of the negative frequencies is folded onto the positive ones
+        self.scale = np.full(segment_length // 2 + 1, 2 / (self.window @ self.window) * sample_dt)
+        self.scale[0] /= 2
+        if segment_length % 2 == 0:
+            self.scale[-1] /= 2
+        self.buffer = None
+        self.samples = 0
+        self.segments = 0
+        self.total = None
+
+    @property
+    def frequencies(self):
+        return np.fft.rfftfreq(self.segment_length, self.sample_dt)
+
+    def update(self, sample):
+        sample = np.asarray(sample, dtype=float)
+        if self.buffer is None:
+            self.buffer = np.zeros((self.segment_length,) + sample.shape)
+            self.total = np.zeros(sample.shape + (self.segment_length // 2 + 1,))
+        self.buffer[self.samples % self.segment_length] = sample
+        self.samples += 1
+        if self.samples >= self.segment_length and (self.samples - self.segment_length) % self.hop == 0:
+            start = self.samples % self.segment_length  # the oldest sample in the ring
+            segment = np.moveaxis(np.roll(self.buffer, -start, axis=0), 0, -1)
+            segment = (segment - segment.mean(axis=-1, keepdims=True)) * self.window
+            self.total += np.abs(np.fft.rfft(segment, axis=-1)) ** 2
+            self.segments += 1
+
+    def power(self):
+        """(frequencies, power spectral density of shape sample shape + (frequencies,)), None before one segment."""
+        if not self.segments:
+            return self.frequencies, None
+        return self.frequencies, self.total * self.scale / self.segments
+
+    def get_state(self):
+        return {'buffer': self.buffer, 'samples': self.samples, 'segments': self.segments, 'total': self.total}
+
+    def set_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class ExchangeTracker:
+    """Times the maxima of a signal (of any fixed shape, each element tracked on its own) sampled with update()."""
+
+    def __init__(self, hysteresis=0.05):
+        self.hysteresis = hysteresis
+        self.state = None
+
+    def update(self, t, value):
+        value = np.asarray(value, dtype=float)
+        if self.state is None:
+            self.state = {'rising': np.ones(value.shape, dtype=bool), 'extreme': value.copy(),
+                          'extreme_time': np.full(value.shape, float(t)),
+                          'last_peak_time': np.full(value.shape, np.nan), 'last_peak': np.full(value.shape, np.nan),
+                          'intervals': np.zeros(value.shape),
+                          'exchanges': np.zeros(value.shape, dtype=np.int64), 'depths': np.zeros(value.shape),
+                          'troughs': np.zeros(value.shape, dtype=np.int64)}
+        state = self.state
+        rising = state['rising']
+        further = np.where(rising, value > state['extreme'], value < state['extreme'])
+        state['extreme'] = np.where(further, value, state['extreme'])
+        state['extreme_time'] = np.where(further, t, state['extreme_time'])
+
+        peak = rising & (value < state['extreme'] - self.hysteresis)
+        timed = peak & ~np.isnan(state['last_peak_time'])
+        state['intervals'] += np.where(timed, state['extreme_time'] - state['last_peak_time'], 0)
+        state['exchanges'] += timed
+        state['last_peak_time'] = np.where(peak, state['extreme_time'], state['last_peak_time'])
+        state['last_peak'] = np.where(peak, state['extreme'], state['last_peak'])
+
+        trough = ~rising & (value > state['extreme'] + self.hysteresis)
+        measured = trough & ~np.isnan(state['last_peak'])
+        state['depths'] += np.where(measured, state['last_peak'] - state['extreme'], 0)
+        state['troughs'] += measured
+
+        turned = peak | trough
+        state['rising'] = rising ^ turned
+        state['extreme'] = np.where(turned, value, state['extreme'])
+        state['extreme_time'] = np.where(turned, t, state['extreme_time'])
+
+    def period(self):
+        """The mean time between consecutive maxima, NaN until two were seen."""
+        if self.state is None:
+            return np.nan
+        return np.divide(self.state['intervals'], self.state['exchanges'],
+                         out=np.full(self.state['intervals'].shape, np.nan), where=self.state['exchanges'] > 0)
+
+    def depth(self):
+        """The mean fall from a maximum to the next minimum, NaN until one was seen."""
+        if self.state is None:
+            return np.nan
+        return np.divide(self.state['depths'], self.state['troughs'],
+                         out=np.full(self.state['depths'].shape, np.nan), where=self.state['troughs'] > 0)
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
+
+class PendulumSpectra:
+    """
+    Spectra of SIGNALS and the mode energy exchange of pendulums with the given parameters (scalars, or (N,) arrays
+    for an ensemble), sampled every sample_dt. mass is the mass of the equations of motion, gravity_mass the one
+    gravity pulls on (SpringPendulum's effective_mass and effective_mass + spring_mass / 6).
+    """
+
+    def __init__(self, mass, gravity_mass, spring_constant, equilibrium_length, g=Constants.g,
+                 sample_dt=Constants.real_dt, segment_length=256, overlap=0.5, hysteresis=0.05):
+        self.parameters = (mass, gravity_mass, spring_constant, equilibrium_length, g)
+        self.rest_radius = equilibrium_length + gravity_mass * g / spring_constant
+        self.sample_dt = sample_dt
+        self.welch = WelchSpectrum(sample_dt, segment_length, overlap)
+        self.exchange = ExchangeTracker(hysteresis)
+        self.next_sample = 0.
+
+    def due(self, t):
+        return t + 1E-12 >= self.next_sample
+
+    def update(self, t, pos, velocity, spring_power, gravitational_power):
+        """Takes a sample if one is due at time t (pos and velocity of shape (..., 3)), returns whether it did."""
+        if not self.due(t):
+            return False
+        self.next_sample += self.sample_dt * max(1, int((t - self.next_sample) // self.sample_dt) + 1)
+        pos, velocity = np.asarray(pos, dtype=float), np.asarray(velocity, dtype=float)
+        stretching, swinging = mode_energies(pos, velocity, *self.parameters)
+        stretch = np.sqrt(pos[..., 0] ** 2 + pos[..., 1] ** 2 + pos[..., 2] ** 2) - self.rest_radius
+        self.welch.update(np.stack(np.broadcast_arrays(pos[..., 0], pos[..., 1], pos[..., 2], stretch, stretching,
+                                                       swinging, spring_power, gravitational_power)))
+        total = stretching + swinging
+        self.exchange.update(t, np.divide(stretching, total, out=np.zeros_like(total), where=total > 0))
+        return True
+
+    def spectrum(self, signal):
+        frequencies, power = self.welch.power()
+        return frequencies, None if power is None else power[SIGNALS.index(signal)]
+
+    def result(self):
+        """Everything measured so far as a dict of arrays: the spectra, mode frequencies and exchange timing."""
+        frequencies, power = self.welch.power()
+        period = self.exchange.period()
+        # the exchange is usually slower than a Welch segment is long, so its frequency comes from the tracker
+        result = {'frequencies': frequencies, 'exchange period': period, 'exchange frequency': 1 / period,
+                  'exchange depth': self.exchange.depth(), 'segments': self.welch.segments}
+        if power is None:
+            return result
+        swing_power = power[SIGNALS.index('x')] + power[SIGNALS.index('z')]
+        result.update({'power': power,
+                       'stretch frequency': peak_frequency(frequencies, power[SIGNALS.index('stretch')]),
+                       'swing frequency': peak_frequency(frequencies, swing_power)})
+        return result
+
+    def get_state(self):
+        return {'welch': self.welch.get_state(), 'exchange': self.exchange.get_state(), 'next_sample': self.next_sample}
+
+    def set_state(self, state):
+        self.welch.set_state(state['welch'])
+        self.exchange.set_state(state['exchange'])
+        self.next_sample = state['next_sample']
+
+
+def format_result(result):
+    """A few lines summing up PendulumSpectra.result() of a single pendulum."""
+    lines = [f'Spectra from {int(result["segments"])} segments']
+    for name in ('stretch frequency', 'swing frequency', 'exchange frequency'):
+        if name in result:
+            lines.append(f'{name}: {float(result[name]):.4g}[Hz]')
+    lines.append(f'exchange period: {float(result["exchange period"]):.4g}[s], '
+                 f'stretching share swings by {float(result["exchange depth"]):.3g}')
+    return '\n'.join(lines)
@@ -0,0 +1,206 @@
+"""
+Headless benchmarks for both simulations.
+
+Every case reports its throughput next to an accuracy metric (the energy drift of a short run), so a speedup that
+breaks conservation shows up in the same table. Results are written as JSON, tagged with the git commit, and can be
+compared against a previous run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, 'SpringPendulum'))
+os.environ.setdefault('SIM_RENDER', 'null')  # benchmark the physics, not the display
+LEGACY_MAX_SIZE = 1000  # the original per-object O(N^2) slab functions take minutes per call beyond this
+
+
+def timed(function, min_time=0.5, max_calls=1000):
+    """Calls function until min_time passed (at least once) and returns (calls, seconds)."""
+    calls = 0
+    start = perf_counter()
+    while True:
+        function()
+        calls += 1
+        elapsed = perf_counter() - start
+        if elapsed >= min_time or calls >= max_calls:
+            return calls, elapsed
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# SPRING PENDULUM #
+def pendulum_ensemble(size, integrator):
+    from constants import Constants
+    from ensemble import PendulumEnsemble
+
+    rng = np.random.default_rng(0)
+    weight_pos = np.array([0, -0.55, 0]) + rng.uniform(-0.05, 0.05, (size, 3))
+    return PendulumEnsemble(weight_pos, rng.uniform(-0.3, 0.3, (size, 3)), effective_mass=Constants.effective_mass,
+                            spring_mass=Constants.spring_mass, spring_constant=Constants.k,
+                            equilibrium_length=Constants.spring_equilibrium_length, integrator=integrator)
+
+
+def benchmark_pendulum(sizes, integrators, min_time, duration):
+    from constants import Constants
+
+    dt = {'euler': Constants.DT, 'verlet': Constants.real_dt / 10, 'rk4': Constants.real_dt / 10}
+    results = []
+    for integrator in integrators:
+        for size in sizes:
+            if integrator == 'rk45':
+                def run():
+                    return pendulum_ensemble(size, 'rk45').run(duration, Constants.real_dt / 10, Constants.real_dt)
+
+                calls, seconds = timed(run, min_time)
+                trajectory = run()
+                steps = trajectory.evaluations / 6 * calls
+            else:
+                ensemble = pendulum_ensemble(size, integrator)
+                steps, seconds = timed(lambda: ensemble.kinematics(dt[integrator]), min_time, max_calls=10 ** 6)
+                trajectory = pendulum_ensemble(size, integrator).run(duration, dt[integrator], Constants.real_dt)
+
+            results.append({'suite': 'pendulum', 'case': f'kinematics[{integrator}]', 'size': size,
+                            'dt': trajectory.dt, 'seconds': seconds,
+                            'steps_per_second': steps / seconds,
+                            'pendulum_steps_per_second': steps * size / seconds,
+                            'energy_drift': float(np.max(trajectory.energy_error)),
+                            'energy_drift_duration': duration})
+    return results
+
+
+# CHARGED SLAB #
+def charged_slab(size):
+    import slabChargeDensity as slab_simulation
+
+    slab_simulation.random.seed(0)
+    slab = slab_simulation.ChargedSlab(slab_simulation.vector(0, 0, 0), slab_simulation.vector(1, 1, 1), 100)
+    slab.populateCharges(size)
+    return slab
+
+
+def benchmark_slab(sizes, min_time, drift_steps, drift_seconds):
+    import slabChargeDensity as slab_simulation
+    from slabKernels import coulombSums
+    from slabNeighbours import CellList
+    from slabOctree import THETA, compareWithDirect, octreeSums
+    from slabParallel import ParallelForces
+    from slabTimesteps import BlockTimesteps
+
+    results = []
+    parallelForces = ParallelForces()  # every core, the workers are reused across sizes
+    for size in sizes:
+        slab = charged_slab(size)
+        parallelForces.share(slab.particles)  # where a slab run keeps them, the calls copy nothing
+        charges = slab_simulation.chargeObjects(slab.particles)  # for the original per-object functions
+        pos, charge = slab.particles.pos, slab.particles.charge
+
+        def kinematics():
+            for particle in charges:
+                slab_simulation.kinematics(charges, particle, slab.xBorders, slab.yBorders, slab.zBorders, 1E-6)
+
+        neighbours = CellList()
+
+        def closestDistance():  # what the cell list replaces findMinDist with, the update included
+            neighbours.update(pos)
+            return neighbours.closestDistance()
+
+        cases = {'kinematics': kinematics,
+                 'potentialEnergy': lambda: slab_simulation.potentialEnergy(charges),
+                 'findMinDist': lambda: slab_simulation.findMinDist(charges)} if size <= LEGACY_MAX_SIZE else {}
+        cases.update({'closestDistance': closestDistance,
+                      'coulombSums': lambda: coulombSums(pos, charge),
+                      'parallelCoulombSums': lambda: parallelForces(pos, charge),
+                      'octreeSums': lambda: octreeSums(pos, charge, theta=THETA)})
+        # every pair is evaluated from both ends
+        ordered_pairs = {'kinematics', 'coulombSums', 'parallelCoulombSums', 'octreeSums'}
+        for case, function in cases.items():
+            calls, seconds = timed(function, min_time)
+            results.append({'suite': 'slab', 'case': case, 'size': size, 'seconds': seconds,
+                            'steps_per_second': calls / seconds, 'pair_evaluations_per_second':
+                                calls * size * (size - 1) / (1 if case in ordered_pairs else 2) / seconds})
+        # the octree's accuracy next to its speed (pair evaluations are the equivalent direct ones)
+        results[-1].update(compareWithDirect(pos, charge, theta=THETA, sampleSize=200))
+
+        # the slab is dissipative (the walls absorb energy) so the drift is a regression metric, not zero. The global
+        # step shrinks with the squared closest distance, so the runs are bounded by steps and wall time and compared
+        # by their simulated time per second
+        drift_cases = {'simulationStep': None, 'blockTimesteps': BlockTimesteps()} if drift_steps else {}
+        for case, timesteps in drift_cases.items():
+            slab = charged_slab(size)
+            energies = []
+            start = perf_counter()
+            while len(energies) < drift_steps and perf_counter() - start < drift_seconds:
+                _, Ek, Ep = slab_simulation.simulationStep(slab, timesteps=timesteps)
+                energies.append(Ek + Ep)
+            seconds = perf_counter() - start
+            results.append({'suite': 'slab', 'case': case, 'size': size, 'seconds': seconds,
+                            'steps_per_second': len(energies) / seconds,
+                            'simulated_time_per_second': slab.t / seconds,
+                            'energy_drift': abs(energies[-1] - energies[0]) / abs(energies[0]),
+                            'energy_drift_duration': slab.t})
+    parallelForces.close()
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {(r['suite'], r['case'], r['size']): r for r in json.load(baseline_file)['results']}
+    print(f'\n{"case":<40}{"speedup":>10}{"drift before":>15}{"drift after":>15}')
+    for result in results:
+        before = baseline.get((result['suite'], result['case'], result['size']))
+        if before is None:
+            continue
+        name = f'{result["suite"]}.{result["case"]}[{result["size"]}]'
+        drifts = [f'{r["energy_drift"]:.3e}' if 'energy_drift' in r else '-' for r in (before, result)]
+        print(f'{name:<40}{result["steps_per_second"] / before["steps_per_second"]:>10.2f}'
+              f'{drifts[0]:>15}{drifts[1]:>15}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spring pendulum and charged slab simulations.')
+    parser.add_argument('--suite', choices=['pendulum', 'slab', 'all'], default='all')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='a previous results file to compare against')
+    parser.add_argument('--quick', action='store_true', help='small sizes and short timings, for a smoke test')
+    parser.add_argument('--min-time', type=float, default=None, help='seconds to time each case for')
+    args = parser.parse_args()
+
+    min_time = args.min_time or (0.1 if args.quick else 1.)
+    results = []
+    if args.suite in ('pendulum', 'all'):
+        results += benchmark_pendulum(sizes=[1, 100] if args.quick else [1, 100, 10000],
+                                      integrators=['euler', 'verlet', 'rk4', 'rk45'], min_time=min_time,
+                                      duration=1. if args.quick else 10.)
+    if args.suite in ('slab', 'all'):
+        results += benchmark_slab(sizes=[100] if args.quick else [100, 1000, 10000], min_time=min_time,
+                                  drift_steps=5 if args.quick else 20, drift_seconds=5. if args.quick else 60.)
+
+    for result in results:
+        drift = f', energy drift {result["energy_drift"]:.3e}' if 'energy_drift' in result else ''
+        print(f'{result["suite"]}.{result["case"]}[{result["size"]}]: '
+              f'{result["steps_per_second"]:.4g} steps/s{drift}')
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'machine': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                   'results': results}, output_file, indent=2)
+    print(f'Saved results to {args.output}')
+
+    if args.compare:
+        compare(results, args.compare)
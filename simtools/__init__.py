@@ -0,0 +1 @@
+"""Simulation-agnostic tooling shared by the spring pendulum and the charged slab simulations."""
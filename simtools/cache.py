@@ -0,0 +1,133 @@
+"""
+Content-addressed cache of finished simulation runs.
+
+A run is identified by the sha256 of its parameters (a JSON-able dict of constants, initial conditions, integrator
+settings, seeds and so on) together with a code version, by default the hash of the source files the run imported (see
+imported_sources), so editing the physics invalidates the old results by itself. The run's result, a dict of NumPy
+arrays, numbers and strings, is stored as an .npz file named by that hash. Entries are written to a temporary name and
+renamed into place, so parallel runs can share a cache directory. Loading an entry marks it as recently used; once the
+directory holds more than max_bytes the least recently used entries are deleted.
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def code_version(*paths):
+    """The sha256 of the given source files' contents, in order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def imported_sources(root):
+    """
+    The source files of every module imported so far from the directory root (and below it), sorted, so that
+    code_version(*imported_sources(root)) covers all the code a run has loaded.
+    """
+    root = os.path.join(os.path.abspath(root), '')
+    paths = {os.path.abspath(module.__file__) for module in list(sys.modules.values())
+             if getattr(module, '__file__', None) and module.__file__.endswith('.py')}
+    return sorted(path for path in paths if path.startswith(root))
+
+
+def json_default(value):  # NumPy values in the parameters
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} values cannot be part of a run cache key')
+
+
+def run_key(params, version=''):
+    text = json.dumps({'cache version': CACHE_VERSION, 'code version': version, 'params': params}, sort_keys=True,
+                      default=json_default)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class RunCache:
+    """
+    Finished runs in directory, at most max_bytes of them. Every entry also keeps its parameters as JSON (under
+    '_params') for inspection.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30, version=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, params):
+        return os.path.join(self.directory, f'{run_key(params, self.version)}.npz')
+
+    def load(self, params, required=()):
+        """The stored result of the run, or None if there is none or it lacks one of the required names."""
+        path = self.path(params)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {name: data[name].item() if data[name].ndim == 0 else data[name]
+                          for name in data.files if name != '_params'}
+        except (OSError, ValueError):  # missing, or evicted or overwritten by another process while reading
+            return None
+        if not set(required) <= result.keys():
+            return None
+        try:
+            os.utime(path)  # marks the entry as recently used
+        except OSError:
+            pass
+        return result
+
+    def store(self, params, result):
+        path = self.path(params)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as cache_file:
+            np.savez(cache_file, _params=json.dumps(params, sort_keys=True, default=json_default),
+                     **{name: np.asarray(value) for name, value in result.items()})
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def cached(self, params, compute, required=()):
+        """Loads the run's result, or computes it with compute() and stores it."""
+        result = self.load(params, required)
+        if result is None:
+            result = compute()
+            self.store(params, result)
+        return result
+
+    def entries(self):
+        """(path, size, last use) of every entry, least recently used first."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:  # evicted by another process
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            os.remove(path)
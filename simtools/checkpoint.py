@@ -0,0 +1,50 @@
+"""
+Checkpoints of a simulation's full state.
+
+A checkpoint is a pickled dict of plain values and NumPy arrays (positions, velocities, time, RNG states, export
+cursors and so on, whatever the simulation needs to carry on exactly where it stopped). Files are written to a
+temporary name and renamed over the old checkpoint, so an interrupted save never leaves a broken file behind.
+"""
+import os
+import pickle
+
+CHECKPOINT_VERSION = 1
+
+
+def save_checkpoint(path, simulation, state):
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as checkpoint_file:
+        pickle.dump({'version': CHECKPOINT_VERSION, 'simulation': simulation, 'state': state}, checkpoint_file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path, simulation):
+    with open(path, 'rb') as checkpoint_file:
+        checkpoint = pickle.load(checkpoint_file)
+    if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('simulation') != simulation:
+        raise ValueError(f'{path} is not a version {CHECKPOINT_VERSION} {simulation} checkpoint')
+    return checkpoint['state']
+
+
+class Checkpointer:
+    """Saves state_function() to path every `every` calls of step(). With no path it does nothing."""
+
+    def __init__(self, path, simulation, every=10000):
+        self.path = path
+        self.simulation = simulation
+        self.every = every
+        self.steps = 0
+
+    def step(self, state_function):
+        if self.path is None:
+            return
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.save(state_function())
+
+    def save(self, state):
+        if self.path is not None:
+            save_checkpoint(self.path, self.simulation, state)
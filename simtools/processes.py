@@ -0,0 +1,12 @@
+"""
+Worker processes for the simulations' process pools.
+
+Workers are forked where the platform allows it, which starts them quickly and lets them inherit the imported modules.
+Elsewhere they are spawned, which imports the main script again in every worker, so run with --render null there.
+"""
+import multiprocessing
+
+
+def process_context():
+    """The multiprocessing context to start pool workers with: fork where available, spawn otherwise."""
+    return multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
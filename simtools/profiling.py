@@ -0,0 +1,100 @@
+"""
+Per-phase wall time profiling of a simulation's main loop.
+
+    profiler = Profiler(enabled=True)
+    with profiler.phase('physics'):
+        step()
+
+A disabled profiler hands out one shared do-nothing context manager, so instrumented loops cost next to nothing when
+profiling is off. An enabled profiler accumulates calls and time per phase, prints a summary at exit and can dump
+every phase as a Chrome trace event timeline (open it in chrome://tracing or https://ui.perfetto.dev).
+"""
+import atexit
+import json
+import os
+from time import perf_counter
+
+
+class NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_PHASE = NullPhase()
+
+
+class Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.start, perf_counter())
+        return False
+
+
+class Profiler:
+    def __init__(self, enabled=False, timeline_path=None, max_timeline_events=10 ** 6):
+        self.enabled = False
+        self.timeline_path = None
+        self.max_timeline_events = max_timeline_events
+        self.totals = {}
+        self.calls = {}
+        self.timeline = []
+        self.start = perf_counter()
+        if enabled:
+            self.enable(timeline_path)
+
+    def enable(self, timeline_path=None):
+        if not self.enabled:
+            atexit.register(self.finish)
+        self.enabled = True
+        self.timeline_path = timeline_path
+        self.start = perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def record(self, name, start, end):
+        self.totals[name] = self.totals.get(name, 0.) + end - start
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.timeline_path is not None and len(self.timeline) < self.max_timeline_events:
+            self.timeline.append((name, start, end))
+
+    def report(self):
+        wall_time = perf_counter() - self.start
+        lines = [f'{"phase":<24}{"calls":>12}{"total[s]":>12}{"mean[us]":>12}{"share":>8}']
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            lines.append(f'{name:<24}{self.calls[name]:>12}{total:>12.3f}{total / self.calls[name] * 1E6:>12.1f}'
+                         f'{total / wall_time:>8.1%}')
+        untracked = wall_time - sum(self.totals.values())
+        lines.append(f'{"(untracked)":<24}{"":>12}{untracked:>12.3f}{"":>12}{untracked / wall_time:>8.1%}')
+        lines.append(f'{"wall time":<24}{"":>12}{wall_time:>12.3f}')
+        return '\n'.join(lines)
+
+    def dump_timeline(self, path):
+        events = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                   'ts': (start - self.start) * 1E6, 'dur': (end - start) * 1E6}
+                  for name, start, end in self.timeline]
+        with open(path, 'w') as timeline_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, timeline_file)
+
+    def finish(self):
+        if not self.enabled:
+            return
+        print(self.report())
+        if self.timeline_path is not None:
+            self.dump_timeline(self.timeline_path)
+            print(f'Saved profiling timeline to {self.timeline_path}')
+        self.enabled = False
@@ -0,0 +1,336 @@
+"""
+Render backends.
+
+The simulations draw through a backend instead of star-importing vpython or visual, so batch runs can skip the
+display entirely. Every backend exposes the same names: vector, mag, color, rate, scene, false, true, the 3D objects
+sphere, box, helix, cylinder, the graphs graph, gcurve and the slider widget (None where the library has none).
+point_cloud(radius=...) draws many particles as one object: its update(positions, colors, radii=None) takes (N, 3)
+NumPy arrays and replaces every point at once, instead of one attribute change per particle.
+
+    vpython  - VPython 7 in the browser.
+    visual   - classic VPython 6 (the visual module) in its own window.
+    null     - no imports, objects or throttling. Objects only keep their attributes and rate() returns at once, so
+               the physics runs at full CPU speed.
+    recorder - like null, but every rate() call ends a frame and the attributes that changed since the last frame are
+               recorded together with all graph points. Saved to a pickle at exit ('recorder:path', default
+               render_recording.pkl) and read back with load_recording.
+
+The backend is picked by name, usually through selected_backend, which reads --render NAME from the command line or
+the SIM_RENDER environment variable.
+"""
+import atexit
+import math
+import numbers
+import os
+import pickle
+import sys
+
+RENDER_ENVIRONMENT_VARIABLE = 'SIM_RENDER'
+BACKENDS = ('vpython', 'visual', 'null', 'recorder')
+
+
+# HEADLESS VECTOR #
+class Vector:
+    """A small pure Python 3D vector with the parts of vpython's vector API the simulations use."""
+    __slots__ = ('x', 'y', 'z')
+
+    def __init__(self, x=0., y=0., z=0.):
+        if not isinstance(x, numbers.Real):  # vector(other) or vector((x, y, z))
+            x, y, z = x
+        self.x, self.y, self.z = float(x), float(y), float(z)
+
+    def __add__(self, other):
+        return Vector(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Vector(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __mul__(self, scalar):
+        return Vector(self.x * scalar, self.y * scalar, self.z * scalar)
+
+    def __rmul__(self, scalar):
+        return Vector(scalar * self.x, scalar * self.y, scalar * self.z)
+
+    def __truediv__(self, scalar):
+        return Vector(self.x / scalar, self.y / scalar, self.z / scalar)
+
+    def __neg__(self):
+        return Vector(-self.x, -self.y, -self.z)
+
+    def __pos__(self):
+        return Vector(self.x, self.y, self.z)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and (self.x, self.y, self.z) == (other.x, other.y, other.z)
+
+    def __iter__(self):
+        return iter((self.x, self.y, self.z))
+
+    def __getitem__(self, i):
+        return (self.x, self.y, self.z)[i]
+
+    def __repr__(self):
+        return f'<{self.x:.6g}, {self.y:.6g}, {self.z:.6g}>'
+
+    @property
+    def mag(self):
+        return math.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
+
+    @property
+    def mag2(self):
+        return self.x ** 2 + self.y ** 2 + self.z ** 2
+
+    @property
+    def value(self):
+        return [self.x, self.y, self.z]
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self, other):
+        return Vector(self.y * other.z - self.z * other.y, self.z * other.x - self.x * other.z,
+                      self.x * other.y - self.y * other.x)
+
+    def norm(self):
+        return self / self.mag
+
+    hat = property(norm)
+
+
+def vector_mag(vector):
+    return vector.mag
+
+
+class Colors:
+    red = Vector(1, 0, 0)
+    green = Vector(0, 1, 0)
+    blue = Vector(0, 0, 1)
+    yellow = Vector(1, 1, 0)
+    cyan = Vector(0, 1, 1)
+    magenta = Vector(1, 0, 1)
+    orange = Vector(1, 0.6, 0)
+    purple = Vector(0.4, 0.2, 0.6)
+    black = Vector(0, 0, 0)
+    white = Vector(1, 1, 1)
+
+    @staticmethod
+    def gray(luminance):
+        return Vector(luminance, luminance, luminance)
+
+
+# HEADLESS OBJECTS #
+class NullObject:
+    """Stands in for a 3D object, scene or graph: it keeps whatever attributes it is given and nothing else."""
+
+    def __init__(self, kind='object', backend=None, **attributes):
+        self.kind = kind
+        self.visible = True
+        self.__dict__.update(attributes)
+        if backend is not None:
+            backend.track(self)
+
+
+class NullCurve(NullObject):
+    def plot(self, *points, pos=None):
+        pass
+
+    def delete(self):
+        pass
+
+
+class NullPointCloud(NullObject):
+    """Keeps the points of the last update, as lists of tuples so the recorder can compare and save them."""
+
+    def update(self, positions, colors, radii=None):
+        self.pos = [tuple(position) for position in positions.tolist()]
+        self.color = [tuple(color) for color in colors.tolist()]
+        if radii is not None:
+            self.radius = radii.tolist()
+
+
+class RecordingCurve(NullCurve):
+    def plot(self, *points, pos=None):
+        if pos is not None:
+            points = [pos]
+        elif len(points) == 1 and isinstance(points[0], list):
+            points = points[0]
+        self.backend.plots.append((self.backend.frame, self.backend.ids[id(self)], [tuple(p) for p in points]))
+
+
+class Backend:
+    """The names a simulation draws with, bound to one rendering implementation."""
+
+    def __init__(self, name, vector, mag, color, rate, scene, sphere, box, helix, cylinder, graph, gcurve,
+                 points=None, slider=None, point_cloud=None):
+        self.name = name
+        self.vector = vector
+        self.mag = mag
+        self.color = color
+        self.rate = rate
+        self.scene = scene
+        self.sphere = sphere
+        self.box = box
+        self.helix = helix
+        self.cylinder = cylinder
+        self.graph = graph
+        self.gcurve = gcurve
+        self.points = points
+        self.slider = slider
+        self.point_cloud = point_cloud
+        self.true = True
+        self.false = False
+
+    @property
+    def headless(self):
+        return self.name in ('null', 'recorder')
+
+
+class NullBackend(Backend):
+    def __init__(self, name='null'):
+        def make(kind, object_type=NullObject):
+            return lambda **attributes: object_type(kind, self.tracker, **attributes)
+
+        self.tracker = None
+        super().__init__(name, Vector, vector_mag, Colors, rate=lambda frequency: None, scene=NullObject('scene'),
+                         sphere=make('sphere'), box=make('box'), helix=make('helix'), cylinder=make('cylinder'),
+                         graph=make('graph'), gcurve=make('gcurve', self.curve_type()), points=make('points'),
+                         slider=make('slider'), point_cloud=make('point_cloud', NullPointCloud))
+
+    @staticmethod
+    def curve_type():
+        return NullCurve
+
+
+class RecorderBackend(NullBackend):
+    TRACKED_ATTRIBUTES = ('pos', 'axis', 'size', 'radius', 'color', 'visible', 'opacity')
+
+    def __init__(self, output='render_recording.pkl'):
+        self.output = output
+        self.objects = []  # (kind, attributes at creation)
+        self.instances = []
+        self.ids = {}
+        self.last_state = []
+        self.changes = []  # (frame, object id, attribute, value)
+        self.plots = []  # (frame, curve id, points)
+        self.frame = 0
+        super().__init__('recorder')
+        self.tracker = self
+        self.rate = self.end_frame
+        atexit.register(self.save)
+
+    @staticmethod
+    def curve_type():
+        return RecordingCurve
+
+    @staticmethod
+    def snapshot(value):
+        return tuple(value) if isinstance(value, Vector) else value
+
+    def track(self, instance):
+        instance.backend = self
+        self.ids[id(instance)] = len(self.instances)
+        self.instances.append(instance)
+        state = {name: self.snapshot(getattr(instance, name)) for name in self.TRACKED_ATTRIBUTES
+                 if hasattr(instance, name)}
+        self.objects.append((instance.kind, dict(state)))
+        self.last_state.append(state)
+
+    def end_frame(self, frequency=None):
+        for object_id, (instance, last_state) in enumerate(zip(self.instances, self.last_state)):
+            for name in self.TRACKED_ATTRIBUTES:
+                if hasattr(instance, name):
+                    value = self.snapshot(getattr(instance, name))
+                    if last_state.get(name) != value:
+                        last_state[name] = value
+                        self.changes.append((self.frame, object_id, name, value))
+        self.frame += 1
+
+    def save(self, path=None):
+        path = path or self.output
+        with open(path, 'wb') as recording_file:
+            pickle.dump({'frames': self.frame, 'objects': self.objects, 'changes': self.changes,
+                         'plots': self.plots}, recording_file, protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+
+def load_recording(path):
+    with open(path, 'rb') as recording_file:
+        return pickle.load(recording_file)
+
+
+# DISPLAY BACKENDS #
+class VpythonPointCloud:
+    """A vpython.points object in world units, all of whose points are replaced with one clear and one append."""
+
+    def __init__(self, vpython, radius=0.01, **attributes):
+        self.vpython = vpython
+        self.radius = radius
+        self.points = vpython.points(radius=radius, size_units='world', **attributes)
+
+    def update(self, positions, colors, radii=None):
+        vector = self.vpython.vector
+        radii = [self.radius] * len(positions) if radii is None else radii.tolist()
+        self.points.clear()
+        if len(positions):
+            self.points.append([{'pos': vector(*position), 'color': vector(*color), 'radius': radius}
+                                for position, color, radius in zip(positions.tolist(), colors.tolist(), radii)])
+
+
+class VisualPointCloud:
+    """A classic visual.points object, whose pos and color arrays are assigned whole. One size for every point."""
+
+    def __init__(self, visual, radius=0.01, **attributes):
+        self.cloud = visual.points(size=2 * radius, size_units='world', shape='round', **attributes)
+
+    def update(self, positions, colors, radii=None):
+        self.cloud.pos = positions
+        self.cloud.color = colors
+        if radii is not None and len(radii):
+            self.cloud.size = 2 * float(radii.mean())
+
+
+def vpython_backend():
+    import vpython
+
+    def graph(x=None, y=None, **options):  # vpython places graphs itself
+        return vpython.graph(**options)
+
+    return Backend('vpython', vpython.vector, vpython.mag, vpython.color, vpython.rate, vpython.scene,
+                   vpython.sphere, vpython.box, vpython.helix, vpython.cylinder, graph, vpython.gcurve,
+                   vpython.points, vpython.slider, lambda **attributes: VpythonPointCloud(vpython, **attributes))
+
+
+def visual_backend():
+    import visual
+    import visual.graph
+
+    def graph(**options):
+        return visual.graph.gdisplay(**options)
+
+    return Backend('visual', visual.vector, visual.mag, visual.color, visual.rate, visual.scene, visual.sphere,
+                   visual.box, visual.helix, visual.cylinder, graph, visual.graph.gcurve, visual.points,
+                   point_cloud=lambda **attributes: VisualPointCloud(visual, **attributes))
+
+
+def load_backend(name):
+    """Builds a backend from its name; 'recorder:path' sets the recorder's output file."""
+    name, _, option = name.partition(':')
+    if name == 'vpython':
+        return vpython_backend()
+    if name == 'visual':
+        return visual_backend()
+    if name == 'null':
+        return NullBackend()
+    if name == 'recorder':
+        return RecorderBackend(option) if option else RecorderBackend()
+    raise ValueError(f'Unknown render backend {name!r}, choose from {", ".join(BACKENDS)}')
+
+
+def selected_backend(default):
+    """The backend name from --render NAME (or --render=NAME) on the command line, then $SIM_RENDER, then default."""
+    for i, argument in enumerate(sys.argv):
+        if argument == '--render' and i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+        if argument.startswith('--render='):
+            return argument.split('=', 1)[1]
+    return os.environ.get(RENDER_ENVIRONMENT_VARIABLE, default)
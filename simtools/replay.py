@@ -0,0 +1,75 @@
+"""
+Playback of recorded trajectories.
+
+A run is recorded once (typically headless, at full resolution) with a raw trajectory writer from
+simtools.trajectory, whose first column is the simulation time 't'. TrajectoryPlayer then walks the memory-mapped file
+at any speed, so the costly computation happens only once and the scene and graphs can be replayed, sought and
+scrubbed as often as needed. Only the rows actually shown are read from disk.
+"""
+import numpy as np
+
+from simtools.trajectory import load_trajectory
+
+
+class TrajectoryPlayer:
+    """
+    Yields the rows to display, frame by frame.
+
+    Each frame advances the playback time by speed / fps seconds of simulation time, where fps is the rate the caller
+    shows frames at (with the render backend's rate). With speed=None every row is shown. decimate keeps only every
+    n-th row, for very long or many-particle recordings. seek() (or setting progress, 0 to 1) jumps anywhere, also
+    while playing; the next frame is then flagged as a jump so the caller can clear trails and graphs.
+    """
+
+    def __init__(self, path, speed=1., fps=60, decimate=1, start=None, end=None):
+        self.rows, self.columns, self.metadata = load_trajectory(path)
+        if not len(self.rows):
+            raise ValueError(f'{path} has no recorded rows')
+        self.times = np.asarray(self.rows[:, self.columns.index('t')])
+        self.speed = speed
+        self.fps = fps
+        self.decimate = max(1, int(decimate))
+        self.start = self.times[0] if start is None else start
+        self.end = self.times[-1] if end is None else min(end, self.times[-1])
+        self.index = 0
+        self.playback_time = self.start
+        self.__move(self.start)
+        self.jumped = False
+
+    def column(self, name):
+        return self.columns.index(name)
+
+    def __index_at(self, t):
+        index = int(np.searchsorted(self.times, t, side='right')) - 1
+        return max(0, index - index % self.decimate)
+
+    def __move(self, t):
+        self.playback_time = min(max(t, self.start), self.end)
+        self.index = self.__index_at(self.playback_time)
+
+    def seek(self, t):
+        self.__move(t)
+        self.jumped = True
+
+    @property
+    def progress(self):
+        return (self.playback_time - self.start) / (self.end - self.start) if self.end > self.start else 1.
+
+    @progress.setter
+    def progress(self, fraction):
+        self.seek(self.start + fraction * (self.end - self.start))
+
+    def frames(self):
+        """
+        Yields (index, row, jumped) once per frame until the end time is reached. At slow speeds consecutive frames can
+        show the same row.
+        """
+        while True:
+            jumped, self.jumped = self.jumped, False
+            yield self.index, np.asarray(self.rows[self.index]), jumped
+            if self.playback_time >= self.end:
+                return
+            if self.speed is None:
+                self.__move(self.times[min(self.index + self.decimate, len(self.times) - 1)])
+            else:
+                self.__move(self.playback_time + self.speed / self.fps)
@@ -0,0 +1,141 @@
+"""
+Streaming trajectory files.
+
+A trajectory is a table of float rows (one per sample) with named columns and a metadata dict for the run's constants.
+Writers keep one preallocated chunk of rows in memory and append it to disk whenever it fills, so memory stays
+constant however long the run is. Two formats are supported:
+    .csv - plain CSV, metadata as leading '# name: value' lines, then a header line with the column names.
+    anything else - raw little-endian float64 rows (memory-mappable) plus a '<path>.json' header with the columns,
+    row count and metadata.
+"""
+import json
+import os
+
+import numpy as np
+
+RAW_DTYPE = '<f8'
+
+
+def header_path(path):
+    return f'{path}.json'
+
+
+class TrajectoryWriter:
+    def __init__(self, path, columns, metadata=None, chunk_size=4096):
+        self.path = path
+        self.columns = list(columns)
+        self.metadata = dict(metadata or {})
+        self.chunk = np.empty((chunk_size, len(self.columns)))
+        self.buffered = 0
+        self.rows_written = 0
+        self.file = None
+
+    def _open(self, mode, resume):
+        """Opens the file, or truncates it back to a cursor and appends to it. Returns whether it resumed."""
+        if resume is None:
+            self.file = open(self.path, mode)
+            return False
+        os.truncate(self.path, resume['bytes'])  # drops rows written after the checkpoint
+        self.file = open(self.path, mode.replace('w', 'a'))
+        self.rows_written = resume['rows']
+        return True
+
+    def cursor(self):
+        self.flush()
+        return {'rows': self.rows_written, 'bytes': os.path.getsize(self.path)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, *values):
+        self.chunk[self.buffered] = values
+        self.buffered += 1
+        if self.buffered == len(self.chunk):
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in np.atleast_2d(rows):
+            self.write(*row)
+
+    def flush(self):
+        if self.buffered:
+            self._write_chunk(self.chunk[:self.buffered])
+            self.rows_written += self.buffered
+            self.buffered = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            self.flush()
+            self.file.close()
+            print(f'Saved {self.rows_written} rows to {self.path}')
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError
+
+
+class CsvTrajectoryWriter(TrajectoryWriter):
+    def __init__(self, path, columns, metadata=None, chunk_size=4096, resume=None):
+        super().__init__(path, columns, metadata, chunk_size)
+        if self._open('w', resume):
+            return
+        for name, value in self.metadata.items():
+            self.file.write(f'# {name}: {json.dumps(value)}\n')
+        self.file.write(','.join(self.columns) + '\n')
+
+    def _write_chunk(self, rows):
+        # repr is the shortest string that reads back to the same float
+        self.file.write(''.join(','.join(map(repr, row)) + '\n' for row in rows.tolist()))
+
+
+class RawTrajectoryWriter(TrajectoryWriter):
+    def __init__(self, path, columns, metadata=None, chunk_size=4096, resume=None):
+        super().__init__(path, columns, metadata, chunk_size)
+        self._open('wb', resume)
+        self.write_header()
+
+    def _write_chunk(self, rows):
+        self.file.write(rows.astype(RAW_DTYPE).tobytes())
+
+    def flush(self):
+        super().flush()
+        self.write_header()
+
+    def write_header(self):
+        header = {'columns': self.columns, 'dtype': RAW_DTYPE, 'rows': self.rows_written, 'metadata': self.metadata}
+        with open(header_path(self.path) + '.tmp', 'w') as header_file:
+            json.dump(header, header_file, indent=2)
+        os.replace(header_path(self.path) + '.tmp', header_path(self.path))
+
+
+def open_trajectory_writer(path, columns, metadata=None, chunk_size=4096, resume=None) -> TrajectoryWriter:
+    writer = CsvTrajectoryWriter if path.lower().endswith('.csv') else RawTrajectoryWriter
+    return writer(path, columns, metadata, chunk_size, resume)
+
+
+def load_trajectory(path):
+    """
+    Returns (rows, columns, metadata). For raw files rows is a read-only np.memmap of shape (samples, columns), so
+    huge trajectories can be sliced without loading them.
+    """
+    if path.lower().endswith('.csv'):
+        metadata = {}
+        with open(path) as csv_file:
+            line = csv_file.readline()
+            while line.startswith('#'):
+                name, value = line[1:].split(':', 1)
+                metadata[name.strip()] = json.loads(value)
+                line = csv_file.readline()
+            columns = line.strip().split(',')
+            rows = np.loadtxt(csv_file, delimiter=',', ndmin=2).reshape(-1, len(columns))
+        return rows, columns, metadata
+
+    with open(header_path(path)) as header_file:
+        header = json.load(header_file)
+    if header['rows'] == 0:
+        return np.empty((0, len(header['columns']))), header['columns'], header['metadata']
+    rows = np.memmap(path, dtype=header['dtype'], mode='r', shape=(header['rows'], len(header['columns'])))
+    return rows, header['columns'], header['metadata']
@@ -1,20 +1,31 @@
-from visual import *
-from visual.graph import *
+import argparse
+from functools import partial
+
+import numpy as np
+from numpy import random
+
+from simtools.checkpoint import Checkpointer, load_checkpoint
+from simtools.profiling import Profiler
+from simtools.render import BACKENDS, load_backend, selected_backend
+from simtools.replay import TrajectoryPlayer
+from simtools.trajectory import open_trajectory_writer
+from slabHistograms import ChargeHistograms
+from slabKernels import coulombSums, kickDrift
+from slabNeighbours import CellList
+from slabOctree import THETA, octreeSums
+from slabParallel import ParallelForces
+from slabParticles import ParticleStore, ParticleView
+from slabTimesteps import BlockTimesteps
+
+render = load_backend(selected_backend('visual'))  # picked before anything is drawn, see simtools.render
+vector, mag, color, rate, scene = render.vector, render.mag, render.color, render.rate, render.scene
+sphere, box, graph, gcurve = render.sphere, render.box, render.graph, render.gcurve
+
+profiler = Profiler()  # enabled with --profile
 
 # Program forked off of ElectricTest for base functionality
 # Test program to find out slab's charge density and distribution.
 
-scene.width = scene.height = 800
-
-gdisplay(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ek')
-energyK = gcurve(color=color.cyan)
-
-gdisplay(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ep')
-energyP = gcurve(color=color.magenta)
-
-gdisplay(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Etot')
-energyTot = gcurve(color=color.green)
-
 
 ###OBJECT CLASSES###
 class PhysicsObject:  # main class for all physical objects
@@ -34,9 +45,10 @@ class PhysicsObject:  # main class for all physical objects
 
 
 class ElectricCharge(PhysicsObject):  # main class for electric charges
-    def __init__(self, Radius, charge, position):
+    def __init__(self, Radius, charge, position, particleId=None):
         self.obj = sphere(pos=position, radius=Radius, make_trail=False)
         self.charge = charge
+        self.id = particleId
         self.initNullParams()
 
         if self.charge < 0:
@@ -54,35 +66,49 @@ class ChargedSlab(ElectricCharge):
         self.zBorders = [center.z - self.obj.size.z / 2, center.z + self.obj.size.z / 2]
         self.volume = (self.xBorders[1] - self.xBorders[0]) * (self.yBorders[1] - self.yBorders[0]) * (
             self.zBorders[1] - self.zBorders[0])
-        self.slabParticles = []
-
-    def populateCharges(self, numOfCharges):
+        self.particles = ParticleStore()
+        self.t = 0
+        self.mergeHistory = []  # (t, id of the surviving particle, id of the merged particle)
+        self.neighbours = CellList(minCellSize=mergeDistance)  # cells never smaller than the merge distance
+        self.forcesAt = None  # (t, merges) of the positions particles.acc belongs to, see simulationStep
+
+    def populateCharges(self, numOfCharges, distribution='90/10', rng=None):
+        # distribution is one of chargeDistributions, rng a numpy Generator (the global numpy.random by default)
+        rng = random if rng is None else rng
+        chargeSign = chargeDistributions[distribution]
         chargeNum = 0
 
-        xPos = random.sample(numOfCharges)  # randomize position of charges. Non repeating to prevent intersection
-        yPos = random.sample(numOfCharges)
-        zPos = random.sample(numOfCharges)
+        xPos = rng.random(numOfCharges)  # randomize position of charges. Non repeating to prevent intersection
+        yPos = rng.random(numOfCharges)
+        zPos = rng.random(numOfCharges)
 
+        pos, charge = [], []
         while chargeNum < numOfCharges:
-            # various distributions of positive and negative charges
-            # chargeSign = random.choice([-1, 1, 1, 1])  # 75% positive 25% negative
-            chargeSign = random.choice([-1, 1, 1, 1, 1, 1, 1, 1, 1, 1])  # 90% positive 10% negative
-            # chargeSign = 1 if chargeNum % 2 == 0 else -1  # equally distribute positive and negative charges
-            # chargeSign = 1  # all positive
-
-            chargePos = vector(xPos[chargeNum] * (self.xBorders[1] - self.xBorders[0]) * random.choice([-1, 1]),
-                               yPos[chargeNum] * (self.yBorders[1] - self.yBorders[0]) * random.choice([-1, 1]),
-                               zPos[chargeNum] * (self.zBorders[1] - self.zBorders[0]) * random.choice(
-                                   [-1, 1])) * 0.5 + self.obj.pos
-
-            self.slabParticles.append(
-                ElectricCharge(2 * self.volume / numOfCharges, chargeSign * 1E-7 * self.charge / self.volume,
-                               chargePos))
+            sign = chargeSign(rng, chargeNum)
+            pos.append([xPos[chargeNum] * (self.xBorders[1] - self.xBorders[0]) * rng.choice([-1, 1]),
+                        yPos[chargeNum] * (self.yBorders[1] - self.yBorders[0]) * rng.choice([-1, 1]),
+                        zPos[chargeNum] * (self.zBorders[1] - self.zBorders[0]) * rng.choice([-1, 1])])
+            charge.append(sign * 1E-7 * self.charge / self.volume)
             chargeNum += 1
 
+        self.particles = ParticleStore(np.reshape(pos, (-1, 3)) * 0.5 + vectorTuple(self.obj.pos), charge,
+                                       np.ones(numOfCharges), np.full(numOfCharges, 2 * self.volume / numOfCharges))
+        self.forcesAt = None
+
+    def getState(self):
+        return {'t': self.t, 'mergeHistory': list(self.mergeHistory), 'particles': self.particles.getState()}
+
+    def setState(self, state):
+        self.t = state['t']
+        self.mergeHistory = list(state['mergeHistory'])
+        particles = state['particles']
+        if isinstance(particles, list):  # a checkpoint from before the particle store, one dict per particle
+            keys = {'pos': 'pos', 'vel': 'v', 'acc': 'a', 'mass': 'm', 'charge': 'charge', 'radius': 'radius',
+                    'storedEnergy': 'storedEnergy', 'ids': 'id'}
+            particles = {name: [particle[key] for particle in particles] for name, key in keys.items()}
+        self.particles = ParticleStore.fromState(particles)
+        self.forcesAt = None
 
-#####STARTING PARAMETERS######
-t = 0
 
 ####CONSTANTS#####
 kCoulomb = 8.987551E+9
@@ -90,9 +116,20 @@ xMaxRange = [-5, 5]
 yMaxRange = [-5, 5]
 zMaxRange = [-5, 5]
 springConst = 1E-20
+mergeDistance = 0.0075  # opposite charges closer than this merge
+chargeDistributions = {  # various distributions of positive and negative charges, the sign of charge chargeNum
+    '90/10': lambda rng, chargeNum: rng.choice([-1, 1, 1, 1, 1, 1, 1, 1, 1, 1]),  # 90% positive 10% negative
+    '75/25': lambda rng, chargeNum: rng.choice([-1, 1, 1, 1]),  # 75% positive 25% negative
+    'alternating': lambda rng, chargeNum: 1 if chargeNum % 2 == 0 else -1,  # equally distribute positive and negative
+    'positive': lambda rng, chargeNum: 1,  # all positive
+}
 
 
 ###FUNCTIONS####
+def vectorTuple(vec):
+    return vec.x, vec.y, vec.z
+
+
 def kinematics(chargeList, obj, xRange, yRange, zRange, dt=0):
     force = vector(0, 0, 0)
     for chargeObj in chargeList:
@@ -212,73 +249,288 @@ def findMinDist(objList):
     return minDist
 
 
-def mergeCharges(particle1, particle2):
-    particle1.storedEnergy = kCoulomb * particle1.charge * particle2.charge / mag(particle1.obj.pos - particle2.obj.pos)
-
-    particle1.charge += particle2.charge
-
-    if particle1.charge > 0:
-        particle1.obj.color = color.red
-    elif particle1.charge < 0:
-        particle1.obj.color = color.blue
-    else:
-        particle1.obj.color = color.gray(0.5)
-
-    particle1.m += particle2.m
-    particle1.obj.radius = (particle1.obj.radius ** 3 + particle2.obj.radius ** 3) ** 0.333333
+def mergeCharges(particles, first, second):  # merges every particle in second into the one in first, all at once
+    # the survivors keep the pair's potential energy, and the masses they had before the merge weight the averages
+    m1, m2 = particles.mass[first, None], particles.mass[second, None]
+    distance = np.linalg.norm(particles.pos[first] - particles.pos[second], axis=1)
+    particles.storedEnergy[first] += particles.storedEnergy[second] + \
+        kCoulomb * particles.charge[first] * particles.charge[second] / distance
+    particles.charge[first] += particles.charge[second]
+    particles.radius[first] = np.cbrt(particles.radius[first] ** 3 + particles.radius[second] ** 3)
     # calculating new radius based on sum of volume's
-    particle1.v = (particle1.m * particle1.v + particle2.m * particle2.v) / (particle1.m + particle2.m)
-    particle1.obj.pos = (particle1.m * particle1.obj.pos + particle2.m * particle2.obj.pos) / (
-        particle1.m + particle2.m)
-    particle1.nextPos = (particle1.m * particle1.nextPos + particle2.m * particle2.nextPos) / (
-        particle1.m + particle2.m)
-
-    # weighted average
-
-
-def findParticlesToMerge(chargeList):
-    i = 0
-    while i < len(chargeList):
-        j = i + 1
-        if chargeList[i].charge == 0:
-            i += 1
+    particles.vel[first] = (m1 * particles.vel[first] + m2 * particles.vel[second]) / (m1 + m2)
+    particles.pos[first] = (m1 * particles.pos[first] + m2 * particles.pos[second]) / (m1 + m2)
+    particles.mass[first] += particles.mass[second]
+    particles.remove(second)
+
+
+def findParticlesToMerge(particles, mergeHistory=None, t=0, neighbours=None):
+    # merges opposite charges closer than mergeDistance, looking only at the pairs the cell list finds. Each particle
+    # takes part in at most one merge per call, anything still close enough merges on the next one.
+    neighbours = neighbours or CellList(minCellSize=mergeDistance)
+    neighbours.update(particles.pos)
+    i, j, _ = neighbours.pairsWithin(mergeDistance)
+    opposite = particles.charge[i] * particles.charge[j] < 0
+    i, j = i[opposite], j[opposite]
+    order = np.lexsort((j, i))  # the order the pairwise scan would find them in
+
+    first, second, merged = [], [], set()
+    for survivor, absorbed in zip(i[order].tolist(), j[order].tolist()):
+        if survivor in merged or absorbed in merged:
             continue
-
-        while j < len(chargeList):
-            if chargeList[i].charge * chargeList[j].charge >= 0:
-                j += 1
-                continue
-
-            r_mag = mag(chargeList[i].obj.pos - chargeList[j].obj.pos)
-
-            if r_mag < 0.0075:
-                mergeCharges(chargeList[i], chargeList[j])
-                chargeList[j].obj.visible = false
-                del chargeList[j]
-
-            j += 1
-        i += 1
-
-
-slab = ChargedSlab(vector(0, 0, 0), vector(1, 1, 1), 100)
-slab.populateCharges(100)
-
-while t < 1000:
-    rate(10000000)
-
-    dt = min(findMinDist(slab.slabParticles) ** 2, 0.003)
-
-    t += dt
-
-    Ek = 0
-    for particle in slab.slabParticles:
-        kinematics(slab.slabParticles, particle, slab.xBorders, slab.yBorders, slab.zBorders, dt)
-        updatePos(slab.slabParticles)
-        Ek += 0.5 * particle.m * mag(particle.v) ** 2
-    Ep = potentialEnergy(slab.slabParticles)
-
-    findParticlesToMerge(slab.slabParticles)
-
-    energyP.plot(pos=(t, Ep))
-    energyK.plot(pos=(t, Ek))
-    energyTot.plot(pos=(t, Ek + Ep))
+        first.append(survivor)
+        second.append(absorbed)
+        merged.update((survivor, absorbed))
+    if first:
+        if mergeHistory is not None:
+            mergeHistory.extend((t, survivor, absorbed) for survivor, absorbed in
+                                zip(particles.ids[first].tolist(), particles.ids[second].tolist()))
+        mergeCharges(particles, np.array(first), np.array(second))
+
+
+def recordColumns(numOfCharges):  # t, energies, then x, y, z, charge and radius of every particle id
+    return ['t', 'Ek', 'Ep'] + [f'{name}{particleId}' for particleId in range(numOfCharges)
+                                for name in ('x', 'y', 'z', 'q', 'r')]
+
+
+def recordRow(slab, numOfCharges, Ek, Ep):  # merged away particles are left as NaN
+    row = np.full(3 + 5 * numOfCharges, np.nan)
+    row[:3] = slab.t, Ek, Ep
+    particles = slab.particles
+    row[3:].reshape(-1, 5)[particles.ids] = np.column_stack([particles.pos, particles.charge, particles.radius])
+    return row
+
+
+def replaySlab(player, fps=60, points=False):  # draws a recorded run instead of simulating it
+    view = ParticleView(render, points=points)
+
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ek')
+    energyK = gcurve(color=color.cyan)
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ep')
+    energyP = gcurve(color=color.magenta)
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Etot')
+    energyTot = gcurve(color=color.green)
+
+    def scrub(slider):
+        player.progress = slider.value
+
+    slider = render.slider(bind=scrub, min=0, max=1, value=0, length=800) if render.slider is not None else None
+    for _, row, jumped in player.frames():
+        rate(fps)
+        if jumped:  # don't connect the graphs across the jump
+            for curve in (energyK, energyP, energyTot):
+                if hasattr(curve, 'delete'):
+                    curve.delete()
+
+        t, Ek, Ep = row[:3]
+        recorded = row[3:].reshape(-1, 5)  # x, y, z, charge and radius of every id, NaN once merged away
+        ids = np.flatnonzero(~np.isnan(recorded[:, 0]))
+        view.sync(ParticleStore(recorded[ids, :3], recorded[ids, 3], np.ones(len(ids)), recorded[ids, 4], ids),
+                  force=True)
+
+        energyP.plot(pos=(t, Ep))
+        energyK.plot(pos=(t, Ek))
+        energyTot.plot(pos=(t, Ek + Ep))
+        if slider is not None:
+            slider.value = player.progress
+
+
+def chargeObjects(particles):  # the store as ElectricCharge objects, for kinematics and the other per-object functions
+    chargeList = []
+    for particleId, pos, v, m, charge, radius, storedEnergy in zip(
+            particles.ids.tolist(), particles.pos.tolist(), particles.vel.tolist(), particles.mass.tolist(),
+            particles.charge.tolist(), particles.radius.tolist(), particles.storedEnergy.tolist()):
+        particle = ElectricCharge(radius, charge, vector(*pos), particleId)
+        particle.v = vector(*v)
+        particle.m = m
+        particle.storedEnergy = storedEnergy
+        chargeList.append(particle)
+    return chargeList
+
+
+def slabPotentialEnergy(slab):  # the same as potentialEnergy, from the particle store
+    _, pairPotential = coulombSums(slab.particles.pos, slab.particles.charge)
+    return kCoulomb * pairPotential + float(slab.particles.storedEnergy.sum())
+
+
+def simulationStep(slab, forces=coulombSums, timesteps=None):  # advances all of the slab's charges and slab.t
+    # returns dt, and Ek and Ep of the positions and velocities the step ends at. forces(pos, charge, targets) is
+    # coulombSums or octreeSums (field, pair potential). With a BlockTimesteps every particle takes its own
+    # power-of-two fraction of its dtMax, otherwise all of them take the same dt, set by the closest pair.
+    particles = slab.particles
+    borders = (slab.xBorders, slab.yBorders, slab.zBorders)
+
+    if timesteps is None:
+        with profiler.phase('neighbours'):
+            slab.neighbours.update(particles.pos)
+            dt = min(slab.neighbours.closestDistance() ** 2, 0.003)
+        accelerationScale = kCoulomb * (particles.charge / particles.mass)[:, None]
+        if slab.forcesAt != (slab.t, len(slab.mergeHistory)):  # the first step, or charges merged since the last
+            with profiler.phase('coulomb'):
+                field, _ = forces(particles.pos, particles.charge)
+                particles.acc[:] = accelerationScale * field
+        with profiler.phase('kinematics'):
+            particles.pos[:] = kickDrift(particles.pos, particles.vel, particles.acc, dt, borders)
+        with profiler.phase('coulomb'):  # the potential of the new positions, their forces kick the next step
+            field, pairPotential = forces(particles.pos, particles.charge)
+            particles.acc[:] = accelerationScale * field
+        slab.forcesAt = (slab.t + dt, len(slab.mergeHistory))
+    else:
+        dt = timesteps.dtMax
+        synchronized = timesteps.synchronizedAt == (slab.t, len(slab.mergeHistory))  # nothing moved or merged since
+        with profiler.phase('blockTimesteps'):  # the potential of the positions the step ends at
+            particles.acc[:], pairPotential = timesteps.step(particles.pos, particles.vel,
+                                                             particles.acc if synchronized else None, particles.charge,
+                                                             kCoulomb * particles.charge / particles.mass, borders,
+                                                             forces)
+        timesteps.synchronizedAt = (slab.t + dt, len(slab.mergeHistory))
+    slab.t += dt
+
+    Ek = particles.kineticEnergy()
+    Ep = kCoulomb * pairPotential + float(particles.storedEnergy.sum())
+
+    with profiler.phase('findParticlesToMerge'):
+        findParticlesToMerge(particles, slab.mergeHistory, slab.t, slab.neighbours)
+    return dt, Ek, Ep
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulates the charge distribution of a charged slab.")
+    parser.add_argument('--checkpoint', help='periodically save the full state to this file')
+    parser.add_argument('--checkpoint-every', type=int, default=100, help='steps between checkpoints')
+    parser.add_argument('--resume', help='continue from a checkpoint file')
+    parser.add_argument('--profile', action='store_true', help='time each phase of the main loop, report at exit')
+    parser.add_argument('--profile-timeline', help='also dump every timed phase to this JSON trace file')
+    parser.add_argument('--render', default='visual', help='render backend, one of ' + ', '.join(BACKENDS) +
+                                                           ' (recorder:path sets the recording file)')
+    parser.add_argument('--draw', choices=['spheres', 'points'], default='spheres',
+                        help='a sphere per charge, or all charges as one point cloud (for thousands of charges)')
+    parser.add_argument('--max-fps', type=float, default=60, help='the most frames a second the charges are drawn at')
+    parser.add_argument('--solver', choices=['direct', 'octree'], default='direct',
+                        help='all pairs, or the Barnes-Hut octree for large charge counts')
+    parser.add_argument('--theta', type=float, default=THETA, help='the octree opening angle, 0 is exact')
+    parser.add_argument('--distribution', choices=list(chargeDistributions), default='90/10',
+                        help='how the charges are split between positive and negative')
+    parser.add_argument('--seed', type=int, help='seed the initial charges (the global numpy.random otherwise)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes to evaluate the forces on, 0 uses every core (see slabParallel)')
+    parser.add_argument('--block-timesteps', action='store_true',
+                        help='individual power-of-two timesteps instead of one global dt')
+    parser.add_argument('--record', help='record every step to this raw trajectory file')
+    parser.add_argument('--replay', help='play a --record file back instead of simulating')
+    parser.add_argument('--histograms', help='stream charge density histograms to this raw trajectory file')
+    parser.add_argument('--histogram-bins', type=int, default=20, help='bins along each axis')
+    parser.add_argument('--histogram-every', type=float, default=0.01, help='simulated time between samples')
+    parser.add_argument('--settle-tolerance', type=float,
+                        help='stop once the histograms and the energy change less than this between windows')
+    parser.add_argument('--settle-window', type=int, default=50, help='histogram samples averaged per window')
+    parser.add_argument('--replay-speed', type=float, default=1.,
+                        help='simulation time per wall second, 0 shows every step')
+    parser.add_argument('--replay-decimate', type=int, default=1, help='show only every n-th recorded step')
+    parser.add_argument('--replay-start', type=float, help='simulation time to start playing from')
+    args = parser.parse_args()
+    if args.profile or args.profile_timeline is not None:
+        profiler.enable(args.profile_timeline)
+
+    scene.width = scene.height = 800
+
+    if args.replay:
+        box(opacity=0.1, pos=vector(0, 0, 0), size=vector(1, 1, 1))
+        replaySlab(TrajectoryPlayer(args.replay, speed=args.replay_speed or None, decimate=args.replay_decimate,
+                                    start=args.replay_start), points=args.draw == 'points')
+        raise SystemExit
+
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ek')
+    energyK = gcurve(color=color.cyan)
+
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Ep')
+    energyP = gcurve(color=color.magenta)
+
+    graph(x=800, y=0, width=450, height=450, xtitle='t', ytitle='Etot')
+    energyTot = gcurve(color=color.green)
+
+    #####STARTING PARAMETERS######
+    numOfCharges = 100
+    slab = ChargedSlab(vector(0, 0, 0), vector(1, 1, 1), 100)
+    recordCursor = histogramCursor = None
+    if args.resume:
+        checkpoint = load_checkpoint(args.resume, 'charged slab')
+        slab.setState(checkpoint['slab'])
+        random.set_state(checkpoint['randomState'])
+        recordCursor = checkpoint.get('recordCursor')
+        histogramCursor = checkpoint.get('histogramCursor')
+    else:
+        slab.populateCharges(numOfCharges, args.distribution,
+                             None if args.seed is None else np.random.default_rng(args.seed))
+
+    recordWriter = None
+    if args.record:
+        recordWriter = open_trajectory_writer(args.record, recordColumns(numOfCharges),
+                                              {'xBorders': slab.xBorders, 'yBorders': slab.yBorders,
+                                               'zBorders': slab.zBorders}, resume=recordCursor)
+        if recordCursor is None:
+            recordWriter.write(*recordRow(slab, numOfCharges, 0, slabPotentialEnergy(slab)))
+
+    histograms = histogramWriter = None
+    if args.histograms or args.settle_tolerance is not None:
+        histograms = ChargeHistograms((slab.xBorders, slab.yBorders, slab.zBorders), args.histogram_bins,
+                                      every=args.histogram_every, window=args.settle_window,
+                                      tolerance=args.settle_tolerance)
+        if args.resume and checkpoint.get('histograms') is not None:
+            histograms.setState(checkpoint['histograms'])
+        if args.histograms:
+            histogramWriter = open_trajectory_writer(args.histograms,
+                                                     ['t'] + ChargeHistograms.columns(args.histogram_bins) + ['E'],
+                                                     histograms.metadata(), resume=histogramCursor)
+            histograms.writer = histogramWriter
+
+    checkpointer = Checkpointer(args.checkpoint, 'charged slab', args.checkpoint_every)
+    timesteps = BlockTimesteps() if args.block_timesteps else None
+
+    view = ParticleView(render, args.max_fps, args.draw == 'points')  # only follows the arrays when drawn
+    view.sync(slab.particles, force=True)
+
+    def simulationState():
+        return {'slab': slab.getState(), 'randomState': random.get_state(),
+                'recordCursor': recordWriter.cursor() if recordWriter is not None else None,
+                'histograms': histograms.getState() if histograms is not None else None,
+                'histogramCursor': histogramWriter.cursor() if histogramWriter is not None else None}
+
+    forces = partial(octreeSums, theta=args.theta) if args.solver == 'octree' else coulombSums
+    if args.workers != 1:
+        forces = ParallelForces(args.workers or None, args.solver, args.theta)
+        forces.share(slab.particles)  # the direct solver's workers read the positions where the steps write them
+    try:  # the worker pool and its shared memory are released however the run ends
+        while slab.t < 1000:
+            with profiler.phase('checkpoint'):
+                checkpointer.step(simulationState)
+            with profiler.phase('rate'):
+                rate(10000000)
+
+            dt, Ek, Ep = simulationStep(slab, forces, timesteps)
+
+            with profiler.phase('draw'):
+                view.sync(slab.particles)
+
+            with profiler.phase('graphs'):
+                energyP.plot(pos=(slab.t, Ep))
+                energyK.plot(pos=(slab.t, Ek))
+                energyTot.plot(pos=(slab.t, Ek + Ep))
+            if recordWriter is not None:
+                with profiler.phase('record'):
+                    recordWriter.write(*recordRow(slab, numOfCharges, Ek, Ep))
+            if histograms is not None:
+                with profiler.phase('histograms'):
+                    histograms.update(slab.t, slab.particles.pos, slab.particles.charge, Ek + Ep)
+                if histograms.converged:
+                    print(f'Settled at t = {slab.t:.4g} after {histograms.samples} histogram samples')
+                    break
+
+        checkpointer.save(simulationState())
+    finally:
+        if recordWriter is not None:
+            recordWriter.close()
+        if histogramWriter is not None:
+            histogramWriter.close()
+        if isinstance(forces, ParallelForces):
+            forces.close()
@@ -0,0 +1,144 @@
+"""
+Batch runs of the charged slab over a grid of experiments.
+
+Every combination of charge distribution, number of charges, slab size and seed is one run. The runs are simulated
+headless, in parallel on a process pool, and the final state of each is gathered into one dataset:
+    per run       - distribution, numOfCharges, slabSize, seed, t, steps, Ek, Ep, merges, seconds, cached
+    per particle  - pos, charge, radius, ids, run (the index of the run the particle belongs to)
+saved as a compressed .npz file. Each run draws its initial charges from its own generator, seeded by the root seed
+and the run's seed alone, so a run gives the same result whatever grid or worker count it is part of. That also makes
+every run cacheable: with a run cache (see simtools.cache) only the runs whose parameters or code changed are
+simulated again. cached marks the runs loaded from it, whose seconds are the time the run took when it was simulated.
+
+    python slabEnsemble.py --distributions 90/10 alternating --charges 100 400 --sizes 1,1,1 1,1,0.1 --seeds 0 1 2
+"""
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
+
+import numpy as np
+
+from simtools.cache import RunCache, code_version, imported_sources
+from simtools.processes import process_context
+
+os.environ['SIM_RENDER'] = 'null'  # the runs are headless, set before the simulation is imported
+
+
+def runGrid(distributions, charges, sizes, seeds):
+    """One parameter dict per combination, in a fixed order."""
+    return [{'distribution': distribution, 'numOfCharges': numOfCharges, 'slabSize': tuple(size), 'seed': seed}
+            for distribution, numOfCharges, size, seed in itertools.product(distributions, charges, sizes, seeds)]
+
+
+def runSlab(run, rootSeed=0, duration=1., maxSteps=100000, solver='direct', theta=None):
+    """Simulates one run until duration (or maxSteps steps) and returns its final state."""
+    import slabChargeDensity as slab_simulation
+    from slabOctree import THETA, octreeSums
+
+    start = perf_counter()
+    rng = np.random.default_rng(np.random.SeedSequence(rootSeed, spawn_key=(run['seed'],)))
+    vector = slab_simulation.vector
+    slab = slab_simulation.ChargedSlab(vector(0, 0, 0), vector(*run['slabSize']), 100)
+    slab.populateCharges(run['numOfCharges'], run['distribution'], rng)
+    theta = THETA if theta is None else theta
+    forces = partial(octreeSums, theta=theta) if solver == 'octree' else slab_simulation.coulombSums
+
+    steps = 0
+    Ek, Ep = 0., slab_simulation.slabPotentialEnergy(slab)
+    while slab.t < duration and steps < maxSteps:
+        _, Ek, Ep = slab_simulation.simulationStep(slab, forces)
+        steps += 1
+    particles = slab.particles
+    return dict(run, t=slab.t, steps=steps, Ek=Ek, Ep=float(Ep), merges=len(slab.mergeHistory),
+                seconds=perf_counter() - start, pos=particles.pos.copy(), charge=particles.charge.copy(),
+                radius=particles.radius.copy(), ids=particles.ids.copy())
+
+
+def codeVersion():
+    """The hash of every module of the repository a run imports, the runs' cache version (see simtools.cache)."""
+    import slabChargeDensity  # the runs import it themselves, here it is only loaded to be hashed
+    return code_version(*imported_sources(os.path.dirname(os.path.abspath(__file__))))
+
+
+def runStarter(arguments):  # unpacks the pool's tasks
+    run, options = arguments
+    return runSlab(run, **options)
+
+
+def runEnsemble(runs, workers=None, cache=None, **options):
+    """
+    Runs every parameter dict in runs (see runGrid) with runSlab(run, **options) on workers processes (all cores by
+    default, 1 runs them in this process) and returns the gathered dataset. Runs found in cache (a RunCache) are
+    loaded instead, the others are stored in it.
+    """
+    results = [None] * len(runs) if cache is None else [cache.load({'run': run, **options}) for run in runs]
+    results = [None if result is None else dict(result, cached=True) for result in results]
+    missing = [index for index, result in enumerate(results) if result is None]
+    tasks = [(runs[index], options) for index in missing]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        computed = [runStarter(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(workers, mp_context=process_context()) as pool:
+            computed = list(pool.map(runStarter, tasks))
+    for index, result in zip(missing, computed):
+        results[index] = dict(result, cached=False)
+        if cache is not None:
+            cache.store({'run': runs[index], **options}, result)
+    return gatherResults(results)
+
+
+def gatherResults(results):
+    perParticle = ('pos', 'charge', 'radius', 'ids')
+    dataset = {name: np.array([result[name] for result in results])
+               for name in results[0] if name not in perParticle}
+    for name in perParticle:
+        dataset[name] = np.concatenate([result[name] for result in results])
+    dataset['run'] = np.repeat(np.arange(len(results)), [len(result['charge']) for result in results])
+    return dataset
+
+
+def saveEnsemble(path, dataset):
+    np.savez_compressed(path, **dataset)
+
+
+def loadEnsemble(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+if __name__ == '__main__':
+    import slabChargeDensity as slab_simulation
+
+    parser = argparse.ArgumentParser(description='Runs the charged slab over a grid of experiments in parallel.')
+    parser.add_argument('--distributions', nargs='+', choices=list(slab_simulation.chargeDistributions),
+                        default=['90/10'])
+    parser.add_argument('--charges', nargs='+', type=int, default=[100], help='numbers of charges')
+    parser.add_argument('--sizes', nargs='+', default=['1,1,1'], help='slab sizes as x,y,z')
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--root-seed', type=int, default=0, help='combined with each run\'s seed')
+    parser.add_argument('--duration', type=float, default=1., help='simulated time of each run')
+    parser.add_argument('--max-steps', type=int, default=100000, help='stop a run after this many steps')
+    parser.add_argument('--solver', choices=['direct', 'octree'], default='direct')
+    parser.add_argument('--theta', type=float, help='the octree opening angle, slabOctree.THETA by default')
+    parser.add_argument('--workers', type=int, default=0, help='processes to run on, 0 uses every core')
+    parser.add_argument('--output', default='slab_ensemble.npz')
+    parser.add_argument('--cache', help='directory of cached runs, only the runs missing from it are simulated')
+    parser.add_argument('--cache-size', type=float, default=1024, help='MB the cache may take before old runs go')
+    args = parser.parse_args()
+
+    grid = runGrid(args.distributions, args.charges, [[float(x) for x in size.split(',')] for size in args.sizes],
+                   args.seeds)
+    cache = RunCache(args.cache, int(args.cache_size * 2 ** 20), codeVersion()) if args.cache else None
+    ensemble = runEnsemble(grid, args.workers or None, cache, rootSeed=args.root_seed, duration=args.duration,
+                           maxSteps=args.max_steps, solver=args.solver, theta=args.theta)
+    saveEnsemble(args.output, ensemble)
+    for index, run in enumerate(grid):
+        print(f'{run["distribution"]:>12} {run["numOfCharges"]:>6} {str(run["slabSize"]):>18} seed {run["seed"]}: '
+              f'Ek {ensemble["Ek"][index]:.4g} Ep {ensemble["Ep"][index]:.4g} merges {ensemble["merges"][index]} '
+              f'in {ensemble["steps"][index]} steps, '
+              + ('cached' if ensemble['cached'][index] else f'{ensemble["seconds"][index]:.1f} s'))
+    print(f'Saved {len(grid)} runs to {args.output}')
@@ -0,0 +1,101 @@
+"""
+Charge density histograms of the charged slab, accumulated while it runs.
+
+A sample bins the particles' charges along each axis between the slab's borders, and splits them between the surface
+layer (closer than surfaceDepth to a face) and the bulk, each divided by its volume to give a charge density. Samples
+are taken every `every` units of simulated time, added to running totals and streamed to an optional trajectory
+writer (see simtools.trajectory), one row per sample.
+
+The samples are also averaged over windows of `window` samples. The distribution has settled once two consecutive
+window averages differ by less than tolerance, in the histograms (relative L1 distance) and in the total energy.
+"""
+import numpy as np
+
+AXES = 'xyz'
+
+
+class ChargeHistograms:
+    def __init__(self, borders, bins=20, surfaceDepth=None, every=0.01, window=50, tolerance=None, writer=None):
+        self.low, self.high = np.array(borders, dtype=float).T
+        size = self.high - self.low
+        self.bins = bins
+        self.surfaceDepth = size.min() / bins if surfaceDepth is None else surfaceDepth
+        volume = float(np.prod(size))
+        self.bulkVolume = float(np.prod(np.maximum(size - 2 * self.surfaceDepth, 0)))
+        self.surfaceVolume = volume - self.bulkVolume
+        self.binVolume = volume / bins  # the same along every axis
+        self.every = every
+        self.window = window
+        self.tolerance = tolerance
+        self.writer = writer
+
+        self.nextSample = 0.
+        self.samples = 0
+        self.totals = np.zeros(3 * bins + 2)
+        self.windowTotals = np.zeros(3 * bins + 2)
+        self.windowEnergy = 0.
+        self.windowSamples = 0
+        self.previousWindow = None  # (densities, energy) averaged over the last full window
+        self.change = None  # (histogram change, energy change) between the last two windows
+        self.converged = False
+
+    @staticmethod
+    def columns(bins):  # of one sample's densities
+        return [f'{axis}{index}' for axis in AXES for index in range(bins)] + ['surface', 'bulk']
+
+    def metadata(self):
+        return {'low': self.low.tolist(), 'high': self.high.tolist(), 'bins': self.bins,
+                'surfaceDepth': self.surfaceDepth, 'binVolume': self.binVolume, 'surfaceVolume': self.surfaceVolume,
+                'bulkVolume': self.bulkVolume}
+
+    def densities(self, pos, charge):
+        """The charge densities of one set of positions: the x, y and z histograms, then the surface and the bulk."""
+        relative = (pos - self.low) / (self.high - self.low)
+        bins = np.clip((relative * self.bins).astype(np.int64), 0, self.bins - 1)
+        histograms = [np.bincount(bins[:, axis], charge, self.bins) / self.binVolume for axis in range(3)]
+        wallDistance = np.minimum(pos - self.low, self.high - pos).min(axis=1, initial=np.inf)
+        surface = wallDistance < self.surfaceDepth
+        bulkDensity = charge[~surface].sum() / self.bulkVolume if self.bulkVolume > 0 else 0.
+        return np.concatenate(histograms + [[charge[surface].sum() / self.surfaceVolume, bulkDensity]])
+
+    def update(self, t, pos, charge, energy):
+        """Takes a sample if one is due at time t, returns whether it did."""
+        if t < self.nextSample:
+            return False
+        self.nextSample = t + self.every
+        densities = self.densities(pos, charge)
+        self.samples += 1
+        self.totals += densities
+        self.windowTotals += densities
+        self.windowEnergy += energy
+        self.windowSamples += 1
+        if self.writer is not None:
+            self.writer.write(t, *densities, energy)
+
+        if self.windowSamples == self.window:
+            current = (self.windowTotals / self.window, self.windowEnergy / self.window)
+            if self.previousWindow is not None:
+                (previous, previousEnergy), (densities, energy) = self.previousWindow, current
+                self.change = (float(np.abs(densities - previous).sum() / max(np.abs(densities).sum(), 1E-300)),
+                               abs(energy - previousEnergy) / max(abs(energy), 1E-300))
+                self.converged = self.tolerance is not None and max(self.change) < self.tolerance
+            self.previousWindow = current
+            self.windowTotals = np.zeros_like(self.windowTotals)
+            self.windowEnergy = 0.
+            self.windowSamples = 0
+        return True
+
+    def mean(self):
+        """The densities averaged over every sample so far, split like densities() into (x, y, z, surface, bulk)."""
+        mean = self.totals / max(self.samples, 1)
+        return (*np.split(mean[:3 * self.bins], 3), mean[-2], mean[-1])
+
+    def getState(self):
+        return {'nextSample': self.nextSample, 'samples': self.samples, 'totals': self.totals.copy(),
+                'windowTotals': self.windowTotals.copy(), 'windowEnergy': self.windowEnergy,
+                'windowSamples': self.windowSamples, 'previousWindow': self.previousWindow, 'change': self.change,
+                'converged': self.converged}
+
+    def setState(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
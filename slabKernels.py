@@ -0,0 +1,79 @@
+"""
+Vectorized NumPy kernels for the charged slab simulation.
+
+The particles are handled as plain arrays (positions (N, 3), velocities (N, 3), charges (N,), masses (N,)) instead of
+lists of ElectricCharge objects. Pair interactions are evaluated in blocks of target rows against all sources, so the
+temporary (block, N) separations stay within pairsPerBlock pairs however many charges there are.
+"""
+import numpy as np
+
+
+def coulombSums(pos, charge, targets=None, pairsPerBlock=1 << 16):
+    """
+    Returns (field, potential) in one pass over the pairs, without the Coulomb constant:
+        field[i] = sum over j of charge[j] * (pos[i] - pos[j]) / |pos[i] - pos[j]|^3
+        potential = sum over pairs i < j of charge[i] * charge[j] / |pos[i] - pos[j]|
+    Coincident pairs (and each particle with itself) are skipped, like kinematics does. With targets (an index array)
+    only those particles' fields are computed, against all sources, and potential is their share of the total: half
+    of sum over targets i and all j of charge[i] * charge[j] / |pos[i] - pos[j]|.
+    """
+    targets = np.arange(len(pos)) if targets is None else np.asarray(targets)
+    field = np.empty((len(targets), 3))
+    potential = 0.
+    coordinates = np.ascontiguousarray(pos.T)  # one row per axis keeps the block arithmetic on contiguous 2D arrays
+    blockSize = max(1, pairsPerBlock // max(len(pos), 1))
+    for start in range(0, len(targets), blockSize):
+        block = targets[start:start + blockSize]
+        r = [axis[block, None] - axis for axis in coordinates]
+        invR = r[0] * r[0]
+        invR += r[1] * r[1]
+        invR += r[2] * r[2]
+        np.sqrt(invR, out=invR)
+        np.divide(1., invR, out=invR, where=invR > 0)  # coincident pairs stay 0
+        chargeOverR = charge * invR
+        potential += charge[block] @ chargeOverR.sum(axis=1)
+        chargeOverR *= invR
+        chargeOverR *= invR
+        for axis in range(3):
+            field[start:start + blockSize, axis] = np.einsum('ij,ij->i', chargeOverR, r[axis])
+    return field, potential / 2  # every pair was counted from both ends
+
+
+def nearestDistances(pos, targets=None, pairsPerBlock=1 << 16):
+    """The distance from each target particle (all by default) to its nearest other particle, inf when alone."""
+    targets = np.arange(len(pos)) if targets is None else np.asarray(targets)
+    nearest = np.empty(len(targets))
+    coordinates = np.ascontiguousarray(pos.T)
+    blockSize = max(1, pairsPerBlock // max(len(pos), 1))
+    for start in range(0, len(targets), blockSize):
+        block = targets[start:start + blockSize]
+        r2 = sum((axis[block, None] - axis) ** 2 for axis in coordinates)
+        r2[np.arange(len(block)), block] = np.inf  # not itself
+        nearest[start:start + blockSize] = np.sqrt(r2.min(axis=1, initial=np.inf))
+    return nearest
+
+
+def wallCollisions(pos, v, borders):
+    """
+    The array version of detectCollision: particles outside the [low, high] borders of an axis lose 10% of their
+    speed, have that velocity component reversed and are put back on the wall. pos and v are changed in place.
+    """
+    for axis, (low, high) in enumerate(borders):
+        outside = (pos[:, axis] < low) | (pos[:, axis] > high)
+        if not outside.any():
+            continue
+        v[outside] *= 0.9
+        v[outside, axis] *= -1
+        pos[outside, axis] = np.where(pos[outside, axis] < low, low, high)
+
+
+def kickDrift(pos, v, acceleration, dt, borders):
+    """
+    Advances all particles synchronously by dt, the way kinematics does one particle: kick, bounce off the walls,
+    drift, then slow down anything faster than 100 by a factor of 10. Returns the new positions; v is changed in place.
+    """
+    v += acceleration * dt
+    wallCollisions(pos, v, borders)
+    nextPos = pos + v * dt
+    v[np.einsum('ij,ij->i', v, v) > 100 ** 2] /= 10
+    return nextPos
@@ -0,0 +1,152 @@
+"""
+Cell list neighbour index for the charged slab.
+
+Space is cut into cubic cells and the particles are kept sorted by cell, so every occupied cell is a contiguous range
+of the sorted particles. Between steps the particles barely move, so update() re-sorts starting from the previous
+order, which a stable sort handles in close to linear time. Queries only look at neighbouring cells:
+    pairsWithin(radius) - every pair closer than radius (the merge candidates)
+    nearestDistances()  - each particle's distance to its nearest neighbour (the timesteps)
+    closestDistance()   - the closest pair's distance
+Below a few hundred particles sorting and visiting the cells costs more than comparing every pair, so below directBelow
+particles the queries compare every pair with the kernels of slabKernels instead.
+"""
+import numpy as np
+
+from slabKernels import nearestDistances
+from slabOctree import ranges
+
+CELL_BITS = 21  # per axis, cell keys are 63 bit integers
+CELL_OFFSET = 1 << (CELL_BITS - 1)  # so negative cell coordinates get valid keys
+DIRECT_BELOW = 250  # particles, about where the cell list overtakes comparing every pair on a slab
+
+
+def encodeCells(cells):
+    return cells[:, 0] << (2 * CELL_BITS) | cells[:, 1] << CELL_BITS | cells[:, 2]
+
+
+def decodeCells(keys):
+    mask = (1 << CELL_BITS) - 1
+    return np.stack([keys >> (2 * CELL_BITS), keys >> CELL_BITS & mask, keys & mask], axis=1)
+
+
+class CellList:
+    """
+    With no cellSize the cells are sized for about one particle each (from the particles' bounding box), but never
+    smaller than minCellSize. The size is chosen again whenever the number of particles changes. With fewer than
+    directBelow particles no cells are built and every query compares all pairs.
+    """
+
+    def __init__(self, cellSize=None, minCellSize=0., directBelow=DIRECT_BELOW):
+        self.fixedCellSize = cellSize
+        self.minCellSize = minCellSize
+        self.directBelow = directBelow
+        self.cellSize = None
+        self.pos = np.empty((0, 3))
+        self.order = None
+
+    @property
+    def direct(self) -> bool:
+        return len(self.pos) < self.directBelow
+
+    def update(self, pos):
+        if len(pos) < self.directBelow:
+            self.pos, self.order = pos, None  # the cells are rebuilt from scratch once there are enough particles
+            return
+        if self.order is None or len(self.order) != len(pos):
+            self.cellSize = self.fixedCellSize or self.__autoCellSize(pos)
+            self.order = np.arange(len(pos))
+        self.pos = pos
+        keys = encodeCells(np.floor(pos / self.cellSize).astype(np.int64) + CELL_OFFSET)
+        self.order = self.order[np.argsort(keys[self.order], kind='stable')]  # nearly sorted already
+        sortedKeys = keys[self.order]
+        self.cellStart = np.flatnonzero(np.r_[True, sortedKeys[1:] != sortedKeys[:-1]]) if len(pos) else \
+            np.empty(0, dtype=np.int64)
+        self.cellKeys = sortedKeys[self.cellStart]
+        self.cellCount = np.diff(np.r_[self.cellStart, len(pos)])
+
+    def __autoCellSize(self, pos):
+        extent = np.ptp(pos, axis=0) if len(pos) else np.ones(3)
+        volume = np.prod(np.maximum(extent, extent.max() * 1E-3))
+        return max(self.minCellSize, (volume / max(len(pos), 1)) ** (1 / 3), 1E-12)
+
+    def __neighbourCells(self, keys, reach, halfShell):
+        """(index into keys, occupied cell) for the occupied cells within reach cells of each key."""
+        cells = decodeCells(keys)
+        offsets = np.stack(np.meshgrid(*[np.arange(-reach, reach + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+        if halfShell:  # every pair of cells once: the cell itself and the offsets after it
+            offsets = offsets[[tuple(offset) >= (0, 0, 0) for offset in offsets.tolist()]]
+        indices, neighbours = [], []
+        for offset in offsets:
+            neighbourKeys = encodeCells(cells + offset)
+            found = np.minimum(np.searchsorted(self.cellKeys, neighbourKeys), len(self.cellKeys) - 1)
+            exists = self.cellKeys[found] == neighbourKeys
+            indices.append(np.flatnonzero(exists))
+            neighbours.append(found[exists])
+        return np.concatenate(indices), np.concatenate(neighbours)
+
+    def pairsWithin(self, radius):
+        """Returns (i, j, distance) for every pair i < j of particles closer than radius."""
+        if len(self.pos) < 2:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        if self.direct:
+            i, j = np.triu_indices(len(self.pos), 1)
+            distance = np.linalg.norm(self.pos[i] - self.pos[j], axis=1)
+            close = distance < radius
+            return i[close], j[close], distance[close]
+        cellA, cellB = self.__neighbourCells(self.cellKeys, int(np.ceil(radius / self.cellSize)), halfShell=True)
+        countA, countB = self.cellCount[cellA], self.cellCount[cellB]
+        pair = ranges(countA * countB)
+        repeatedB = np.repeat(countB, countA * countB)
+        a = np.repeat(self.cellStart[cellA], countA * countB) + pair // repeatedB
+        b = np.repeat(self.cellStart[cellB], countA * countB) + pair % repeatedB
+        keep = (np.repeat(cellA != cellB, countA * countB)) | (a < b)  # inside one cell every pair once
+        i, j = self.order[a[keep]], self.order[b[keep]]
+        distance = np.linalg.norm(self.pos[i] - self.pos[j], axis=1)
+        close = distance < radius
+        i, j = i[close], j[close]
+        return np.minimum(i, j), np.maximum(i, j), distance[close]
+
+    def __nearestWithin(self, targets, reach):
+        """Nearest distances of the targets among the particles within reach cells, inf where there are none."""
+        nearest = np.full(len(targets), np.inf)
+        keys = encodeCells(np.floor(self.pos[targets] / self.cellSize).astype(np.int64) + CELL_OFFSET)
+        target, cell = self.__neighbourCells(keys, reach, halfShell=False)
+        counts = self.cellCount[cell]
+        source = self.order[np.repeat(self.cellStart[cell], counts) + ranges(counts)]
+        target = np.repeat(target, counts)
+        notItself = source != targets[target]
+        target, source = target[notItself], source[notItself]
+        np.minimum.at(nearest, target, np.linalg.norm(self.pos[targets[target]] - self.pos[source], axis=1))
+        return nearest
+
+    def nearestDistances(self, targets=None, maxReach=4):
+        """
+        Each target particle's (all by default) distance to its nearest other particle, inf when alone. A distance
+        found within reach cells is final only when it is at most reach cell sizes, otherwise the search widens, up to
+        maxReach cells, and whatever is still left over is searched among all particles.
+        """
+        if self.direct:
+            return nearestDistances(self.pos, targets)
+        if targets is None:  # every pair of neighbouring cells once
+            targets = np.arange(len(self.pos))
+            nearest = np.full(len(targets), np.inf)
+            i, j, distance = self.pairsWithin(self.cellSize)
+            np.minimum.at(nearest, i, distance)
+            np.minimum.at(nearest, j, distance)
+        else:
+            targets = np.asarray(targets)
+            nearest = self.__nearestWithin(targets, 1) if len(self.pos) > 1 else np.full(len(targets), np.inf)
+
+        reach = 1
+        far = np.flatnonzero(nearest > self.cellSize)
+        while len(far) and len(self.pos) > 1:
+            if 2 * reach > maxReach:
+                nearest[far] = nearestDistances(self.pos, targets[far])
+                break
+            reach *= 2
+            nearest[far] = self.__nearestWithin(targets[far], reach)
+            far = far[nearest[far] > reach * self.cellSize]
+        return nearest
+
+    def closestDistance(self):
+        return float(self.nearestDistances().min(initial=np.inf))
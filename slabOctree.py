@@ -0,0 +1,293 @@
+"""
+Barnes-Hut octree for the charged slab, an O(N log N) alternative to slabKernels.coulombSums.
+
+The tree is rebuilt from the positions on every call. Particles are sorted along a Morton (Z-order) curve, so every
+cell is a contiguous range of the sorted particles and the whole tree is built level by level with array operations.
+The charges are signed and can cancel, so a cell is expanded about the centroid of its absolute charges (which always
+lies inside the cell) and keeps its dipole and quadrupole moments about that point as well as its total charge; with
+cancelling charges the monopole and dipole alone leave errors of tens of percent.
+
+The traversal is vectorized over (target, cell) pairs: at each round every pair either accepts the cell's multipole
+(cell size < theta * distance), interacts directly with the cell's particles (an opened leaf) or is replaced by pairs
+with the cell's children. theta=0 is the exact direct sum, larger is faster and less accurate; check the error with
+compareWithDirect. Over the slab's charge distributions (100-1000 charges, cubic and flat slabs, fresh and after 30
+steps) the field errors were
+    theta = 0.3 (THETA, the default)  median 0.01%, at most 0.05% for a whole configuration, worst charge 1.4%
+    theta = 0.5                       median 0.13%, at most 0.4%, worst charge 32%
+the worst charges being the ones whose neighbours' fields almost cancel.
+"""
+import numpy as np
+
+from slabKernels import coulombSums
+
+MORTON_BITS = 21  # per axis, 63 bits in all
+THETA = 0.3  # the default opening angle, keeps every field error on the slab's configurations below about 1.5%
+
+
+def spreadBits(values):  # puts two zero bits after each of the low 21 bits
+    values = values.astype(np.uint64) & np.uint64(0x1FFFFF)
+    for shift, mask in ((32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def mortonCodes(pos, low, size):
+    cells = np.clip(((pos - low) / size * (1 << MORTON_BITS)).astype(np.int64), 0, (1 << MORTON_BITS) - 1)
+    return spreadBits(cells[:, 0]) << np.uint64(2) | spreadBits(cells[:, 1]) << np.uint64(1) | spreadBits(cells[:, 2])
+
+
+def ranges(counts):  # concatenated aranges: [0, counts[0]), [0, counts[1]), ...
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def batches(group, other, cost, maxCost):  # splits (group, other) pairs into runs costing about maxCost each
+    if not len(group):
+        return []
+    splits = np.searchsorted(np.cumsum(cost), np.arange(maxCost, cost.sum(), maxCost))
+    return zip(np.split(group, splits), np.split(other, splits))
+
+
+def rangeSums(values, starts, ends):  # sums of values[start:end] over the first axis for every range
+    padded = np.concatenate([values, np.zeros((1,) + values.shape[1:])])
+    return np.add.reduceat(padded, np.ravel([starts, ends], order='F'), axis=0)[::2]
+
+
+class Octree:
+    """The tree of one set of positions and charges, cells with more than leafSize particles are split."""
+    # everything sums() and blockSums() read, what fromArrays() takes
+    ARRAYS = ('order', 'rank', 'pos', 'charge', 'start', 'end', 'size', 'firstChild', 'childCount', 'totalCharge',
+              'absCharge', 'center', 'axes', 'centerAxes', 'dipoleAxes', 'quadrupoleAxes')
+
+    def __init__(self, pos, charge, leafSize=8):
+        low = pos.min(axis=0)
+        size = max(float((pos.max(axis=0) - low).max()), 1E-12) * (1 + 1E-9)
+        codes = mortonCodes(pos, low, size)
+        self.order = np.argsort(codes, kind='stable')
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(pos))
+        codes = codes[self.order]
+        self.pos = pos[self.order]
+        self.charge = charge[self.order]
+
+        # cells level by level, the children of each internal cell are stored contiguously
+        starts, ends, levels, firstChild, childCount = [np.array([0])], [np.array([len(pos)])], [np.array([0])], [], []
+        level = 0
+        internal = np.array([len(pos) > leafSize])
+        cellCount = 1
+        while True:
+            levelStarts, levelEnds = starts[-1][internal], ends[-1][internal]
+            if not len(levelStarts) or level == MORTON_BITS:
+                firstChild.append(np.full(len(internal), -1))
+                childCount.append(np.zeros(len(internal), dtype=np.int64))
+                break
+            level += 1
+            keys = codes >> np.uint64(3 * (MORTON_BITS - level))
+            runStarts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            runEnds = np.r_[runStarts[1:], len(codes)]
+            parents = np.searchsorted(levelStarts, runStarts, side='right') - 1
+            inside = (parents >= 0) & (runStarts < levelEnds[np.maximum(parents, 0)])
+            runStarts, runEnds, parents = runStarts[inside], runEnds[inside], parents[inside]
+
+            counts = np.bincount(parents, minlength=len(levelStarts))
+            levelFirstChild = np.full(len(internal), -1)
+            levelFirstChild[internal] = cellCount + np.cumsum(counts) - counts
+            levelChildCount = np.zeros(len(internal), dtype=np.int64)
+            levelChildCount[internal] = counts
+            firstChild.append(levelFirstChild)
+            childCount.append(levelChildCount)
+
+            starts.append(runStarts)
+            ends.append(runEnds)
+            levels.append(np.full(len(runStarts), level))
+            cellCount += len(runStarts)
+            internal = runEnds - runStarts > leafSize
+
+        self.start = np.concatenate(starts)
+        self.end = np.concatenate(ends)
+        self.size = size / 2. ** np.concatenate(levels)
+        self.firstChild = np.concatenate(firstChild)
+        self.childCount = np.concatenate(childCount)
+
+        # multipoles: total charge, and the dipole moment about the absolute charge centroid
+        self.totalCharge = rangeSums(self.charge, self.start, self.end)
+        self.absCharge = rangeSums(np.abs(self.charge), self.start, self.end)
+        weighted = rangeSums(np.abs(self.charge)[:, None] * self.pos, self.start, self.end)
+        cellCenter = rangeSums(self.pos, self.start, self.end) / (self.end - self.start)[:, None]
+        neutral = self.absCharge == 0
+        self.center = np.where(neutral[:, None], cellCenter, weighted / np.where(neutral, 1, self.absCharge)[:, None])
+        firstMoment = rangeSums(self.charge[:, None] * self.pos, self.start, self.end)
+        self.dipole = firstMoment - self.totalCharge[:, None] * self.center
+        # the traceless quadrupole sum q (3 d d - |d|^2 I), d = pos - center, from the second moments about the origin
+        secondMoment = rangeSums(self.charge[:, None, None] * self.pos[:, :, None] * self.pos[:, None, :],
+                                 self.start, self.end)
+        centered = secondMoment - firstMoment[:, :, None] * self.center[:, None, :] - \
+            self.center[:, :, None] * firstMoment[:, None, :] + \
+            self.totalCharge[:, None, None] * self.center[:, :, None] * self.center[:, None, :]
+        quadrupole = 3 * centered - np.trace(centered, axis1=1, axis2=2)[:, None, None] * np.eye(3)
+        # coordinate-major copies, gathering from 1D arrays is much faster than gathering rows
+        self.axes = np.ascontiguousarray(self.pos.T)
+        self.centerAxes = np.ascontiguousarray(self.center.T)
+        self.dipoleAxes = np.ascontiguousarray(self.dipole.T)
+        self.quadrupoleAxes = np.ascontiguousarray(quadrupole.reshape(-1, 9).T)  # xx, xy, xz, yx, ... yz, zz
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        """The tree whose ARRAYS are given by name (e.g. views of another process' tree), without building it."""
+        tree = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        return tree
+
+    def sums(self, targets=None, theta=THETA, chunkSize=1024, maxPairs=1 << 18):
+        """
+        Like coulombSums, for the particles at the indices targets (all by default). The leaves are the target groups
+        when every particle is a target, each target is its own group otherwise. Groups are traversed chunkSize
+        targets at a time and their interactions evaluated maxPairs at a time, which bounds the memory.
+        """
+        if targets is None:
+            leaves = self.leaves()
+            members = np.arange(len(self.pos))
+            field, potential = self.__groupSums(members, self.start[leaves], self.end[leaves], theta, chunkSize,
+                                                maxPairs)
+            return field[self.rank], 0.5 * self.charge @ potential
+        members = np.sort(self.rank[targets])
+        groupStart = np.arange(len(members))
+        field, potential = self.__groupSums(members, groupStart, groupStart + 1, theta, chunkSize, maxPairs)
+        # back from the sorted order to the order of targets
+        index = np.searchsorted(members, self.rank[targets])
+        return field[index], 0.5 * self.charge[members[index]] @ potential[index]
+
+    def leaves(self):  # in Morton order
+        leaves = np.flatnonzero(self.childCount == 0)
+        return leaves[np.argsort(self.start[leaves])]
+
+    def blockSums(self, block, blocks, theta=THETA, chunkSize=1024, maxPairs=1 << 18):
+        """
+        sums() for one of blocks runs of consecutive leaves holding about the same number of particles, each a
+        subtree or a few neighbouring ones. Returns the indices of the block's particles, their fields and their share
+        of the potential; the blocks together give what sums() does.
+        """
+        leaves = self.leaves()
+        first, last = np.searchsorted(self.start[leaves], [block * len(self.pos) // blocks,
+                                                           (block + 1) * len(self.pos) // blocks])
+        low, high = (self.start[leaves[first]], self.end[leaves[last - 1]]) if last > first else (0, 0)
+        members = np.arange(low, high)
+        field, potential = self.__groupSums(members, self.start[leaves[first:last]] - low,
+                                            self.end[leaves[first:last]] - low, theta, chunkSize, maxPairs)
+        return self.order[members], field, 0.5 * self.charge[members] @ potential
+
+    def __groupSums(self, members, groupStart, groupEnd, theta, chunkSize, maxPairs):
+        """The fields and potentials at the members (sorted ranks), groupStart and groupEnd index into members."""
+        field = np.zeros((len(members), 3))
+        potential = np.zeros(len(members))
+        if not len(members):
+            return field, potential
+        groupCenter = rangeSums(self.pos[members], groupStart, groupEnd) / (groupEnd - groupStart)[:, None]
+        memberDistance = np.linalg.norm(self.pos[members] - np.repeat(groupCenter, groupEnd - groupStart, axis=0),
+                                        axis=1)
+        groups = (groupStart, groupEnd, groupCenter, np.maximum.reduceat(memberDistance, groupStart))
+
+        groupSize = groupEnd - groupStart
+        chunkStarts = np.unique(np.searchsorted(groupStart, np.arange(0, len(members), chunkSize)))
+        for first, last in zip(chunkStarts, np.r_[chunkStarts[1:], len(groupStart)]):
+            chunk = slice(groupStart[first], groupEnd[last - 1])
+            (multipoleGroup, cell), (directGroup, leaf) = self.__traverse(groups, members, np.arange(first, last),
+                                                                           theta)
+            for pairs in batches(multipoleGroup, cell, groupSize[multipoleGroup], maxPairs):
+                self.__addMultipoles(field[chunk], potential[chunk], groups, members, *pairs, chunk.start)
+            for pairs in batches(directGroup, leaf, groupSize[directGroup] * (self.end - self.start)[leaf], maxPairs):
+                self.__addDirect(field[chunk], potential[chunk], groups, members, *pairs, chunk.start)
+        return field, potential
+
+    def __traverse(self, groups, members, group, theta):
+        """The (group, cell) pairs that use the cell's multipole and the (group, leaf) pairs that interact directly."""
+        groupStart, _, groupCenter, groupRadius = groups
+        firstRank = members[groupStart]
+        cell = np.zeros(len(group), dtype=np.int64)
+        accepted, direct = [], []
+        while len(group):
+            distance = np.linalg.norm(groupCenter[group] - self.center[cell], axis=1)
+            inside = (self.start[cell] <= firstRank[group]) & (firstRank[group] < self.end[cell])
+            charged = self.absCharge[cell] > 0
+            # every member of the group sees the cell under an angle below theta
+            accept = ~inside & charged & (self.size[cell] < theta * (distance - groupRadius[group]))
+            accepted.append((group[accept], cell[accept]))
+
+            opened = ~accept & charged
+            leaves = opened & (self.childCount[cell] == 0)
+            direct.append((group[leaves], cell[leaves]))
+
+            internal = opened & (self.childCount[cell] > 0)
+            group, cell = group[internal], cell[internal]
+            counts = self.childCount[cell]
+            group = np.repeat(group, counts)
+            cell = np.repeat(self.firstChild[cell], counts) + ranges(counts)
+        return [np.concatenate(pairs) for pairs in zip(*accepted)], [np.concatenate(pairs) for pairs in zip(*direct)]
+
+    @staticmethod
+    def __expand(groups, group, other):  # (member, other) pairs from (group, other) pairs
+        groupStart, groupEnd = groups[:2]
+        counts = groupEnd[group] - groupStart[group]
+        return np.repeat(groupStart[group], counts) + ranges(counts), np.repeat(other, counts)
+
+    def __addMultipoles(self, field, potential, groups, members, group, cell, firstMember):
+        member, cell = self.__expand(groups, group, cell)
+        local = member - firstMember
+        target = members[member]
+        r = [axis[target] - center[cell] for axis, center in zip(self.axes, self.centerAxes)]
+        invR2 = 1 / (r[0] * r[0] + r[1] * r[1] + r[2] * r[2])
+        invR = np.sqrt(invR2)
+        dipole = [axis[cell] for axis in self.dipoleAxes]
+        dipoleDotR = dipole[0] * r[0] + dipole[1] * r[1] + dipole[2] * r[2]
+        quadrupole = [axis[cell] for axis in self.quadrupoleAxes]
+        quadrupoleR = [quadrupole[3 * row] * r[0] + quadrupole[3 * row + 1] * r[1] + quadrupole[3 * row + 2] * r[2]
+                       for row in range(3)]
+        rQr = r[0] * quadrupoleR[0] + r[1] * quadrupoleR[1] + r[2] * quadrupoleR[2]
+        totalCharge = self.totalCharge[cell]
+        # monopole, dipole and quadrupole: phi = Q / r + p.r / r^3 + r.Qr / (2 r^5) and E = -grad phi
+        # = Q r / r^3 + 3 (p.r) r / r^5 - p / r^3 + 5 (r.Qr) r / (2 r^7) - Qr / r^5
+        invR3 = invR * invR2
+        invR5 = invR3 * invR2
+        radial = (totalCharge + (3 * dipoleDotR + 2.5 * rQr * invR2) * invR2) * invR3
+        for axis in range(3):
+            field[:, axis] += np.bincount(local, radial * r[axis] - invR3 * dipole[axis] - invR5 * quadrupoleR[axis],
+                                          len(field))
+        potential += np.bincount(local, (totalCharge + (dipoleDotR + 0.5 * rQr * invR2) * invR2) * invR, len(field))
+
+    def __addDirect(self, field, potential, groups, members, group, leaf, firstMember):
+        member, leaf = self.__expand(groups, group, leaf)
+        counts = self.end[leaf] - self.start[leaf]
+        local = np.repeat(member - firstMember, counts)
+        target = np.repeat(members[member], counts)
+        source = np.repeat(self.start[leaf], counts) + ranges(counts)
+        r = [axis[target] - axis[source] for axis in self.axes]
+        r2 = r[0] * r[0] + r[1] * r[1] + r[2] * r[2]
+        invR = np.divide(1., np.sqrt(r2), out=np.zeros_like(r2), where=r2 > 0)  # skips the target itself
+        chargeOverR = self.charge[source] * invR
+        chargeOverR3 = chargeOverR * invR * invR
+        for axis in range(3):
+            field[:, axis] += np.bincount(local, chargeOverR3 * r[axis], len(field))
+        potential += np.bincount(local, chargeOverR, len(field))
+
+
+def octreeSums(pos, charge, targets=None, theta=THETA, leafSize=8):
+    """Builds an Octree and returns (field, potential) like coulombSums."""
+    if not len(pos):
+        return np.empty((0, 3)), 0.
+    return Octree(pos, charge, leafSize).sums(targets, theta)
+
+
+def compareWithDirect(pos, charge, theta=THETA, sampleSize=1000, seed=0):
+    """
+    The octree's accuracy on a random sample of particles, against coulombSums on the same targets. Returns the
+    median and maximum relative field error and the relative error of the sample's share of the potential.
+    """
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(pos), min(sampleSize, len(pos)), replace=False))
+    treeField, treePotential = Octree(pos, charge).sums(sample, theta)
+    directField, directPotential = coulombSums(pos, charge, targets=sample)
+    error = np.linalg.norm(treeField - directField, axis=1) / np.linalg.norm(directField, axis=1)
+    return {'theta': theta, 'sample': len(sample), 'medianFieldError': float(np.median(error)),
+            'maxFieldError': float(error.max()),
+            'potentialError': abs(treePotential - directPotential) / abs(directPotential)}
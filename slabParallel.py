@@ -0,0 +1,217 @@
+"""
+Multi-core force evaluation for the charged slab.
+
+ParallelForces is a drop-in for the forces(pos, charge, targets=None) -> (field, potential) solvers (coulombSums and
+octreeSums). The worker processes read everything from shared memory segments they map once, so the tasks themselves
+only carry a few integers (and the target indices when a subset is asked for):
+    direct - share(particles) moves a ParticleStore's positions and charges into a segment for good, the calls on
+             them copy nothing (other arrays are copied into a scratch segment). Each task takes a block of targets
+             and sums over all sources with coulombSums
+    octree - the octree is built once per call, in the calling process, and its arrays are copied into a segment.
+             Each task takes a block of consecutive leaves (Octree.blockSums), or a block of the targets when a subset
+             is asked for
+The fields of the blocks are scattered back into place and their shares of the potential added up. The segments are
+only replaced, by larger ones, when the arrays outgrow them. With one worker, too few targets to split, or no shared
+memory available, the solver runs serially in the calling process.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from simtools.processes import process_context
+from slabKernels import coulombSums
+from slabOctree import THETA, Octree, octreeSums
+
+attached = {}  # in a worker: the shared memory segments it has mapped, by name
+
+
+def attach(name, live):
+    """The buffer of the shared segment name, mapped on first use (in the workers). Others not in live are unmapped."""
+    for stale in attached.keys() - set(live):
+        attached.pop(stale).close()
+    if name not in attached:
+        attached[name] = shared_memory.SharedMemory(name=name)
+    return attached[name].buf
+
+
+def particleArrays(buffer, capacity, count):  # the positions and charges of a segment with room for capacity particles
+    pos = np.ndarray((count, 3), buffer=buffer)
+    charge = np.ndarray(count, buffer=buffer, offset=3 * 8 * capacity)
+    return pos, charge
+
+
+def directBlock(live, name, capacity, count, start, stop, targets=None):
+    pos, charge = particleArrays(attach(name, live), capacity, count)
+    targets = np.arange(start, stop) if targets is None else targets
+    field, potential = coulombSums(pos, charge, targets=targets)
+    return targets, field, potential
+
+
+def octreeBlock(live, name, layout, block, blocks, theta, targets=None):
+    buffer = attach(name, live)
+    tree = Octree.fromArrays({array: np.ndarray(shape, dtype, buffer, offset)
+                              for array, dtype, shape, offset in layout})
+    if targets is not None:
+        field, potential = tree.sums(targets, theta)
+        return targets, field, potential
+    return tree.blockSums(block, blocks, theta)
+
+
+class SharedSegment:
+    """A shared memory segment, replaced by a larger one (spare times the size asked for) only when it is too small."""
+
+    def __init__(self, spare=1.):
+        self.spare = spare
+        self.memory = None
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def reserve(self, size):
+        if self.memory is None or size > self.memory.size:
+            self.release()
+            self.memory = shared_memory.SharedMemory(create=True, size=max(int(size * self.spare), 1))
+        return self.memory.buf
+
+    def release(self):
+        if self.memory is not None:
+            self.memory.unlink()
+            try:
+                self.memory.close()
+            except BufferError:  # arrays elsewhere still view it, it is unmapped when they go
+                pass
+            self.memory = None
+
+
+class ParallelForces:
+    """
+    forces(pos, charge, targets=None) on workers processes (all cores by default). solver is 'direct' or 'octree'
+    (with theta and leafSize), every worker gets blocksPerWorker tasks per call for load balancing and subsets of
+    fewer than minTargets targets are evaluated serially. Call share(particles) once the slab's ParticleStore exists
+    and close() (or use it as a context manager) to stop the workers and free the shared memory.
+    """
+
+    def __init__(self, workers=None, solver='direct', theta=THETA, leafSize=8, blocksPerWorker=4, minTargets=256):
+        if solver not in ('direct', 'octree'):
+            raise ValueError(f'unknown solver {solver!r}, expected direct or octree')
+        self.workers = workers or os.cpu_count() or 1
+        self.solver = solver
+        self.theta = theta
+        self.leafSize = leafSize
+        self.blocksPerWorker = blocksPerWorker
+        self.minTargets = minTargets
+        self.pool = None
+        self.store = SharedSegment()  # the shared ParticleStore's positions and charges
+        self.storeCapacity = 0
+        self.shared = None
+        self.scratch = SharedSegment()  # copies of any other positions and charges
+        self.tree = SharedSegment(spare=1.5)  # the octree of the current call, its size varies a little between calls
+
+    def serial(self, pos, charge, targets=None):
+        if self.solver == 'octree':
+            return octreeSums(pos, charge, targets, self.theta, self.leafSize)
+        return coulombSums(pos, charge, targets)
+
+    def share(self, particles):
+        """
+        Moves the positions and charges of the ParticleStore particles into shared memory, where the calls find them
+        without a copy. Merges shrink the arrays in place; the segment is only reallocated when a store with more
+        particles is shared. close() (or sharing another store) moves them back. The octree solver shares its tree
+        instead, so there this does nothing.
+        """
+        if self.solver == 'octree' or self.workers <= 1:
+            return
+        self.__unshare()
+        capacity = max(len(particles), self.storeCapacity)
+        try:
+            buffer = self.store.reserve(4 * 8 * capacity)
+        except OSError:  # no usable shared memory here, e.g. a too small /dev/shm
+            self.workers = 1
+            return
+        self.storeCapacity = capacity
+        pos, charge = particleArrays(buffer, capacity, len(particles))
+        pos[:], charge[:] = particles.pos, particles.charge
+        particles.pos, particles.charge = pos, charge
+        self.shared = particles
+
+    def __call__(self, pos, charge, targets=None):
+        count = len(pos)
+        targetCount = count if targets is None else len(targets)
+        if self.workers <= 1 or targetCount < max(self.minTargets, 2):
+            return self.serial(pos, charge, targets)
+        try:
+            tasks = self.__tasks(pos, charge, targets, min(self.workers * self.blocksPerWorker, targetCount))
+        except OSError:  # no usable shared memory here, e.g. a too small /dev/shm
+            self.workers = 1
+            return self.serial(pos, charge, targets)
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=process_context())
+
+        # the results are indexed by particle, the field is returned in the order of targets
+        field = np.empty((count, 3))
+        potential = 0.
+        for blockTargets, blockField, blockPotential in [future.result() for future in
+                                                         [self.pool.submit(*task) for task in tasks]]:
+            field[blockTargets] = blockField
+            potential += blockPotential
+        return (field if targets is None else field[targets]), potential
+
+    def __tasks(self, pos, charge, targets, blocks):
+        if self.solver == 'octree':
+            layout = self.__shareTree(Octree(pos, charge, self.leafSize))
+            shared = (self.__live(), self.tree.name, layout)
+            if targets is None:
+                return [(octreeBlock, *shared, block, blocks, self.theta) for block in range(blocks)]
+            return [(octreeBlock, *shared, 0, 1, self.theta, block)
+                    for block in np.array_split(np.asarray(targets), blocks)]
+
+        if self.shared is not None and pos is self.shared.pos and charge is self.shared.charge:
+            name, capacity = self.store.name, self.storeCapacity
+        else:
+            capacity = len(pos)
+            scratchPos, scratchCharge = particleArrays(self.scratch.reserve(4 * 8 * capacity), capacity, capacity)
+            scratchPos[:], scratchCharge[:] = pos, charge
+            name = self.scratch.name
+        shared = (self.__live(), name, capacity, len(pos))
+        if targets is None:
+            bounds = np.linspace(0, len(pos), blocks + 1).astype(int)
+            return [(directBlock, *shared, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+        return [(directBlock, *shared, 0, 0, block) for block in np.array_split(np.asarray(targets), blocks)]
+
+    def __shareTree(self, tree):  # copies the tree's arrays into its segment and returns where each one went
+        layout = []
+        size = 0
+        for name in Octree.ARRAYS:  # all of them 8 byte types, so every array stays aligned
+            array = getattr(tree, name)
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += array.nbytes
+        buffer = self.tree.reserve(size)
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype, buffer, offset)[...] = getattr(tree, name)
+        return tuple(layout)
+
+    def __live(self):  # the segments the workers may keep mapped
+        return tuple(segment.name for segment in (self.store, self.scratch, self.tree) if segment.memory is not None)
+
+    def __unshare(self):
+        if self.shared is not None:
+            self.shared.pos, self.shared.charge = self.shared.pos.copy(), self.shared.charge.copy()
+            self.shared = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.__unshare()
+        for segment in (self.store, self.scratch, self.tree):
+            segment.release()
+        self.storeCapacity = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
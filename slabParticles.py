@@ -0,0 +1,107 @@
+"""
+Struct-of-arrays storage for the charged slab's particles.
+
+ParticleStore keeps one contiguous array per property, row i of every array being particle i, so the kernels work on
+the arrays directly and nothing is gathered from or scattered to per-particle objects. Particles are removed by
+swapping the last rows into the holes, which moves only as many rows as are removed; the rows are views of the
+original buffers, so nothing is reallocated either. Rows move around when particles are removed, ids keeps each
+particle's original number (its record columns and its name in the merge history).
+
+ParticleView draws the particles, as spheres or as one point cloud, and is only brought up to date from the arrays
+by sync().
+"""
+from time import perf_counter
+
+import numpy as np
+
+
+class ParticleStore:
+    FIELDS = ('pos', 'vel', 'acc', 'mass', 'charge', 'radius', 'storedEnergy', 'ids')
+
+    def __init__(self, pos=(), charge=(), mass=(), radius=(), ids=None):
+        self.pos = np.array(pos, dtype=float).reshape(-1, 3)
+        self.vel = np.zeros_like(self.pos)
+        self.acc = np.zeros_like(self.pos)
+        self.mass = np.array(mass, dtype=float)
+        self.charge = np.array(charge, dtype=float)
+        self.radius = np.array(radius, dtype=float)
+        self.storedEnergy = np.zeros(len(self.pos))  # from the merges that formed each particle
+        self.ids = np.arange(len(self.pos)) if ids is None else np.array(ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def remove(self, indices):
+        """Removes the particles at indices: the last rows that are kept move into the holes the others leave."""
+        indices = np.unique(indices)
+        keep = len(self) - len(indices)
+        holes = indices[indices < keep]
+        moved = np.setdiff1d(np.arange(keep, len(self)), indices, assume_unique=True)
+        for name in self.FIELDS:
+            array = getattr(self, name)
+            array[holes] = array[moved]
+            setattr(self, name, array[:keep])
+
+    def kineticEnergy(self):
+        return 0.5 * float(self.mass @ np.einsum('ij,ij->i', self.vel, self.vel))
+
+    def getState(self):
+        return {name: getattr(self, name).copy() for name in self.FIELDS}
+
+    @classmethod
+    def fromState(cls, state):
+        particles = cls()
+        for name in cls.FIELDS:
+            empty = getattr(particles, name)
+            setattr(particles, name, np.array(state[name], dtype=empty.dtype).reshape((-1,) + empty.shape[1:]))
+        return particles
+
+
+class ParticleView:
+    """
+    Draws a ParticleStore with a simtools.render backend, as one sphere per particle id or (points=True) as a single
+    point cloud colored by sign, which costs one update per frame however many particles there are. sync() copies
+    positions, radii and colors from the arrays at most maxFps times a second of wall time unless forced, so the frame
+    rate does not follow the physics step rate. With the null backend nothing is drawn at all.
+    """
+
+    def __init__(self, backend, maxFps=60, points=False):
+        self.backend = backend
+        self.maxFps = maxFps
+        self.points = points
+        self.spheres = {}
+        self.cloud = None
+        self.lastSync = -np.inf
+
+    def sync(self, particles, force=False):
+        if self.backend.name == 'null' or not force and perf_counter() - self.lastSync < 1 / self.maxFps:
+            return
+        self.lastSync = perf_counter()
+        if self.points:
+            self.__syncCloud(particles)
+        else:
+            self.__syncSpheres(particles)
+
+    def __signColors(self, charge):
+        color = self.backend.color
+        palette = np.array([[c.x, c.y, c.z] for c in (color.blue, color.gray(0.5), color.red)])
+        return palette[np.sign(charge).astype(np.int64) + 1]
+
+    def __syncCloud(self, particles):
+        if self.cloud is None:
+            self.cloud = self.backend.point_cloud(radius=float(particles.radius.mean()) if len(particles) else 0.01)
+        self.cloud.update(particles.pos, self.__signColors(particles.charge), particles.radius)
+
+    def __syncSpheres(self, particles):
+        vector, color = self.backend.vector, self.backend.color
+        for particleId, pos, radius, charge in zip(particles.ids.tolist(), particles.pos.tolist(),
+                                                   particles.radius.tolist(), particles.charge.tolist()):
+            if particleId not in self.spheres:
+                self.spheres[particleId] = self.backend.sphere(pos=vector(*pos), radius=radius, make_trail=False)
+            sphere = self.spheres[particleId]
+            sphere.pos = vector(*pos)
+            sphere.radius = radius
+            sphere.color = color.red if charge > 0 else color.blue if charge < 0 else color.gray(0.5)
+            sphere.visible = True
+        for particleId in self.spheres.keys() - set(particles.ids.tolist()):
+            self.spheres[particleId].visible = False
@@ -0,0 +1,109 @@
+"""
+Individual power-of-two (block) timesteps for the charged slab.
+
+With one global dt = min(findMinDist() ** 2, 0.003) a single close pair makes every charge take tiny steps. Here
+each particle i gets its own level l_i and timestep dt_i = dtMax / 2 ** l_i, the largest power-of-two fraction of
+dtMax that satisfies
+    dt_i <= nearest_i ** 2                          (the global rule, applied per particle)
+    dt_i <= eta * sqrt(nearest_i / |a_i|)           (the particle's own acceleration)
+where nearest_i is the distance to its nearest neighbour. Levels stop at maxLevel: the default 10 (dt_i >= dtMax / 1024)
+still resolves pairs a quarter of the merge distance apart, closer opposite charges merge anyway.
+
+A block step of dtMax is integrated with kick-drift-kick leapfrog on a grid of 2 ** maxLevel ticks. At a sub-step only
+the particles whose own step ends there (the active ones) are drifted, bounced off the walls, have their accelerations
+evaluated (for those targets only) and are kicked. Within a step a particle moves in a straight line with its
+half-kicked velocity, so the sources' positions at the sub-step are predicted from where each particle's step started
+(held inside the walls), which is exact but for the bounces. The active particles then pick their next level, finer
+always, coarser only where the current tick lies on the coarser level's grid, with their nearest distances looked up
+among the predicted positions; the cell list is only built at the start of a block step, when everyone is active, so
+the work of a sub-step grows with its active particles rather than with all of them. At the end of the block step
+every particle is active, so all of them are synchronized again and the accelerations and the potential of the new
+positions come with the last evaluation.
+"""
+import numpy as np
+
+from slabKernels import coulombSums, nearestDistances, wallCollisions
+from slabNeighbours import CellList
+
+
+class BlockTimesteps:
+    def __init__(self, dtMax=0.003, maxLevel=10, eta=0.2):
+        self.dtMax = dtMax
+        self.maxLevel = maxLevel
+        self.eta = eta
+        self.levels = np.zeros(0, dtype=int)
+        self.forceEvaluations = 0  # target particles whose accelerations were evaluated, over all sub-steps
+        self.subSteps = 0
+        self.synchronizedAt = None  # set by the caller, marks the state the returned accelerations belong to
+        self.neighbours = CellList()
+
+    def chooseLevels(self, pos, a, targets):
+        if len(targets) == len(pos):  # the start of a block step
+            self.neighbours.update(pos)
+            nearest = self.neighbours.nearestDistances(targets)
+        else:  # a few active particles, cheaper than bringing the cells up to date
+            nearest = nearestDistances(pos, targets)
+        acceleration = np.linalg.norm(a[targets], axis=1)
+        accelerationLimit = self.eta * np.sqrt(np.divide(nearest, acceleration, out=np.full_like(nearest, np.inf),
+                                                         where=acceleration > 0))
+        dt = np.minimum(np.minimum(nearest ** 2, accelerationLimit), self.dtMax)
+        with np.errstate(divide='ignore'):  # coincident particles, dt = 0, get the deepest level
+            levels = np.ceil(np.log2(self.dtMax / dt))
+        return np.clip(levels, 0, self.maxLevel).astype(np.int64)
+
+    def step(self, pos, v, a, charge, accelerationScale, borders, forces=coulombSums):
+        """
+        Advances the particles by dtMax, pos and v in place. a is the acceleration at pos (evaluated when None),
+        accelerationScale the factor between the field and the acceleration (kCoulomb * charge / m) and forces is
+        coulombSums or octreeSums. Returns the accelerations and the pair potential of the new positions.
+        """
+        everyone = np.arange(len(pos))
+        ticks = 1 << self.maxLevel
+        tickDt = self.dtMax / ticks
+        lastTick = np.zeros(len(pos), dtype=np.int64)  # the tick each particle's pos belongs to
+
+        def predicted(tick):  # all the positions at tick, the ones mid-step drifted ahead
+            ahead = pos + v * ((tick - lastTick) * tickDt)[:, None]
+            for axis, (low, high) in enumerate(borders):
+                np.clip(ahead[:, axis], low, high, out=ahead[:, axis])
+            return ahead
+
+        def accelerations(sources, targets):
+            self.forceEvaluations += len(targets)
+            field, potential = forces(sources, charge, targets=None if len(targets) == len(pos) else targets)
+            return accelerationScale[targets, None] * field, potential
+
+        if a is None:
+            a, _ = accelerations(pos, everyone)
+        self.levels = self.chooseLevels(pos, a, everyone)
+        period = ticks >> self.levels  # ticks per step of each particle
+        endTick = period.copy()
+        v += 0.5 * (period * tickDt)[:, None] * a  # every particle opens a step
+
+        tick = 0
+        pairPotential = None
+        while tick < ticks:
+            tick = int(endTick.min())
+            self.subSteps += 1
+            active = everyone[endTick == tick]
+            activePos = pos[active] + v[active] * ((tick - lastTick[active]) * tickDt)[:, None]
+            activeV = v[active]
+            wallCollisions(activePos, activeV, borders)
+            pos[active], v[active] = activePos, activeV
+            lastTick[active] = tick
+
+            sources = pos if len(active) == len(pos) else predicted(tick)
+            a[active], pairPotential = accelerations(sources, active)
+            v[active] += 0.5 * (period[active] * tickDt)[:, None] * a[active]  # closes their step
+            tooFast = active[np.einsum('ij,ij->i', v[active], v[active]) > 100 ** 2]
+            v[tooFast] /= 10
+            if tick == ticks:
+                break
+
+            # the next step, no coarser than the grid the current tick lies on allows
+            alignedLevel = self.maxLevel - ((tick & -tick).bit_length() - 1)
+            self.levels[active] = np.maximum(self.chooseLevels(sources, a, active), alignedLevel)
+            period[active] = ticks >> self.levels[active]
+            endTick[active] = tick + period[active]
+            v[active] += 0.5 * (period[active] * tickDt)[:, None] * a[active]
+        return a, pairPotential